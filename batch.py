@@ -0,0 +1,198 @@
+""" Headless batch voxelization of image directories, spread over a process pool.
+
+Example:
+    python batch.py "scans/*.jpg" -o voxels --channels 0 2 --sizes 2 6 --min 30 --max 220
+    python batch.py rasters/ -o voxels --space Lab
+    python batch.py "dem/*.tif" -o voxels --value-range 0 4000
+"""
+
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import instrument
+from channels import COLOR_SPACES
+from core import derive_channels, grid_origin, read_image, voxelize_channels
+from engine import VoxelEngine
+from imaging import FIXED_WIDTH
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def find_images(inputs):
+    """
+    Expands directories (with their subdirectories) and glob patterns ('**' matching any
+    depth) into a sorted list of image files.
+
+    :param      inputs | list of str
+
+    :return     list of str
+    """
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(root, name) for root, _, names in os.walk(pattern) for name in names]
+        else:
+            candidates = glob.glob(pattern, recursive=True)
+
+        paths.update(p for p in candidates if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(p))
+
+    return sorted(paths)
+
+
+def output_paths(paths, out_dir):
+    """
+    Returns the .npz path of each image: its path relative to the deepest directory holding
+    all the images, mirrored under out_dir, so that images of the same name do not overwrite
+    each other ('a/x.jpg' -> 'out/a/x.jpg.npz', 'b/x.jpg' -> 'out/b/x.jpg.npz').
+
+    :param      paths | list of str
+                out_dir | str
+
+    :return     list of str
+    """
+    if not paths:
+        return []
+
+    absolute = [os.path.abspath(path) for path in paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in absolute])
+
+    # the extension is kept, so that 'a.jpg' and 'a.png' do not collide
+    return [os.path.join(out_dir, os.path.relpath(path, root) + '.npz') for path in absolute]
+
+
+def process_image(img_path, out_path, channels, sizes, lower, upper, width, space='Native', engine=None, values=None):
+    """
+    Runs the image-to-voxels pipeline on one image and writes the result as .npz to out_path.
+
+    The archive holds, for each channel c and voxel size s, the arrays 'c{c}_s{s}_indices'
+    and 'c{c}_s{s}_values' (grid indices and mean intensity) and 'c{c}_s{s}_origin'.
+    Channels are those of the colour space (see channels.py), all of them if None.
+    With an engine, the (channel, size) jobs of the image run on its process pool, which
+    shares the image (see engine.VoxelEngine). With values, images deeper than 8 bits are
+    rescaled over that fixed range, so that intensities compare across images.
+
+    :return     (str, int, int, list) | output path, number of pixels, number of voxels,
+                and the spans recorded by this process when profiling
+    """
+    image_array = derive_channels(read_image(img_path, width, values), space)
+    if channels is None:
+        channels = range(image_array.shape[2])
+    channels = [c for c in channels if c < image_array.shape[2]]
+
+    if engine is not None:
+        engine.load(image_array)
+        voxels = engine.voxelize([(c, s, lower, upper) for s in sizes for c in channels])
+    else:
+        voxels = {}
+        for s in sizes:
+            # all the channels go through voxelization together
+            by_channel = voxelize_channels(image_array[:, :, channels], s, lower, upper)
+            voxels.update(((c, s), channel_voxels) for c, channel_voxels in zip(channels, by_channel))
+
+    arrays = {'shape': np.array(image_array.shape)}
+    n_voxels = 0
+    for (c, s), (indices, intensities) in voxels.items():
+        arrays[f'c{c}_s{s}_indices'] = indices
+        arrays[f'c{c}_s{s}_values'] = intensities
+        arrays[f'c{c}_s{s}_origin'] = grid_origin(image_array.shape[1], s)
+        n_voxels += len(indices)
+
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    with instrument.span('write'):
+        np.savez(out_path, **arrays)
+
+    return out_path, image_array.shape[0] * image_array.shape[1], n_voxels, instrument.take_events()
+
+
+def run(paths, out_dir, channels, sizes, lower, upper, width, workers, space='Native', values=None):
+    """
+    Processes all the images on a process pool, reporting progress and throughput.
+
+    The outputs mirror the directories of the images under out_dir, see output_paths.
+
+    With fewer images than workers, images are processed one at a time instead, each
+    spreading its (channel, size) jobs over the workers of one engine for the whole run.
+
+    :return     int | number of failed images
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n_pixels = 0
+    n_failed = 0
+    start = time.perf_counter()
+
+    # worker processes record their own spans, which are sent back with the results
+    initializer = instrument.enable if instrument.is_enabled() else None
+
+    if len(paths) < workers:
+        pool, engine = ThreadPoolExecutor(max_workers=1), VoxelEngine(None, workers, processes=True)
+    else:
+        pool, engine = ProcessPoolExecutor(max_workers=workers, initializer=initializer), None
+
+    with pool, engine or contextlib.nullcontext():
+        futures = {pool.submit(process_image, path, out_path, channels, sizes, lower, upper, width, space,
+                               engine, values): path
+                   for path, out_path in zip(paths, output_paths(paths, out_dir))}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                out_path, pixels, voxels, events = future.result()
+            except Exception as exc:
+                n_failed += 1
+                print(f'[{done}/{len(paths)}] {path} failed: {exc}', file=sys.stderr)
+                continue
+
+            n_pixels += pixels
+            instrument.add_events(events)
+            elapsed = time.perf_counter() - start
+            print(f'[{done}/{len(paths)}] {out_path} ({voxels} voxels) - '
+                  f'{done / elapsed:.2f} img/s, {n_pixels / elapsed / 1e6:.1f} Mpx/s')
+
+    elapsed = time.perf_counter() - start
+    print(f'{len(paths) - n_failed} images in {elapsed:.1f} s, {n_failed} failed')
+    if instrument.is_enabled():
+        print(instrument.summary())
+
+    return n_failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Voxelize whole image directories without the GUI.')
+    parser.add_argument('inputs', nargs='+', help='image directories (searched recursively) or glob patterns')
+    parser.add_argument('-o', '--output', default='voxels', help='output directory')
+    parser.add_argument('--channels', type=int, nargs='+', help='channel indices (default: all)')
+    parser.add_argument('--space', choices=list(COLOR_SPACES), default='Native', help='colour space of the channels')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 6, 15], help='voxel sizes')
+    parser.add_argument('--min', type=int, default=0, dest='lower', help='min. intensity')
+    parser.add_argument('--max', type=int, default=255, dest='upper', help='max. intensity')
+    parser.add_argument('--width', type=int, default=FIXED_WIDTH, help='resize width')
+    parser.add_argument('--value-range', type=float, nargs=2, metavar=('LOW', 'HIGH'),
+                        help='values mapped to intensities 0-255 in every image deeper than 8 bits '
+                             '(default: the range of each image)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--profile', action='store_true', help='time the pipeline stages')
+    parser.add_argument('--trace', help='JSON file where the timings are dumped at exit')
+    args = parser.parse_args(argv)
+
+    if args.profile or args.trace:
+        instrument.enable(args.trace)
+
+    paths = find_images(args.inputs)
+    if not paths:
+        parser.error('no image found')
+
+    n_failed = run(paths, args.output, args.channels, args.sizes, args.lower, args.upper, args.width,
+                   args.workers, args.space, args.value_range and tuple(args.value_range))
+
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
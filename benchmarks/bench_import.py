@@ -0,0 +1,76 @@
+""" Import time of the headless modules, which worker processes import many times.
+
+Each module is imported in a fresh interpreter, and must neither exceed the time budget
+nor pull in the heavy libraries (Open3D, PIL, matplotlib):
+    python benchmarks/bench_import.py -o import.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['core', 'voxelizer', 'grid_store', 'lod', 'tiles', 'meshing', 'picking', 'intensity_index', 'channels',
+           'pooling', 'sequence', 'disk_cache', 'scene_cache', 'engine', 'export', 'batch', 'memory']
+HEAVY_MODULES = ['open3d', 'PIL', 'matplotlib']
+# Import time budget of each module, in seconds (NumPy alone takes most of it)
+BUDGET_S = 0.5
+
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'duration_s': duration, 'heavy': heavy}}))
+'''
+
+
+def measure(module, repeat):
+    """
+    Imports a module in fresh interpreters, returns the median time and the heavy modules loaded.
+
+    :return     (float, list of str)
+    """
+    timings = []
+    heavy = []
+    for _ in range(repeat):
+        probe = PROBE.format(module=module, heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['duration_s'])
+        heavy = result['heavy']
+
+    return statistics.median(timings), heavy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the import time of the headless modules.')
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module')
+    parser.add_argument('--budget', type=float, default=BUDGET_S, help='max. import time, in seconds')
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    args = parser.parse_args(argv)
+
+    results = []
+    n_failed = 0
+    for module in MODULES:
+        duration, heavy = measure(module, args.repeat)
+        failed = duration > args.budget or bool(heavy)
+        n_failed += failed
+        results.append({'module': module, 'median_s': duration, 'heavy_imports': heavy})
+        print(f'{module:<12} {duration * 1e3:8.1f} ms {" ".join(heavy)}{"  <-- too slow/heavy" if failed else ""}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
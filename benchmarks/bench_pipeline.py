@@ -0,0 +1,213 @@
+""" CPU benchmarks of the image-to-voxels pipeline, run without the GUI.
+
+Results are written as JSON, and can be compared with the results of another commit:
+    python benchmarks/bench_pipeline.py -o bench.json
+    python benchmarks/bench_pipeline.py -o new.json --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import resources as res
+from engine import VoxelEngine
+from grid_store import build_geometry
+from pooling import BlockPool
+from core import IntensityIndex, LevelFilter, channel_colors, derive_channels, filter_point_cloud_by_intensity, \
+    grid_origin, read_image, replace_pixels_between_thresholds, surface_from_image, voxelize_channel, voxelize_channels
+
+VOXEL_SIZES = [2, 6, 15]
+BUNDLED_IMAGES = ['img/dog.png', 'img/miniature.png']
+# Intensity window used by the filter benchmarks
+WINDOW = (50, 200)
+
+
+def synthetic_image(width, seed=0):
+    """
+    Returns a reproducible RGB test image: smooth gradients plus noise.
+
+    :param      width | int
+
+    :return     np.ndarray (3 * width // 4, width, 3) uint8
+    """
+    height = 3 * width // 4
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / width
+    planes = [128 + 100 * np.sin(6 * x + 2 * k) * np.cos(4 * y - k) for k in range(3)]
+    image = np.stack(planes, axis=2) + rng.normal(0, 12, (height, width, 3))
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def pipeline_cases(image_array):
+    """
+    Yields (name, callable) for each benchmarked stage on one image.
+    """
+    chan = image_array[:, :, 0]
+    surface = surface_from_image(image_array)
+    points = surface.points(0)
+
+    yield 'surface_from_image', lambda: surface_from_image(image_array).points(0)
+    yield 'filter_point_cloud_by_intensity', lambda: filter_point_cloud_by_intensity(points, *WINDOW)
+    yield 'replace_pixels_between_thresholds', lambda: replace_pixels_between_thresholds(image_array, *WINDOW, 0)
+
+    point_index = surface.intensity_index(0)
+    image_index = IntensityIndex(image_array)
+    yield 'intensity_index', lambda: IntensityIndex(chan)
+    yield 'filter_point_cloud_by_intensity_indexed', \
+        lambda: filter_point_cloud_by_intensity(points, *WINDOW, index=point_index)
+    yield 'replace_pixels_between_thresholds_indexed', \
+        lambda: replace_pixels_between_thresholds(image_array, *WINDOW, 0, index=image_index)
+
+    yield 'derive_channels_lab', lambda: derive_channels(image_array, 'Lab')
+
+    # decoding a JPEG to a quarter of its width goes through DCT scaling
+    from PIL import Image
+    # (cases run as they are yielded, so the file is removed once its case is timed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jpeg_path = os.path.join(tmp_dir, 'bench.jpg')
+        Image.fromarray(image_array).save(jpeg_path, quality=90)
+        yield 'read_image_jpeg_quarter', lambda: read_image(jpeg_path, image_array.shape[1] // 4)
+
+    block_pool = BlockPool(chan)
+    yield 'block_pool', lambda: BlockPool(chan)
+
+    # level filters of every channel and size, one after another, then on the engine threads
+    jobs = [(c, size) for c in range(image_array.shape[2]) for size in VOXEL_SIZES]
+    yield 'level_filters', lambda: [LevelFilter(image_array[:, :, c], size) for c, size in jobs]
+    with VoxelEngine(image_array) as engine:
+        yield 'level_filters_engine', lambda: engine.level_filters(jobs)
+
+    for size in VOXEL_SIZES:
+        yield f'voxelize_channels_s{size}', lambda size=size: voxelize_channels(image_array, size)
+        origin = grid_origin(image_array.shape[1], size)
+        yield f'voxelize_s{size}', lambda size=size: voxelize_channel(chan, size)
+
+        def voxel_grid(size=size, origin=origin):
+            indices, values = voxelize_channel(chan, size)
+            build_geometry(indices, channel_colors(values, 0), size, origin)
+
+        yield f'voxel_grid_s{size}', voxel_grid
+
+        # path of the min/max edits: window over precomputed voxels, then a new grid
+        level_filter = LevelFilter(chan, size)
+
+        def edit_window(level_filter=level_filter, size=size, origin=origin):
+            level_filter.set_window(0, 255)
+            indices, values = level_filter.window(*WINDOW)
+            build_geometry(indices, channel_colors(values, 0), size, origin)
+
+        yield f'edit_window_s{size}', edit_window
+        yield f'pool_max_s{size}', lambda size=size: block_pool.voxels(size, *WINDOW, mode='max')
+
+
+def run(widths, repeat, bundled=True):
+    images = [('synthetic', synthetic_image)]
+    if bundled:
+        images += [(name, lambda w, name=name: read_image(res.find(name), w)) for name in BUNDLED_IMAGES]
+
+    results = []
+    for image_name, make in images:
+        for width in widths:
+            image_array = make(width)
+            for name, func in pipeline_cases(image_array):
+                timings = timeit(func, repeat)
+                results.append({
+                    'name': name,
+                    'image': image_name,
+                    'width': int(image_array.shape[1]),
+                    'height': int(image_array.shape[0]),
+                    'repeat': repeat,
+                    'min_s': min(timings),
+                    'median_s': statistics.median(timings),
+                })
+                print(f'{image_name:>20} {width:>6} {name:<36} {statistics.median(timings) * 1e3:9.2f} ms')
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, fail_ratio):
+    """
+    Prints the ratio of each median time to the baseline, returns the number of regressions.
+    """
+    reference = {(r['name'], r['image'], r['width']): r['median_s'] for r in baseline['results']}
+    n_regressions = 0
+    print(f'\nCompared to {baseline.get("commit")}:')
+    for r in results:
+        key = (r['name'], r['image'], r['width'])
+        if key not in reference:
+            continue
+
+        ratio = r['median_s'] / reference[key]
+        flag = ''
+        if ratio > fail_ratio:
+            flag = '  <-- regression'
+            n_regressions += 1
+        print(f'{r["image"]:>20} {r["width"]:>6} {r["name"]:<36} {ratio:6.2f}x{flag}')
+
+    return n_regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the image-to-voxels pipeline.')
+    parser.add_argument('--widths', type=int, nargs='+', default=[256, 1000, 2000], help='image widths')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measure')
+    parser.add_argument('--no-bundled', action='store_true', help='only use synthetic images')
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--fail-ratio', type=float, default=1.2, help='slowdown flagged as regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.widths, args.repeat, not args.no_bundled)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.fail_ratio):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
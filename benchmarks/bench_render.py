@@ -0,0 +1,236 @@
+""" Offscreen rendering benchmark: frame time of the viewer's geometries versus their size.
+
+Each image is voxelized at each voxel size, shown as a VoxelGrid and as a merged mesh
+with each shader of the viewer, and rendered by Open3D's OffscreenRenderer while the
+camera orbits around it. Software rendering is used by default, so that no GPU is needed
+(Linux, with Mesa); --gpu renders on the GPU instead:
+    python benchmarks/bench_render.py -o render.json
+    python benchmarks/bench_render.py -o new.json --compare render.json
+
+The report holds, for each case, the upload time (add_geometry and first frame), the
+frame times, the voxel and triangle counts and the memory, and ends with the number of
+voxels each shader can draw within a frame time target.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from bench_pipeline import BUNDLED_IMAGES, VOXEL_SIZES, compare, git_commit, synthetic_image
+
+import resources as res
+from core import channel_colors, grid_origin, read_image, voxelize_channel
+from grid_store import build_geometry
+from scene_cache import render_bytes
+
+# Shaders of the viewer's "Rendering" combo
+SHADERS = ['defaultLit', 'defaultUnlit', 'normals', 'depth']
+# Frames rendered along the orbit of the camera
+N_FRAMES = 24
+# Frame time used to derive the voxel budgets (30 fps)
+TARGET_MS = 33.0
+
+
+def rss_bytes():
+    # resident memory of the process, renderer included
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def orbit_eye(bounds, angle):
+    # 60 degrees above the image plane, as after a reset of the view and some orbiting
+    distance = 3 * max(bounds.get_extent())
+    return bounds.get_center() + distance * np.array([0.5 * np.cos(angle), 0.5 * np.sin(angle), np.sqrt(3) / 2])
+
+
+def setup_camera(renderer, bounds):
+    # the (fov, bounds, center) overload only exists on gui.SceneWidget: the eye is given here
+    renderer.setup_camera(30, bounds.get_center(), orbit_eye(bounds, 0.0), [0, -1, 0])
+
+
+def orbit(renderer, bounds, n_frames):
+    """
+    Renders frames around the geometry, with the camera of the viewer (see main.py), and
+    returns their durations.
+
+    :return     list of float, in seconds
+    """
+    center = bounds.get_center()
+    setup_camera(renderer, bounds)
+
+    timings = []
+    for k in range(n_frames):
+        eye = orbit_eye(bounds, 2 * np.pi * k / n_frames)
+        renderer.scene.camera.look_at(center, eye, [0, -1, 0])
+
+        start = time.perf_counter()
+        renderer.render_to_image()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def render_cases(renderer, image_array, n_frames):
+    """
+    Yields the results of each (voxel size, geometry, shader) case on one image.
+    """
+    import open3d.visualization.rendering as rendering
+
+    chan = image_array[:, :, 0]
+    for size in VOXEL_SIZES:
+        indices, values = voxelize_channel(chan, size)
+        colors = channel_colors(values, 0)
+        origin = grid_origin(image_array.shape[1], size)
+
+        for mesh in (False, True):
+            geometry, nbytes = build_geometry(indices, colors, size, origin, mesh)
+            n_triangles = len(geometry.triangles) if mesh else 12 * len(indices)
+            bounds = geometry.get_axis_aligned_bounding_box()
+
+            for shader in SHADERS:
+                material = rendering.MaterialRecord()
+                material.shader = shader
+                renderer.scene.clear_geometry()
+                memory_before = rss_bytes()
+
+                start = time.perf_counter()
+                renderer.scene.add_geometry('grid', geometry, material)
+                setup_camera(renderer, bounds)
+                renderer.render_to_image()
+                upload = time.perf_counter() - start
+
+                timings = orbit(renderer, bounds, n_frames)
+                memory_after = rss_bytes()
+
+                yield {
+                    'name': f'{"mesh" if mesh else "voxels"}_{shader}_s{size}',
+                    'voxel_size': size,
+                    'geometry': 'mesh' if mesh else 'voxels',
+                    'shader': shader,
+                    'voxels': len(indices),
+                    'triangles': n_triangles,
+                    'geometry_bytes': nbytes,
+                    'render_bytes': render_bytes(geometry, nbytes),
+                    'rss_delta_bytes': None if memory_before is None else memory_after - memory_before,
+                    'upload_s': upload,
+                    'frames': n_frames,
+                    'median_s': statistics.median(timings),
+                    'p95_s': float(np.percentile(timings, 95)),
+                }
+
+
+def run(widths, n_frames, bundled=True, resolution=(1280, 720)):
+    import open3d.visualization.rendering as rendering
+
+    images = [('synthetic', synthetic_image)]
+    if bundled:
+        images += [(name, lambda w, name=name: read_image(res.find(name), w)) for name in BUNDLED_IMAGES]
+
+    renderer = rendering.OffscreenRenderer(*resolution)
+    # background and lighting of the viewer
+    renderer.scene.set_background([0, 0, 0, 1])
+    renderer.scene.scene.set_sun_light([0.45, 0.45, -1], [1, 1, 1], 100000)
+    renderer.scene.scene.enable_sun_light(True)
+    renderer.scene.scene.enable_indirect_light(True)
+
+    results = []
+    for image_name, make in images:
+        for width in widths:
+            image_array = make(width)
+            for result in render_cases(renderer, image_array, n_frames):
+                result.update(image=image_name, width=int(image_array.shape[1]), height=int(image_array.shape[0]))
+                results.append(result)
+                print(f'{image_name:>20} {width:>6} {result["name"]:<28} {result["voxels"]:>9} voxels '
+                      f'{result["median_s"] * 1e3:8.2f} ms/frame (p95 {result["p95_s"] * 1e3:.2f}), '
+                      f'upload {result["upload_s"] * 1e3:.1f} ms')
+
+    renderer.scene.clear_geometry()
+    # the renderer must be released before the interpreter exits
+    del renderer
+
+    return results
+
+
+def voxel_budgets(results, target_ms=TARGET_MS):
+    """
+    Fits the frame time of each geometry and shader as a linear function of the voxel
+    count, and returns the number of voxels rendered within the target frame time.
+
+    :return     dict | {(geometry, shader): (ms per million voxels, voxel budget or None)}
+    """
+    budgets = {}
+    for key in sorted({(r['geometry'], r['shader']) for r in results}):
+        cases = [r for r in results if (r['geometry'], r['shader']) == key]
+        voxels = np.array([r['voxels'] for r in cases], dtype=float)
+        frame_ms = np.array([r['median_s'] * 1e3 for r in cases])
+        if len(set(voxels)) < 2:
+            continue
+
+        slope, intercept = np.polyfit(voxels, frame_ms, 1)
+        budget = int((target_ms - intercept) / slope) if slope > 0 and target_ms > intercept else None
+        budgets[key] = (float(slope) * 1e6, budget)
+
+    return budgets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the offscreen rendering of the voxel grids.')
+    parser.add_argument('--widths', type=int, nargs='+', default=[256, 1000], help='image widths')
+    parser.add_argument('--frames', type=int, default=N_FRAMES, help='frames rendered per case')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[1280, 720], help='width and height of the frames')
+    parser.add_argument('--gpu', action='store_true', help='render on the GPU instead of the CPU')
+    parser.add_argument('--target-ms', type=float, default=TARGET_MS, help='frame time of the voxel budgets')
+    parser.add_argument('--no-bundled', action='store_true', help='only use synthetic images')
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--fail-ratio', type=float, default=1.2, help='slowdown flagged as regression')
+    args = parser.parse_args(argv)
+
+    if not args.gpu:
+        # read when Open3D is imported
+        os.environ.setdefault('OPEN3D_CPU_RENDERING', 'true')
+    import open3d
+
+    results = run(args.widths, args.frames, not args.no_bundled, tuple(args.resolution))
+
+    budgets = voxel_budgets(results, args.target_ms)
+    print(f'\nVoxels rendered within {args.target_ms:.0f} ms:')
+    for (geometry, shader), (ms_per_million, budget) in budgets.items():
+        print(f'{geometry:>8} {shader:<14} {ms_per_million:8.2f} ms per million voxels, budget {budget}')
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'open3d': open3d.__version__,
+        'renderer': 'gpu' if args.gpu else 'cpu',
+        'resolution': args.resolution,
+        'machine': platform.machine(),
+        'results': results,
+        'budgets': [{'geometry': geometry, 'shader': shader, 'ms_per_million_voxels': ms, 'voxels': budget}
+                    for (geometry, shader), (ms, budget) in budgets.items()],
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.fail_ratio):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+""" Channels of any image as 8-bit heightfields: native bands, luminance, HSV and Lab.
+
+The rest of the pipeline works on uint8 intensities (the z axis, the intensity filter and
+its index are 0-255), so images of other depths are rescaled here rather than clipped:
+8 and 16-bit integers over the range of their type, wider integers and floats over the
+range of their data (floats within [0, 1] keep it).
+
+A data range differs from one image to the next, so the intensities of such images are
+not comparable with each other; a fixed range (the 'values' of to_uint8, the
+--value-range flag of main.py and batch.py) maps the same value to the same intensity
+in every image.
+"""
+
+import numpy as np
+
+from instrument import span
+
+# Derived colour spaces of RGB(A) images, and the names of their channels
+COLOR_SPACES = {
+    'Native': None,
+    'Luminance': ['Luminance'],
+    'HSV': ['Hue', 'Saturation', 'Value'],
+    'Lab': ['L*', 'a*', 'b*'],
+}
+
+# sRGB (D65) to XYZ, rows scaled by the white point so that white is (1, 1, 1)
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]]) / np.array([[0.95047], [1.0], [1.08883]])
+
+
+def as_channels(image_array):
+    # grayscale images are (H, W)
+    return image_array[:, :, None] if image_array.ndim == 2 else image_array
+
+
+def value_range(image_array):
+    """
+    Returns the range of values mapped to 0-255 for an image of any depth.
+
+    :param      image_array | np.ndarray
+
+    :return     (float, float)
+    """
+    dtype = image_array.dtype
+    if dtype == np.bool_:
+        return 0, 1
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        info = np.iinfo(dtype)
+        return info.min, info.max
+
+    low, high = float(np.nanmin(image_array)), float(np.nanmax(image_array))
+    if np.issubdtype(dtype, np.floating) and 0.0 <= low and high <= 1.0:
+        return 0.0, 1.0
+
+    return low, high
+
+
+def to_uint8(image_array, values=None):
+    """
+    Rescales an image of any depth to uint8; uint8 images are returned unchanged.
+
+    :param      image_array | np.ndarray
+                values | (float, float), range mapped to 0-255, values outside of it are
+                clipped (by default, see value_range)
+
+    :return     np.ndarray, same shape, uint8
+    """
+    if image_array.dtype == np.uint8:
+        return image_array
+
+    low, high = value_range(image_array) if values is None else values
+    scale = 255 / (high - low) if high > low else 0.0
+    scaled = (image_array.astype(np.float32) - low) * scale
+    np.nan_to_num(scaled, copy=False)
+
+    return np.rint(np.clip(scaled, 0, 255)).astype(np.uint8)
+
+
+def native_names(n_channels):
+    if n_channels == 1:
+        return ['Gray']
+    if n_channels == 2:
+        return ['Gray', 'Alpha']
+    if n_channels in (3, 4):
+        return ['Red', 'Green', 'Blue', 'Alpha'][:n_channels]
+
+    return [f'Band {c + 1}' for c in range(n_channels)]
+
+
+def color_spaces(n_channels):
+    # colour spaces are derived from the red, green and blue channels
+    return list(COLOR_SPACES) if n_channels in (3, 4) else ['Native']
+
+
+def channel_names(n_channels, space='Native'):
+    return COLOR_SPACES[space] or native_names(n_channels)
+
+
+def channel_tints(n_channels, space='Native'):
+    """
+    Returns the display tint of each channel: its own color for red, green and blue, white
+    for the others.
+
+    :return     list of np.ndarray (3,)
+    """
+    names = channel_names(n_channels, space)
+    primaries = {'Red': 0, 'Green': 1, 'Blue': 2}
+
+    return [np.eye(3)[primaries[name]] if name in primaries else np.ones(3) for name in names]
+
+
+def _hsv(rgb):
+    high = rgb.max(axis=2)
+    delta = high - rgb.min(axis=2)
+    safe = np.where(delta > 0, delta, 1)
+
+    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    hue = np.where(high == r, (g - b) / safe % 6,
+                   np.where(high == g, (b - r) / safe + 2, (r - g) / safe + 4)) / 6
+    hue[delta == 0] = 0
+    saturation = np.where(high > 0, delta / np.where(high > 0, high, 1), 0)
+
+    return np.stack([hue, saturation, high], axis=2)
+
+
+def _lab(rgb):
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ _RGB_TO_XYZ.T.astype(np.float32)
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+
+    lab = np.empty_like(f)
+    # L* in [0, 100], a* and b* about [-128, 127], as 8-bit Lab
+    lab[:, :, 0] = (116 * f[:, :, 1] - 16) / 100
+    lab[:, :, 1] = (500 * (f[:, :, 0] - f[:, :, 1]) + 128) / 255
+    lab[:, :, 2] = (200 * (f[:, :, 1] - f[:, :, 2]) + 128) / 255
+
+    return lab
+
+
+def derive_channels(image_array, space='Native'):
+    """
+    Returns the channels of an image in a colour space, all computed in one pass.
+
+    :param      image_array | np.ndarray (H, W, C) uint8 (see to_uint8)
+                space | str, key of COLOR_SPACES
+
+    :return     np.ndarray (H, W, K) uint8
+    """
+    if COLOR_SPACES[space] is None:
+        return image_array
+    if space not in color_spaces(image_array.shape[2]):
+        raise ValueError(f'{space} channels need an RGB image')
+
+    with span('derive_channels', space=space):
+        rgb = image_array[:, :, :3].astype(np.float32) / 255
+        if space == 'Luminance':
+            planes = (rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32))[:, :, None]
+        elif space == 'HSV':
+            planes = _hsv(rgb)
+        else:
+            planes = _lab(rgb)
+
+        return np.rint(np.clip(planes * 255, 0, 255)).astype(np.uint8)
@@ -0,0 +1,130 @@
+""" Image processing core of the application, importable without the GUI.
+
+Only NumPy is imported eagerly: Open3D and PIL are imported by the functions that need
+them, so that worker processes and command line tools start quickly.
+"""
+
+import math
+
+import numpy as np
+
+from channels import derive_channels, to_uint8
+from instrument import span
+from imaging import read_image
+from intensity_index import IntensityIndex, channel_indexes
+from voxelizer import LevelFilter, channel_colors, grid_origin, snapped_window, to_voxel_grid, \
+    voxel_grid_from_image, voxelize_bands, voxelize_channel, voxelize_channels
+
+__all__ = ['ImageSurface', 'IntensityIndex', 'LevelFilter', 'channel_colors', 'channel_indexes',
+           'derive_channels', 'filter_point_cloud_by_intensity', 'grid_origin', 'read_image',
+           'replace_pixels_between_thresholds', 'snapped_window', 'surface_from_image', 'to_uint8', 'to_voxel_grid',
+           'voxel_grid_from_image', 'voxelize_bands', 'voxelize_channel', 'voxelize_channels']
+
+# Parameters
+Z_FACTOR = 3
+# Largest share of the pixels selected through an IntensityIndex: past it, the gather of
+# scattered positions costs more than one boolean scan of the whole array
+INDEX_FRACTION = 0.25
+
+
+def _use_index(index, lower, upper, between=False):
+    if index is None or not len(index):
+        return False
+    count = index.count(math.floor(lower) + 1, math.ceil(upper) - 1) if between else index.count(lower, upper)
+
+    return count <= INDEX_FRACTION * len(index)
+
+
+def replace_pixels_between_thresholds(image, lower_threshold, upper_threshold, new_value, index=None):
+    # Create a copy of the original image to avoid modifying it directly
+    modified_image = np.copy(image)
+
+    # With an IntensityIndex of the flattened image, only the replaced pixels are touched
+    if _use_index(index, lower_threshold, upper_threshold, between=True):
+        modified_image.reshape(-1)[index.between(lower_threshold, upper_threshold)] = new_value
+        return modified_image
+
+    # Find the indices of pixels that satisfy the condition (lower_threshold < pixel < upper_threshold)
+    between_threshold_indices = np.logical_and(image > lower_threshold, image < upper_threshold)
+
+    # Replace the pixels between the thresholds with the new value
+    modified_image[between_threshold_indices] = new_value
+
+    return modified_image
+
+
+def filter_point_cloud_by_intensity(point_cloud, lower_threshold, upper_threshold, index=None):
+    # With an IntensityIndex of the intensities, the points in range are one slice of it
+    # (sorted back to keep the order of the point cloud)
+    if _use_index(index, lower_threshold, upper_threshold):
+        return point_cloud[np.sort(index.within(lower_threshold, upper_threshold))]
+
+    # Extract the intensity values from the point cloud
+    intensity_values = point_cloud[:, 2]  # Assuming the intensity is in the fourth column (index 3)
+
+    # Find the indices of points with intensity within the desired range
+    valid_indices = np.where(np.logical_and(intensity_values >= lower_threshold, intensity_values <= upper_threshold))[
+        0]
+
+    # Create the filtered point cloud
+    filtered_point_cloud = point_cloud[valid_indices]
+
+    return filtered_point_cloud
+
+
+class ImageSurface:
+    """
+    Compact heightfield view of an image: one coordinate grid shared by all the channels.
+
+    Pixel (row, col) is the point (-col, row, intensity). Coordinates are stored once as a
+    small integer (N, 2) array, heights are the uint8 channels of the image (without copy),
+    and points/colors are only expanded to float64 when converting to Open3D.
+    """
+
+    def __init__(self, data):
+        self.height, self.width = data.shape[:2]
+        self.heights = data.reshape(self.height * self.width, -1)
+
+        coord_type = np.int16 if max(self.height, self.width) <= np.iinfo(np.int16).max else np.int32
+        self.xy = np.empty((self.height * self.width, 2), dtype=coord_type)
+        xy = self.xy.reshape(self.height, self.width, 2)
+        xy[:, :, 0] = -np.arange(self.width, dtype=coord_type)
+        xy[:, :, 1] = np.arange(self.height, dtype=coord_type)[:, None]
+        self._indexes = {}
+
+    @property
+    def n_channels(self):
+        return self.heights.shape[1]
+
+    def points(self, channel):
+        points = np.empty((self.xy.shape[0], 3))
+        points[:, :2] = self.xy
+        points[:, 2] = self.heights[:, channel]
+        # points[:, 2] *= Z_FACTOR
+
+        return points
+
+    def intensity_index(self, channel):
+        # built on first use, then range queries on the channel do not scan the points
+        if channel not in self._indexes:
+            self._indexes[channel] = IntensityIndex(self.heights[:, channel])
+
+        return self._indexes[channel]
+
+    def colors(self, channel):
+        return channel_colors(self.heights[:, channel], channel)
+
+    def to_point_cloud(self, channel):
+        import open3d as o3d
+
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(self.points(channel))
+        pcd.colors = o3d.utility.Vector3dVector(self.colors(channel))
+
+        return pcd
+
+
+def surface_from_image(data):
+    # all channels share the same x/y coordinates, only the heights differ
+    with span('surface_from_image'):
+        return ImageSurface(data)
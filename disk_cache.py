@@ -0,0 +1,173 @@
+""" Persistent, content-addressed cache of processed images on disk.
+
+Entries are directories of .npy files, named after a hash of the image content and of the
+processing parameters, and are read back memory-mapped. The least recently used entries
+are deleted once the cache exceeds its size cap.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('PIX2VOX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pixels2voxels'))
+# Size cap of the cache on disk
+CACHE_BYTES = 4 * 1024 * 1024 * 1024
+# Bump when the processing changes, so that old entries are not reused
+CACHE_VERSION = 3
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Returns the hash of the content of a file.
+
+    :param      path | str
+
+    :return     str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Size-capped store of named arrays, keyed by content hash and parameters.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(content_hash, **params):
+        """
+        Returns the key of an entry from the content hash and the processing parameters.
+
+        :param      content_hash | str
+                    params | JSON-serializable values
+
+        :return     str
+        """
+        description = json.dumps([CACHE_VERSION, content_hash, params], sort_keys=True)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def load(self, key):
+        """
+        Returns the arrays of an entry, memory-mapped read-only, or None on a miss.
+
+        :param      key | str
+
+        :return     dict of np.memmap
+        """
+        path = self._path(key)
+        try:
+            names = [name for name in os.listdir(path) if name.endswith('.npy')]
+            arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r') for name in names}
+        except (OSError, ValueError):
+            return None
+
+        # the modification time of an entry is its last use, for eviction
+        os.utime(path)
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        Writes the arrays of an entry, then evicts old entries if the cache is too large.
+
+        :param      key | str
+                    arrays | dict of np.ndarray
+        """
+        os.makedirs(self.root, exist_ok=True)
+        # written aside then renamed, so that readers never see a partial entry
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+
+        try:
+            os.rename(tmp_path, self._path(key))
+        except OSError:
+            # written meanwhile by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        """
+        Returns (mtime, size, path) of the entries, least recently used first.
+
+        :return     list of (float, int, str)
+        """
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def cached_pyramid(img_path, disk_cache, space='Native', factor=1, values=None):
+    """
+    Returns the LOD pyramid of an image, read from the cache when it was already processed.
+
+    :param      img_path | str
+                disk_cache | DiskCache
+                space | str, colour space of the channels (see channels.COLOR_SPACES)
+                factor | int, power of two by which the image is downscaled when decoded
+                (JPEG images are then decoded at a reduced scale); the pyramid keeps the
+                world frame of the full image, see lod.ImagePyramid
+                values | (float, float), fixed range of the intensities, see imaging.read_image
+
+    :return     (ImagePyramid, str, int) | pyramid, key of its cache entry (a hash of the
+                image content and of the processing, used to key later stages), and the
+                number of native channels of the image
+    """
+    from channels import derive_channels
+    from imaging import read_image
+    from lod import ImagePyramid, MIN_WIDTH
+    from tiles import image_size
+
+    width = None if factor == 1 else -(-image_size(img_path)[0] // factor)
+    base_level = factor.bit_length() - 1
+    cache_key = disk_cache.key(file_hash(img_path), stage='pyramid', width=width, min_width=MIN_WIDTH, space=space,
+                               values=values)
+
+    arrays = disk_cache.load(cache_key)
+    if arrays is not None:
+        levels = [arrays[f'level{k}'] for k in range(len(arrays) - 1)]
+        return ImagePyramid.from_levels(levels, base_level), cache_key, int(arrays['n_channels'][0])
+
+    image_array = read_image(img_path, width, values)
+    pyramid = ImagePyramid(derive_channels(image_array, space), base_level=base_level)
+    arrays = {f'level{k}': level for k, level in enumerate(pyramid.levels)}
+    arrays['n_channels'] = np.array([image_array.shape[2]])
+    disk_cache.save(cache_key, arrays)
+
+    return pyramid, cache_key, image_array.shape[2]
@@ -0,0 +1,189 @@
+""" Concurrent voxelization of the (channel x voxel size) jobs of an image.
+
+Each job voxelizes one channel at one voxel size, or builds its LevelFilter. Jobs run on
+a thread pool by default: the heavy steps (block sorts, reductions, radix sorts) run in
+NumPy without the GIL, and the threads read the image in place. With processes=True they run on a
+process pool instead, the image being placed once in shared memory that the workers
+map, so that no job copies it.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import instrument
+from voxelizer import LevelFilter, voxelize_channel
+
+# Shared images mapped by a worker process, by name
+_attached = {}
+
+
+class SharedImage:
+    """
+    An image array in shared memory.
+
+    Pickling it (e.g. as the argument of a job sent to a worker process) only sends the
+    name of the memory block, which the worker maps once, without copying the pixels.
+    """
+
+    def __init__(self, image_array):
+        self.shape = image_array.shape
+        self.dtype = image_array.dtype
+        self.memory = shared_memory.SharedMemory(create=True, size=max(image_array.nbytes, 1))
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+        self.array[...] = image_array
+
+    def __reduce__(self):
+        return _attach, (self.memory.name, self.shape, self.dtype.str)
+
+    def close(self):
+        # only the creator frees the block, once the jobs using it are done
+        self.array = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _attach(name, shape, dtype):
+    if name not in _attached:
+        # the engine has moved on to another image (see VoxelEngine.load): the previous ones are unmapped
+        for memory, _ in _attached.values():
+            memory.close()
+        _attached.clear()
+        memory = shared_memory.SharedMemory(name=name)
+        _attached[name] = (memory, np.ndarray(shape, np.dtype(dtype), buffer=memory.buf))
+
+    return _attached[name][1]
+
+
+def _worker_init(profile):
+    if profile:
+        instrument.enable()
+        # forked workers inherit the spans recorded by the parent, which are not theirs to send back
+        instrument.take_events()
+
+
+def _events():
+    # worker processes send their spans back with the results, threads record them in place
+    if multiprocessing.parent_process() is None or not instrument.is_enabled():
+        return []
+
+    return instrument.take_events()
+
+
+def _filter_job(image_array, channel, voxel_size, z_size):
+    return LevelFilter(image_array[:, :, channel], voxel_size, z_size).arrays, _events()
+
+
+def _voxels_job(image_array, channel, voxel_size, lower, upper, z_size):
+    return voxelize_channel(image_array[:, :, channel], voxel_size, lower, upper, z_size), _events()
+
+
+class VoxelEngine:
+    """
+    Runs the voxelization jobs of one image concurrently.
+
+    Jobs are submitted one by one (futures) or all together ('level_filters' and
+    'voxelize'). The engine is closed with 'close' or by using it as a context manager.
+    Several images can go through the same workers one after another, see 'load'.
+    """
+
+    def __init__(self, image_array, workers=None, processes=False):
+        self.processes = processes
+        self.workers = workers or os.cpu_count()
+        self.image = None
+        if processes:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_worker_init,
+                                             initargs=(instrument.is_enabled(),))
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='voxel-engine')
+        if image_array is not None:
+            self.load(image_array)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _submit(self, job, convert, *args):
+        # the future of the converted result of a job; cancelling it cancels the job if not started
+        pending = self._pool.submit(job, self.image, *args)
+        future = Future()
+
+        def done(pending):
+            if future.cancelled():
+                return
+            try:
+                result, events = pending.result()
+                instrument.add_events(events)
+                future.set_result(convert(result))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        pending.add_done_callback(done)
+        future.add_done_callback(lambda future: future.cancelled() and pending.cancel())
+
+        return future
+
+    def submit_filter(self, channel, voxel_size, z_size=None):
+        """
+        Schedules the level filter of one channel and voxel size (see voxelizer.LevelFilter).
+
+        :return     concurrent.futures.Future of LevelFilter
+        """
+        return self._submit(_filter_job, lambda arrays: LevelFilter.from_arrays(arrays, voxel_size, z_size),
+                            channel, voxel_size, z_size)
+
+    def submit_voxels(self, channel, voxel_size, lower=0, upper=255, z_size=None):
+        """
+        Schedules the voxelization of one channel (see voxelizer.voxelize_channel).
+
+        :return     concurrent.futures.Future of (indices, values)
+        """
+        return self._submit(_voxels_job, tuple, channel, voxel_size, lower, upper, z_size)
+
+    def level_filters(self, jobs):
+        """
+        Builds the level filters of several channels and voxel sizes concurrently.
+
+        :param      jobs | iterable of (channel, voxel_size[, z_size])
+
+        :return     dict | {(channel, voxel_size): LevelFilter}, in the order of the jobs
+        """
+        with instrument.span('engine', workers=self.workers, processes=self.processes):
+            futures = {tuple(job[:2]): self.submit_filter(*job) for job in jobs}
+
+            return {key: future.result() for key, future in futures.items()}
+
+    def voxelize(self, jobs):
+        """
+        Voxelizes several channels and voxel sizes concurrently.
+
+        :param      jobs | iterable of (channel, voxel_size[, lower, upper, z_size])
+
+        :return     dict | {(channel, voxel_size): (indices, values)}, in the order of the jobs
+        """
+        with instrument.span('engine', workers=self.workers, processes=self.processes):
+            futures = {tuple(job[:2]): self.submit_voxels(*job) for job in jobs}
+
+            return {key: future.result() for key, future in futures.items()}
+
+    def load(self, image_array):
+        """
+        Replaces the image of the jobs submitted from now on, keeping the workers; the jobs
+        of the previous image must be done.
+
+        :param      image_array | np.ndarray (H, W, C)
+        """
+        previous, self.image = self.image, SharedImage(image_array) if self.processes else image_array
+        if self.processes and previous is not None:
+            previous.close()
+
+    def close(self, wait=True):
+        # without waiting, the running jobs finish in the background and their results are dropped
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+        if self.processes and self.image is not None:
+            self.image.close()
@@ -0,0 +1,366 @@
+""" Export of voxel grids, written chunk by chunk: run-length encoded columns, MagicaVoxel and PLY.
+
+Writers take the voxels as they come out of the voxelizer (see voxelizer.voxelize_bands
+and tiles.TiledImage.voxel_tiles) and write each chunk before the next one is built, so
+an export never holds more than one chunk of voxels. Sizes that are only known at the
+end (PLY vertex count, MagicaVoxel chunk sizes) are patched in place when closing.
+
+The column format (.p2v) stores voxel columns as runs of consecutive intensity levels,
+which heightfields are made of, and is read back with ColumnReader through a memory map.
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from instrument import span
+from voxelizer import channel_colors
+
+COLUMN_MAGIC = b'P2VCOLS\x00'
+COLUMN_VERSION = 1
+# magic, version, channel, voxel size, origin, tint, padded to 64 bytes
+_COLUMN_HEADER = struct.Struct('<8sIif3d3f8x')
+# first and last + 1 block row and column, number of runs and of voxels
+_CHUNK_HEADER = struct.Struct('<4iqq')
+# number of chunks, magic
+_COLUMN_FOOTER = struct.Struct('<q8s')
+
+# Intensity levels are stored as bytes, MagicaVoxel models are at most 256 voxels wide
+MAX_LEVELS = 256
+VOX_MODEL_SIZE = 256
+
+
+def _align(f, alignment):
+    f.write(b'\x00' * (-f.tell() % alignment))
+
+
+def _check_levels(indices):
+    if len(indices) and (indices[:, 2].min() < 0 or indices[:, 2].max() >= MAX_LEVELS):
+        raise ValueError(f'voxel levels must be in [0, {MAX_LEVELS - 1}]')
+
+
+class VoxelWriter:
+    """
+    Base class of the writers: one file, written one chunk of voxels at a time.
+
+    :param      path | str
+                voxel_size | float, size of the voxels in the world frame
+                origin | np.ndarray (3,), see voxelizer.grid_origin
+                channel | int
+                tint | np.ndarray (3,), color of the channel (see voxelizer.channel_colors)
+    """
+
+    def __init__(self, path, voxel_size, origin, channel=0, tint=None):
+        self.path = path
+        self.voxel_size = float(voxel_size)
+        self.origin = np.asarray(origin, dtype=float)
+        self.channel = channel
+        self.tint = tint
+        self.n_voxels = 0
+        self.file = open(path, 'wb')
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # a partial file is not left behind
+            self.file.close()
+            os.remove(self.path)
+
+    def write(self, indices, values):
+        """
+        Appends a chunk of voxels.
+
+        :param      indices | np.ndarray (M, 3) of grid indices
+                    values | np.ndarray (M,), mean intensity of the voxels
+        """
+        if not len(indices):
+            return
+
+        with span('export_chunk', voxels=len(indices)):
+            self._write(np.asarray(indices), np.asarray(values, dtype=np.float32))
+        self.n_voxels += len(indices)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._finish()
+        self.file.close()
+
+    def colors(self, values):
+        # display colors of the viewer, as bytes
+        return np.rint(channel_colors(values, self.channel, self.tint) * 255).astype(np.uint8)
+
+    def _start(self):
+        pass
+
+    def _write(self, indices, values):
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+
+class ColumnWriter(VoxelWriter):
+    """
+    Writes the .p2v column format.
+
+    Each chunk covers a rectangle of voxel columns and holds the number of runs of each
+    column (uint8, in row-major order), the first level and length - 1 of each run
+    (uint8), and the values of the voxels (float32) in column then level order. A table
+    of the chunk offsets ends the file.
+    """
+
+    def _start(self):
+        tint = np.ones(3) if self.tint is None else self.tint
+        self.file.write(_COLUMN_HEADER.pack(COLUMN_MAGIC, COLUMN_VERSION, self.channel, self.voxel_size,
+                                            *self.origin, *tint))
+        self._offsets = []
+
+    def _write(self, indices, values):
+        _check_levels(indices)
+        x, y, z = indices[:, 0], indices[:, 1], indices[:, 2]
+        order = np.lexsort((z, x, y))
+        x, y, z, values = x[order], y[order], z[order], values[order]
+
+        # a run goes on while the column is the same and the level is the next one
+        new_run = np.ones(len(z), dtype=bool)
+        new_run[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1]) | (z[1:] != z[:-1] + 1)
+        starts = np.flatnonzero(new_run)
+        lengths = np.diff(np.append(starts, len(z)))
+
+        x0, x1, y0, y1 = int(x.min()), int(x.max()) + 1, int(y.min()), int(y.max()) + 1
+        columns = (y[starts] - y0) * (x1 - x0) + (x[starts] - x0)
+        counts = np.bincount(columns, minlength=(y1 - y0) * (x1 - x0))
+
+        self._offsets.append(self.file.tell())
+        self.file.write(_CHUNK_HEADER.pack(y0, y1, x0, x1, len(starts), len(z)))
+        self.file.write(counts.astype(np.uint8).tobytes())
+        self.file.write(z[starts].astype(np.uint8).tobytes())
+        self.file.write((lengths - 1).astype(np.uint8).tobytes())
+        _align(self.file, 4)
+        self.file.write(values.tobytes())
+        _align(self.file, 8)
+
+    def _finish(self):
+        self.file.write(np.array(self._offsets, dtype='<i8').tobytes())
+        self.file.write(_COLUMN_FOOTER.pack(len(self._offsets), COLUMN_MAGIC))
+
+
+class ColumnReader:
+    """
+    Reads a .p2v file through a memory map: chunks are decoded on demand, and their
+    values are views on the file.
+    """
+
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        (magic, version, self.channel, self.voxel_size, *rest) = _COLUMN_HEADER.unpack_from(self.data, 0)
+        if magic != COLUMN_MAGIC or version != COLUMN_VERSION:
+            raise ValueError(f'{path} is not a voxel column file')
+        self.origin = np.array(rest[:3])
+        self.tint = np.array(rest[3:])
+
+        n_chunks, magic = _COLUMN_FOOTER.unpack_from(self.data, len(self.data) - _COLUMN_FOOTER.size)
+        if magic != COLUMN_MAGIC:
+            raise ValueError(f'{path} is truncated')
+        table = len(self.data) - _COLUMN_FOOTER.size - 8 * n_chunks
+        self.offsets = self.data[table:table + 8 * n_chunks].view('<i8')
+        self.n_voxels = sum(_CHUNK_HEADER.unpack_from(self.data, offset)[5] for offset in self.offsets)
+
+    def __len__(self):
+        return self.n_voxels
+
+    @property
+    def n_chunks(self):
+        return len(self.offsets)
+
+    def chunk(self, i):
+        """
+        Decodes one chunk.
+
+        :param      i | int
+
+        :return     (indices, values) | np.ndarray (M, 3) int32, np.ndarray (M,) float32
+                    (read-only view on the file)
+        """
+        offset = int(self.offsets[i])
+        y0, y1, x0, x1, n_runs, n_voxels = _CHUNK_HEADER.unpack_from(self.data, offset)
+        position = offset + _CHUNK_HEADER.size
+        n_columns = (y1 - y0) * (x1 - x0)
+
+        counts = self.data[position:position + n_columns]
+        position += n_columns
+        starts = self.data[position:position + n_runs]
+        lengths = self.data[position + n_runs:position + 2 * n_runs].astype(np.int64) + 1
+        position += 2 * n_runs
+        position += -position % 4
+        values = self.data[position:position + 4 * n_voxels].view('<f4')
+
+        columns = np.repeat(np.arange(n_columns), counts)
+        run_of_voxel = np.repeat(np.arange(n_runs), lengths)
+        first_voxel = np.cumsum(lengths) - lengths
+
+        indices = np.empty((n_voxels, 3), dtype=np.int32)
+        indices[:, 0] = x0 + (columns % (x1 - x0))[run_of_voxel]
+        indices[:, 1] = y0 + (columns // (x1 - x0))[run_of_voxel]
+        indices[:, 2] = starts[run_of_voxel] + (np.arange(n_voxels) - first_voxel[run_of_voxel])
+
+        return indices, values
+
+    def chunks(self):
+        for i in range(self.n_chunks):
+            yield self.chunk(i)
+
+    def read(self):
+        # all the voxels at once
+        parts = list(self.chunks())
+        if not parts:
+            return np.empty((0, 3), dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+
+def _vox_string(text):
+    data = text.encode()
+    return struct.pack('<i', len(data)) + data
+
+
+def _vox_dict(items):
+    return struct.pack('<i', len(items)) + b''.join(_vox_string(k) + _vox_string(v) for k, v in items.items())
+
+
+def _vox_chunk(chunk_id, content):
+    return chunk_id + struct.pack('<ii', len(content), 0) + content
+
+
+class VoxWriter(VoxelWriter):
+    """
+    Writes MagicaVoxel .vox files (version 150).
+
+    Voxels are split into models of at most 256 x 256 x 256 voxels, written as soon as
+    their chunk comes, and placed by a scene graph written at the end. Colors are those
+    of the viewer, with one palette entry per intensity step.
+    """
+
+    def _start(self):
+        self.file.write(b'VOX ' + struct.pack('<i', 150))
+        # MAIN holds every other chunk, its size is patched when closing
+        self.file.write(b'MAIN' + struct.pack('<ii', 0, 0))
+        self._translations = []
+
+    def _write(self, indices, values):
+        _check_levels(indices)
+        # palette indices 1 to 255
+        color_indices = (1 + np.rint(np.clip(values, 0, 255) * 254 / 255)).astype(np.uint8)
+        cells = indices[:, :2] // VOX_MODEL_SIZE
+        order = np.lexsort((cells[:, 0], cells[:, 1]))
+        cells, indices, color_indices = cells[order], indices[order], color_indices[order]
+        bounds = np.flatnonzero(np.any(cells[1:] != cells[:-1], axis=1)) + 1
+
+        for b0, b1 in zip(np.append(0, bounds), np.append(bounds, len(cells))):
+            base = np.append(cells[b0] * VOX_MODEL_SIZE, 0)
+            local = indices[b0:b1] - base
+            size = local.max(axis=0) + 1
+            xyzi = np.empty((b1 - b0, 4), dtype=np.uint8)
+            xyzi[:, :3] = local
+            xyzi[:, 3] = color_indices[b0:b1]
+
+            self.file.write(_vox_chunk(b'SIZE', struct.pack('<3i', *size)))
+            self.file.write(_vox_chunk(b'XYZI', struct.pack('<i', b1 - b0) + xyzi.tobytes()))
+            # models are centered on their translation
+            self._translations.append(base + size // 2)
+
+    def _finish(self):
+        # root transform -> group -> (transform -> shape) per model
+        n_models = len(self._translations)
+        nodes = [_vox_chunk(b'nTRN', struct.pack('<i', 0) + _vox_dict({}) + struct.pack('<4i', 1, -1, -1, 1)
+                            + _vox_dict({})),
+                 _vox_chunk(b'nGRP', struct.pack('<i', 1) + _vox_dict({}) + struct.pack('<i', n_models)
+                            + struct.pack(f'<{n_models}i', *range(2, 2 + 2 * n_models, 2)))]
+        for model, translation in enumerate(self._translations):
+            node = 2 + 2 * model
+            frame = _vox_dict({'_t': ' '.join(str(int(t)) for t in translation)})
+            nodes.append(_vox_chunk(b'nTRN', struct.pack('<i', node) + _vox_dict({})
+                                    + struct.pack('<4i', node + 1, -1, 0, 1) + frame))
+            nodes.append(_vox_chunk(b'nSHP', struct.pack('<i', node + 1) + _vox_dict({})
+                                    + struct.pack('<2i', 1, model) + _vox_dict({})))
+        self.file.write(b''.join(nodes))
+
+        # entry i is the color of palette index i + 1
+        palette = np.zeros((256, 4), dtype=np.uint8)
+        palette[:, 3] = 255
+        palette[:255, :3] = self.colors(np.arange(255) * 255 / 254)
+        self.file.write(_vox_chunk(b'RGBA', palette.tobytes()))
+
+        children = self.file.tell() - 20
+        self.file.seek(16)
+        self.file.write(struct.pack('<i', children))
+
+
+class PlyWriter(VoxelWriter):
+    """
+    Writes binary PLY point clouds: one vertex per voxel, at its center in the world frame,
+    with its mean intensity and display color. The voxel size is kept in a comment.
+    """
+
+    VERTEX = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('intensity', '<f4'),
+                       ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    # digits of the vertex count, written as 0 then patched
+    COUNT_DIGITS = 12
+
+    def _start(self):
+        header = ['ply', 'format binary_little_endian 1.0',
+                  f'comment pixels2voxels channel {self.channel} voxel_size {self.voxel_size}']
+        self.file.write(('\n'.join(header) + '\nelement vertex ').encode())
+        self._count_position = self.file.tell()
+        properties = ['property float x', 'property float y', 'property float z', 'property float intensity',
+                      'property uchar red', 'property uchar green', 'property uchar blue', 'end_header']
+        self.file.write(('0' * self.COUNT_DIGITS + '\n' + '\n'.join(properties) + '\n').encode())
+
+    def _write(self, indices, values):
+        centers = self.origin + (indices + 0.5) * self.voxel_size
+        vertices = np.empty(len(indices), dtype=self.VERTEX)
+        vertices['x'], vertices['y'], vertices['z'] = centers.T
+        vertices['intensity'] = values
+        colors = self.colors(values)
+        vertices['red'], vertices['green'], vertices['blue'] = colors.T
+        self.file.write(vertices.tobytes())
+
+    def _finish(self):
+        self.file.seek(self._count_position)
+        self.file.write(f'{self.n_voxels:0{self.COUNT_DIGITS}d}'.encode())
+
+
+# Writer of each file extension
+WRITERS = {'.p2v': ColumnWriter, '.vox': VoxWriter, '.ply': PlyWriter}
+
+
+def export_voxels(path, chunks, voxel_size, origin, channel=0, tint=None):
+    """
+    Writes voxels to a file, in the format given by its extension (see WRITERS).
+
+    :param      path | str
+                chunks | iterable of (indices, values), e.g. voxelizer.voxelize_bands
+                voxel_size | float, size of the voxels in the world frame
+                origin | np.ndarray (3,)
+                channel | int
+                tint | np.ndarray (3,)
+
+    :return     int | number of voxels written
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f'unknown export format {extension!r}, expected one of {", ".join(WRITERS)}')
+
+    with span('export', format=extension):
+        with WRITERS[extension](path, voxel_size, origin, channel, tint) as writer:
+            for indices, values in chunks:
+                writer.write(indices, values)
+
+        return writer.n_voxels
@@ -0,0 +1,346 @@
+""" Lazy, memory-capped store of the voxel grids shown by the viewer."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from engine import VoxelEngine
+from meshing import heightfield_mesh
+from pooling import BlockPool
+from voxelizer import LevelFilter, channel_colors, grid_origin, nests, to_voxel_grid
+
+# Approximate cost of one voxel inside an Open3D VoxelGrid (hash map node, index and color)
+VOXEL_BYTES = 80
+# Bytes per vertex (position, color, normal) and per triangle of a mesh
+VERTEX_BYTES = 72
+TRIANGLE_BYTES = 12
+# Level filters shown this long are written to the disk cache (not the sizes passed over by the slider)
+PERSIST_S = 2.0
+
+
+def build_geometry(indices, colors, voxel_size, origin, mesh=False):
+    """
+    Builds the geometry shown for a set of voxels: a VoxelGrid, or a merged heightfield mesh.
+
+    :return     (geometry, nbytes) | Open3D geometry and its estimated footprint
+    """
+    if mesh:
+        geometry = heightfield_mesh(indices, colors, voxel_size, origin)
+        return geometry, len(geometry.vertices) * VERTEX_BYTES + len(geometry.triangles) * TRIANGLE_BYTES
+
+    return to_voxel_grid(indices, colors, voxel_size, origin), len(indices) * VOXEL_BYTES
+
+
+class GridStore:
+    """
+    Builds voxel grids on demand and keeps the recently used ones in an LRU.
+
+    Grids are keyed by (channel, voxel size, min intensity, max intensity, pyramid level,
+    mesh), the window being snapped to voxel layers; 'mesh' selects a merged heightfield
+    mesh instead of a VoxelGrid. They are cut from the unfiltered voxels of a
+    LevelFilter, computed once per (channel, voxel size, level), so moving the intensity window
+    never re-voxelizes the image. Least recently used grids are dropped once the
+    estimated footprint exceeds max_bytes; the grid that was just requested is always kept.
+
+    The level filter of a size that is an odd multiple of a size already built, or any multiple
+    of size 1 at full resolution (see voxelizer.nests), is pooled from the voxels of the coarsest
+    such filter rather than voxelized from the pixels, e.g. 6, 10 and 18 from 2, or 15 from 5.
+    Even multiples of larger sizes (4 from 2) are voxelized from the pixels.
+
+    With a DiskCache and the content hash of the image, level filters shown for
+    persist_s seconds are also stored on disk, and memory-mapped back when the same
+    image is opened again; the sizes a slider only passes over are not stored.
+
+    With pooling ('mean' or 'max'), grids hold one voxel per column at the pooled height
+    of its block instead, cut from a BlockPool of the (channel, level): any voxel size is
+    then built in time proportional to its number of columns.
+
+    'prefetch' builds the level filters of several channels and sizes at once on a
+    VoxelEngine per pyramid level (threads sharing the image), so that they cost about
+    as much as one of them.
+
+    'footprint' adds the level filters and block pools to the grids; 'shrink' drops them
+    least recently used first (see memory.MemoryBudget).
+    """
+
+    def __init__(self, pyramid, max_bytes, disk_cache=None, content_hash=None, tints=None, persist_s=PERSIST_S):
+        self.pyramid = pyramid
+        # display color of each channel (see channels.channel_tints)
+        self.tints = tints
+        self.disk_cache = disk_cache
+        self.content_hash = content_hash
+        self.persist_s = persist_s
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._grids = OrderedDict()
+        self._filters = OrderedDict()
+        self._pools = OrderedDict()
+        # level filters being built by the engines, and the engine of each pyramid level
+        self._pending = {}
+        self._engines = {}
+        self._lock = threading.Lock()
+        # filters on disk, and the filter last shown with the time it was first shown
+        self._saved = set()
+        self._shown = None
+
+    def __len__(self):
+        return len(self._grids)
+
+    def __contains__(self, key):
+        return key in self._grids
+
+    @property
+    def footprint(self):
+        # grids, level filters (built or prefetched) and block pools
+        return (self.nbytes + sum(level_filter.nbytes for level_filter in list(self._filters.values()))
+                + sum(level_filter.nbytes for level_filter in self._prefetched())
+                + sum(pool.nbytes for pool in self._pool_list()))
+
+    def _pool_list(self):
+        # block pools are also used by the export thread (see block_pool)
+        with self._lock:
+            return list(self._pools.values())
+
+    def _prefetched(self):
+        # level filters built by prefetch and not requested yet
+        with self._lock:
+            futures = list(self._pending.values())
+
+        return [future.result() for future in futures
+                if future.done() and not future.cancelled() and future.exception() is None]
+
+    def get(self, channel, voxel_size, lower=0, upper=255, level=0, mesh=False, pooling=None):
+        return self.entry(channel, voxel_size, lower, upper, level, mesh, pooling)[1]
+
+    def grid_key(self, channel, voxel_size, lower=0, upper=255, level=0, mesh=False, pooling=None, build=True):
+        """
+        Returns the key of the grid of a request, requests giving the same grid sharing it.
+
+        :param      build | bool, if False, returns None instead of computing the voxels
+                    needed to snap the window
+
+        :return     tuple or None
+        """
+        if pooling is not None:
+            return channel, voxel_size, lower, upper, level, mesh, pooling
+        if not build and (channel, voxel_size, level) not in self._filters:
+            return None
+
+        level_filter = self.level_filter(channel, voxel_size, level)
+        return (channel, voxel_size) + level_filter.window_key(lower, upper) + (level, mesh, None)
+
+    def entry(self, channel, voxel_size, lower=0, upper=255, level=0, mesh=False, pooling=None):
+        """
+        Returns a grid with its key and estimated footprint, building it if needed.
+
+        :return     (tuple, geometry, int)
+        """
+        key = self.grid_key(channel, voxel_size, lower, upper, level, mesh, pooling)
+        if pooling is None:
+            self._dwell((channel, voxel_size, level))
+        if key in self._grids:
+            self._grids.move_to_end(key)
+            return (key,) + self._grids[key]
+
+        if pooling is None:
+            indices, values = self.level_filter(channel, voxel_size, level).window(lower, upper)
+        else:
+            indices, values = self.block_pool(channel, level).voxels(
+                voxel_size, lower, upper, pooling, self.pyramid.world_voxel_size(level, voxel_size))
+        grid, nbytes = self._build(indices, values, channel, voxel_size, level, mesh)
+        self._grids[key] = (grid, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+
+        return key, grid, nbytes
+
+    def level_filter(self, channel, voxel_size, level=0):
+        key = (channel, voxel_size, level)
+        if key not in self._filters:
+            with self._lock:
+                pending = self._pending.pop(key, None)
+            if pending is not None:
+                self._filters[key] = pending.result()
+            else:
+                self._filters[key] = self._load_filter(channel, voxel_size, level)
+        self._filters.move_to_end(key)
+
+        return self._filters[key]
+
+    def prefetch(self, channels, voxel_sizes, level=0):
+        """
+        Starts building the level filters of several channels and voxel sizes concurrently.
+
+        Filters already built, being built, on disk or pooled from a finer filter are
+        skipped; level_filter then waits for the others instead of voxelizing again. The
+        filters prefetched for other sizes and levels and not requested since are dropped.
+
+        :param      channels | iterable of int
+                    voxel_sizes | iterable of int
+                    level | int
+        """
+        voxel_sizes = list(voxel_sizes)
+        channels = list(channels)
+        wanted = {(channel, voxel_size, level) for channel in channels for voxel_size in voxel_sizes}
+        with self._lock:
+            for key in [key for key in self._pending if key not in wanted]:
+                self._pending.pop(key).cancel()
+
+        for channel in channels:
+            for voxel_size in voxel_sizes:
+                key = (channel, voxel_size, level)
+                with self._lock:
+                    if key in self._filters or key in self._pending:
+                        continue
+                arrays = self._cached_arrays(channel, voxel_size, level)
+                if arrays is not None:
+                    self._filters[key] = LevelFilter.from_arrays(arrays, voxel_size, self._z_size(voxel_size, level))
+                    self._saved.add(key)
+                    continue
+                if self._parent_filter(channel, voxel_size, level) is not None:
+                    continue
+
+                with self._lock:
+                    if level not in self._engines:
+                        self._engines[level] = VoxelEngine(self.pyramid.levels[level])
+                    self._pending[key] = self._engines[level].submit_filter(
+                        channel, voxel_size, self._z_size(voxel_size, level))
+
+    def _z_size(self, voxel_size, level):
+        # intensity layers are as high as the voxels are wide in the world frame
+        return self.pyramid.world_voxel_size(level, voxel_size)
+
+    def _cache_key(self, channel, voxel_size, level):
+        if self.disk_cache is None or self.content_hash is None:
+            return None
+
+        return self.disk_cache.key(self.content_hash, stage='filter', channel=channel, voxel_size=voxel_size,
+                                   level=level, base_level=self.pyramid.base_level,
+                                   z_size=self._z_size(voxel_size, level))
+
+    def _cached_arrays(self, channel, voxel_size, level):
+        cache_key = self._cache_key(channel, voxel_size, level)
+        return None if cache_key is None else self.disk_cache.load(cache_key)
+
+    def _load_filter(self, channel, voxel_size, level):
+        z_size = self._z_size(voxel_size, level)
+        arrays = self._cached_arrays(channel, voxel_size, level)
+        if arrays is not None:
+            self._saved.add((channel, voxel_size, level))
+            return LevelFilter.from_arrays(arrays, voxel_size, z_size)
+
+        parent = self._parent_filter(channel, voxel_size, level)
+        if parent is not None:
+            return parent.pooled(voxel_size)
+
+        return LevelFilter(self.pyramid.levels[level][:, :, channel], voxel_size, z_size)
+
+    def _parent_filter(self, channel, voxel_size, level):
+        # the coarsest built filter whose blocks and layers nest those of voxel_size: the cheapest to pool
+        sizes = [size for (c, size, l), level_filter in list(self._filters.items())
+                 if c == channel and l == level and size < voxel_size and nests(size, voxel_size)
+                 and nests(self._z_size(size, level), self._z_size(voxel_size, level))
+                 and level_filter.counts is not None]
+
+        return self._filters.get((channel, max(sizes), level)) if sizes else None
+
+    def persist(self, channel, voxel_size, level=0):
+        """
+        Writes a built level filter to the disk cache, unless it is already there.
+
+        :param      channel | int
+                    voxel_size | int
+                    level | int
+        """
+        key = (channel, voxel_size, level)
+        cache_key = self._cache_key(channel, voxel_size, level)
+        level_filter = self._filters.get(key)
+        if cache_key is None or level_filter is None or key in self._saved:
+            return
+
+        self.disk_cache.save(cache_key, level_filter.arrays)
+        self._saved.add(key)
+
+    def _dwell(self, key):
+        # a filter is persisted once it has been shown for persist_s seconds
+        now = time.monotonic()
+        with self._lock:
+            if self._shown is None or self._shown[0] != key:
+                shown, self._shown = self._shown, (key, now)
+            else:
+                shown = self._shown
+        if shown is not None and now - shown[1] >= self.persist_s:
+            self.persist(*shown[0])
+
+    def block_pool(self, channel, level=0):
+        key = (channel, level)
+        with self._lock:
+            block_pool = self._pools.get(key)
+        if block_pool is None:
+            # built outside of the lock, the other threads only wait for the dict
+            block_pool = BlockPool(self.pyramid.levels[level][:, :, channel])
+        with self._lock:
+            block_pool = self._pools.setdefault(key, block_pool)
+            self._pools.move_to_end(key)
+
+        return block_pool
+
+    def shrink(self, max_bytes):
+        """
+        Drops the prefetched level filters, then the least recently used grids, level
+        filters and block pools, until the footprint fits max_bytes. The latest of each is
+        kept, the shown grid coming from them.
+
+        :param      max_bytes | int
+        """
+        if self.footprint > max_bytes:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.cancel()
+
+        for cache in (self._grids, self._filters, self._pools):
+            while len(cache) > 1 and self.footprint > max_bytes:
+                with self._lock:
+                    _, item = cache.popitem(last=False)
+                if cache is self._grids:
+                    self.nbytes -= item[1]
+
+    def clear(self):
+        self.close()
+        self.persist_shown()
+        self._grids.clear()
+        self._filters.clear()
+        with self._lock:
+            self._pools.clear()
+        self.nbytes = 0
+
+    def close(self, wait=True):
+        # stops the engines, filters being built are dropped (without waiting for the running ones
+        # if not wait); see persist_shown for the filter shown last
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+            self._pending.clear()
+        for engine in engines:
+            engine.close(wait)
+
+    def persist_shown(self):
+        # writes the filter shown last to the disk cache if it was shown long enough (a full filter:
+        # better called away from the GUI thread)
+        with self._lock:
+            shown, self._shown = self._shown, None
+        if shown is not None and time.monotonic() - shown[1] >= self.persist_s:
+            self.persist(*shown[0])
+
+    def _build(self, indices, values, channel, voxel_size, level, mesh):
+        width = self.pyramid.levels[level].shape[1]
+        origin = grid_origin(width, voxel_size, self.pyramid.pixel_size(level))
+        tint = None if self.tints is None else self.tints[channel]
+        colors = channel_colors(values, channel, tint)
+        return build_geometry(indices, colors, self.pyramid.world_voxel_size(level, voxel_size), origin, mesh)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._grids) > 1:
+            _, (_, nbytes) = self._grids.popitem(last=False)
+            self.nbytes -= nbytes
@@ -0,0 +1,156 @@
+""" Reading of the input images as arrays ready for voxelization."""
+
+import numpy as np
+
+from channels import as_channels, to_uint8
+from instrument import span
+
+# Width to which images are resized for performance
+FIXED_WIDTH = 1000
+
+
+def image_to_array(image):
+    """
+    Returns the bands of a PIL image as an (H, W, C) array, keeping their depth.
+
+    Palette and bilevel images are expanded to RGB(A) and grayscale, 16-bit images stay
+    16-bit, and other colour models are converted to RGB.
+
+    :param      image | PIL.Image.Image
+
+    :return     np.ndarray (H, W, C)
+    """
+    if image.mode == '1':
+        image = image.convert('L')
+    elif image.mode in ('P', 'PA'):
+        image = image.convert('RGBA' if image.mode == 'PA' or 'transparency' in image.info else 'RGB')
+    elif image.mode in ('CMYK', 'YCbCr', 'LAB', 'HSV'):
+        image = image.convert('RGB')
+
+    return as_channels(np.asarray(image))
+
+
+def fitted_size(size, width):
+    # (width, height) keeping the aspect ratio of size
+    return width, int(width * size[1] / size[0])
+
+
+def resize_image(image, size):
+    """
+    Resizes a PIL image by the cheapest route.
+
+    JPEG images not loaded yet are decoded at a reduced DCT scale (draft mode), to the
+    smallest scale still larger than the target. Images still at least twice as large
+    are then reduced by an integer factor (box average of whole blocks), and only the
+    remaining small step goes through the resampling filter.
+
+    :param      image | PIL.Image.Image
+                size | (int, int), see fitted_size
+
+    :return     PIL.Image.Image
+    """
+    if image.size == size:
+        return image
+
+    if getattr(image, 'tile', None):
+        # no-op for other formats, or once decoded
+        image.draft(image.mode, size)
+
+    # palette indices and bilevel pixels cannot be averaged
+    if image.mode not in ('1', 'P', 'PA'):
+        factor = min(image.size[0] // size[0], image.size[1] // max(size[1], 1))
+        if factor >= 2:
+            with span('reduce', factor=factor):
+                image = image.reduce(factor)
+
+    if image.size == size:
+        return image
+
+    with span('resize', width=size[0]):
+        return image.resize(size)
+
+
+def box_reduce(image_array, factor, stats=('mean',)):
+    """
+    Reduces an image by an integer factor, with statistics of each factor x factor block.
+
+    When the size is not a multiple of the factor, the edge blocks are smaller: their
+    statistics only cover their own pixels.
+
+    :param      image_array | np.ndarray (H, W[, C])
+                factor | int
+                stats | iterable of 'mean', 'min' and 'max'
+
+    :return     dict of np.ndarray (ceil(H / factor), ceil(W / factor)[, C]), same dtype
+                (means are rounded for integer images)
+    """
+    height, width = image_array.shape[:2]
+    pad_rows, pad_cols = -height % factor, -width % factor
+    pad = ((0, pad_rows), (0, pad_cols)) + ((0, 0),) * (image_array.ndim - 2)
+    shape = ((height + pad_rows) // factor, factor, (width + pad_cols) // factor, factor) + image_array.shape[2:]
+
+    def blocks(mode):
+        # replicated edges change no min or max, zeros no sum
+        padded = np.pad(image_array, pad, mode=mode) if pad_rows or pad_cols else image_array
+        return padded.reshape(shape)
+
+    reduced = {}
+    for stat in stats:
+        if stat == 'mean':
+            mean = blocks('constant').sum(axis=(1, 3), dtype=np.float32)
+            if pad_rows or pad_cols:
+                # number of real pixels of each block
+                rows = np.minimum(height - np.arange(shape[0]) * factor, factor)
+                cols = np.minimum(width - np.arange(shape[2]) * factor, factor)
+                counts = np.outer(rows, cols).astype(np.float32)
+                mean /= counts.reshape(counts.shape + (1,) * (image_array.ndim - 2))
+            else:
+                mean /= factor * factor
+            if np.issubdtype(image_array.dtype, np.integer):
+                mean = np.rint(mean)
+            reduced[stat] = mean.astype(image_array.dtype)
+        elif stat == 'min':
+            reduced[stat] = blocks('edge').min(axis=(1, 3))
+        elif stat == 'max':
+            reduced[stat] = blocks('edge').max(axis=(1, 3))
+        else:
+            raise ValueError(f'unknown block statistic {stat!r}')
+
+    return reduced
+
+
+def read_image(img_path, fixed_width=FIXED_WIDTH, values=None):
+    """
+    Opens an image and resizes it to a fixed width, keeping its aspect ratio.
+
+    Images of any depth and number of channels (grayscale, alpha, 16-bit, multi-band
+    TIFF...) are returned as 8-bit channels, see channels.to_uint8.
+
+    :param      img_path | str
+                fixed_width | int, or None to keep the original size
+                values | (float, float), fixed range mapped to 0-255 for images deeper
+                than 8 bits, see channels.to_uint8
+
+    :return     np.ndarray (H, W, C) uint8
+    """
+    from PIL import Image
+
+    # Open the image using PIL
+    with span('decode'):
+        image = Image.open(img_path)
+        size = image.size if fixed_width is None else fitted_size(image.size, fixed_width)
+        if size != image.size:
+            # JPEG images are decoded straight at a reduced scale
+            image.draft(image.mode, size)
+        image.load()
+        # 16-bit modes are not resized by every filter, 32-bit integers are
+        if image.mode.startswith('I;16'):
+            image = image.convert('I')
+            if values is None:
+                values = (0, 65535)
+
+    # resize to the fixed width, keeping the original aspect ratio
+    image = resize_image(image, size)
+
+    # Convert the image to a NumPy array
+    return to_uint8(image_to_array(image), values)
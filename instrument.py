@@ -0,0 +1,169 @@
+""" Named timing and memory spans around the stages of the pipeline.
+
+Disabled by default (spans then cost a function call). Enable with the PIX2VOX_PROFILE
+environment variable or the --profile flag of main.py and batch.py; PIX2VOX_TRACE (or
+--trace) names a JSON file where all the spans are dumped at exit.
+
+Memory is measured with tracemalloc, which sees the NumPy buffers but not the memory
+allocated inside Open3D. Peaks are process-wide, so concurrent spans share them.
+"""
+
+import atexit
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import tracemalloc
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+_local = threading.local()
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def enable(trace_path=None):
+    """
+    Starts recording spans, and dumps them to trace_path at exit if given.
+
+    :param      trace_path | str
+    """
+    global _enabled
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+    # worker processes send their spans to the parent, which writes the trace
+    if trace_path and multiprocessing.parent_process() is None:
+        atexit.register(dump, trace_path)
+
+
+def is_enabled():
+    return _enabled
+
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.peak = 0
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        current, peak = tracemalloc.get_traced_memory()
+        # the enclosing span keeps the peak reached so far, before it is reset for this one
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        tracemalloc.reset_peak()
+
+        stack.append(self)
+        self.start_memory = current
+        self.peak = current
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+
+        event = {
+            'name': self.name,
+            'thread': threading.current_thread().name,
+            'start': self.start,
+            'duration_s': duration,
+            'alloc_bytes': current - self.start_memory,
+            'peak_bytes': self.peak - self.start_memory,
+        }
+        event.update(self.attrs)
+        with _lock:
+            _events.append(event)
+
+        return False
+
+
+def span(name, **attrs):
+    """
+    Context manager timing a stage and its memory, e.g. 'with span("voxelize", size=2):'.
+
+    :param      name | str
+                attrs | extra values stored with the span
+    """
+    if not _enabled:
+        return _NULL_SPAN
+
+    return _Span(name, attrs)
+
+
+def error(name, exc, **attrs):
+    """
+    Records a failed stage, e.g. a background job that raised, even when spans are disabled.
+
+    :param      name | str
+                exc | Exception
+                attrs | extra values stored with the event
+    """
+    event = {
+        'name': name,
+        'thread': threading.current_thread().name,
+        'start': time.perf_counter(),
+        'duration_s': 0.0,
+        'alloc_bytes': 0,
+        'peak_bytes': 0,
+        'error': f'{type(exc).__name__}: {exc}',
+    }
+    event.update(attrs)
+    with _lock:
+        _events.append(event)
+
+
+def events():
+    with _lock:
+        return list(_events)
+
+
+def take_events():
+    # returns and forgets the recorded spans (used to gather them from worker processes)
+    with _lock:
+        taken = list(_events)
+        _events.clear()
+
+    return taken
+
+
+def add_events(new_events):
+    with _lock:
+        _events.extend(new_events)
+
+
+def summary(since=0.0):
+    """
+    Returns a text summary of the spans, aggregated by name.
+
+    :param      since | float, only summarize the spans started after this time.perf_counter() value
+
+    :return     str
+    """
+    stats = {}
+    for event in (e for e in events() if e['start'] >= since):
+        count, total, peak = stats.get(event['name'], (0, 0.0, 0))
+        stats[event['name']] = (count + 1, total + event['duration_s'], max(peak, event['peak_bytes']))
+
+    return '\n'.join(f'{name}: {count} x, {total * 1e3:.1f} ms, peak {peak / 2 ** 20:.1f} MB'
+                     for name, (count, total, peak) in stats.items())
+
+
+def dump(path):
+    with open(path, 'w') as f:
+        json.dump(events(), f, indent=1)
+
+
+if os.environ.get('PIX2VOX_PROFILE'):
+    enable(os.environ.get('PIX2VOX_TRACE'))
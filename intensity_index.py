@@ -0,0 +1,102 @@
+""" Bucket index of 8-bit intensities, for range queries without scanning the image."""
+
+import math
+
+import numpy as np
+
+from instrument import span
+
+N_INTENSITIES = 256
+
+
+def bucket_sort(keys, n_buckets):
+    """
+    Stably sorts small integer keys, counting sort style.
+
+    :param      keys | np.ndarray (N,) of integers in [0, n_buckets)
+                n_buckets | int
+
+    :return     (order, offsets) | np.ndarray (N,) positions of the keys in sorted order,
+                np.ndarray (n_buckets + 1,) position of the first key of each bucket in order
+    """
+    counts = np.bincount(keys, minlength=n_buckets)
+    offsets = np.zeros(n_buckets + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # stable sorts of 8 and 16-bit keys are radix sorts in NumPy, in linear time
+    key_type = np.uint8 if n_buckets <= 1 << 8 else np.uint16 if n_buckets <= 1 << 16 else np.int64
+    order = np.argsort(keys.astype(key_type, copy=False), kind='stable')
+
+    return order, offsets
+
+
+class IntensityIndex:
+    """
+    Positions of the values of one channel, sorted by intensity, with one offset per intensity.
+
+    The values between two intensities are then one contiguous slice of the sorted
+    positions, found in constant time: a range query costs the size of its result,
+    not the size of the image. Values must be integers in [0, 255] (uint8 channels, or
+    the intensities of heightfield points); other depths are quantized first with
+    channels.to_uint8, otherwise a ValueError is raised.
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values).reshape(-1)
+        with span('intensity_index', values=len(values)):
+            if values.dtype != np.uint8:
+                if not np.issubdtype(values.dtype, np.integer):
+                    raise ValueError(f'{values.dtype} intensities: quantize them with channels.to_uint8')
+                if len(values) and (values.min() < 0 or values.max() >= N_INTENSITIES):
+                    raise ValueError(f'intensities out of [0, {N_INTENSITIES - 1}]: '
+                                     'quantize them with channels.to_uint8')
+                values = values.astype(np.uint8)
+            self.order, self.offsets = bucket_sort(values, N_INTENSITIES)
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def nbytes(self):
+        return self.order.nbytes + self.offsets.nbytes
+
+    def count(self, lower, upper):
+        # number of values in [lower, upper]
+        selection = self.range(lower, upper)
+        return selection.stop - selection.start
+
+    def range(self, lower, upper):
+        """
+        Returns the slice of the sorted positions whose values are in [lower, upper].
+
+        :param      lower | float
+                    upper | float
+
+        :return     slice
+        """
+        first = min(max(math.ceil(lower), 0), N_INTENSITIES)
+        last = min(max(math.floor(upper) + 1, first), N_INTENSITIES)
+
+        return slice(int(self.offsets[first]), int(self.offsets[last]))
+
+    def between(self, lower, upper):
+        # positions of the values strictly between lower and upper, in intensity order
+        return self.order[self.range(math.floor(lower) + 1, math.ceil(upper) - 1)]
+
+    def within(self, lower, upper):
+        # positions of the values in [lower, upper], in intensity order
+        return self.order[self.range(lower, upper)]
+
+
+def channel_indexes(image_array):
+    """
+    Builds the intensity index of each channel of an image.
+
+    :param      image_array | np.ndarray (H, W[, C]) uint8
+
+    :return     list of IntensityIndex, positions are flat (row * W + col) pixel indices
+    """
+    if image_array.ndim == 2:
+        image_array = image_array[:, :, None]
+
+    return [IntensityIndex(image_array[:, :, c]) for c in range(image_array.shape[2])]
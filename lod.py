@@ -0,0 +1,103 @@
+""" Multi-resolution image pyramid used to pick the level of detail of the voxel grids."""
+
+import math
+
+from imaging import box_reduce
+from instrument import span
+
+# Max. number of voxel columns sent to the renderer
+VOXEL_BUDGET = 2_000_000
+# Coarsest level of the pyramid
+MIN_WIDTH = 64
+# Details smaller than this (in screen pixels) are not worth a finer level
+MIN_SCREEN_PIXELS = 1.0
+
+
+def downsample(image_array):
+    """
+    Halves an image by averaging 2x2 blocks (for odd sizes, the last row or column of blocks is averaged
+    over its own pixels).
+
+    :param      image_array | np.ndarray (H, W, C)
+
+    :return     np.ndarray (ceil(H / 2), ceil(W / 2), C), same dtype
+    """
+    return box_reduce(image_array, 2)['mean']
+
+
+class ImagePyramid:
+    """
+    Full-resolution image and its successive 2x downsamplings.
+
+    Level 0 is the original image; level k is built by averaging level k - 1, so one of
+    its pixels covers 2^k x 2^k original pixels. Grids of every level share the world
+    frame of level 0: a voxel of voxel_size pixels at level k is voxel_size * 2^k wide,
+    and its intensity layers are as high, so that voxels stay cubes.
+
+    For images loaded tile by tile (see tiles.py), or decoded at a coarser width to fit the
+    memory budget (see disk_cache.cached_pyramid), level 0 is already downsampled
+    2^base_level times, and the world frame is still the full image.
+    """
+
+    def __init__(self, image_array, min_width=MIN_WIDTH, base_level=0):
+        self.base_level = base_level
+        self.levels = [image_array]
+        with span('pyramid'):
+            while self.levels[-1].shape[1] > min_width:
+                self.levels.append(downsample(self.levels[-1]))
+
+    @classmethod
+    def from_levels(cls, levels, base_level=0):
+        """
+        Rebuilds a pyramid from its levels, e.g. read from disk.
+
+        :param      levels | list of np.ndarray, finest first
+
+        :return     ImagePyramid
+        """
+        pyramid = cls.__new__(cls)
+        pyramid.base_level = base_level
+        pyramid.levels = list(levels)
+
+        return pyramid
+
+    def __len__(self):
+        return len(self.levels)
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def pixel_size(self, level):
+        return 2 ** (self.base_level + level)
+
+    def world_voxel_size(self, level, voxel_size):
+        return voxel_size * self.pixel_size(level)
+
+    def estimate_voxels(self, level, voxel_size):
+        # one voxel per column at least
+        height, width = self.levels[level].shape[:2]
+        return math.ceil(height / voxel_size) * math.ceil(width / voxel_size)
+
+    def pick_level(self, voxel_size, budget=VOXEL_BUDGET, pixels_per_unit=None):
+        """
+        Returns the finest level that fits the voxel budget and is visible from the camera.
+
+        :param      voxel_size | int, in pixels of the picked level
+                    budget | int, max. number of voxel columns
+                    pixels_per_unit | float, screen pixels per world unit at the scene
+                    center (None if the camera is not set yet)
+
+        :return     int
+        """
+        level = 0
+        while level < len(self.levels) - 1 and self.estimate_voxels(level, voxel_size) > budget:
+            level += 1
+
+        # a far camera does not need pixels smaller than a screen pixel
+        if pixels_per_unit:
+            while (level < len(self.levels) - 1
+                   and self.pixel_size(level + 1) * pixels_per_unit <= MIN_SCREEN_PIXELS):
+                level += 1
+
+        return level
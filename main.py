@@ -1,22 +1,40 @@
-import open3d as o3d
+import argparse
+import os
+import threading
+import time
+
 import open3d.visualization.gui as gui
 import open3d.visualization.rendering as rendering
-from matplotlib import cm
-from matplotlib import pyplot as plt
-import matplotlib.colors as mcol
 import numpy as np
 
-from PIL import Image
-
 # Parameters
-Z_FACTOR = 3
+GRID_CACHE_BYTES = 1024 * 1024 * 1024  # memory cap of the voxel grid LRU
+GPU_CACHE_BYTES = 3 * 1024 * 1024 * 1024  # renderer memory cap of the geometries kept in the scene
+DEFAULT_VOXEL_SIZE = 2
+MAX_VOXEL_SIZE = 64
+PYRAMID_SHARE = 0.5  # share of the memory budget an image may take before it is decoded at a coarser width
+VOXEL_MEMORY_BYTES = 96  # memory of one shown voxel: its grid node, and its entry in the level filter
+EXPORT_FORMATS = [('.p2v', 'Voxel columns (.p2v)'), ('.vox', 'MagicaVoxel (.vox)'), ('.ply', 'PLY point cloud (.ply)')]
 
 # custom libraries
 import resources as res
+import instrument
+from channels import channel_names, channel_tints, color_spaces
+from core import channel_colors, grid_origin, snapped_window, voxelize_bands
+from disk_cache import DiskCache, cached_pyramid
+from export import export_voxels
+from grid_store import GridStore, build_geometry
+from lod import ImagePyramid, VOXEL_BUDGET
+from memory import MemoryBudget, format_bytes, parse_bytes, reduction_factor
+from picking import HeightfieldPicker
+from scene_cache import ResidentScene
+from sequence import SequencePlayer, VoxelField, open_sequence
+from tiles import TiledImage, TileStore, TILE_ZOOM, decoded_bytes, is_large, open_image_source, overview_factor
+from worker import LatestJobWorker, DEBOUNCE_S
 
 
 class Custom3dView:
-    def __init__(self):
+    def __init__(self, memory_budget=None, value_range=None):
         app = gui.Application.instance
         self.window = app.create_window("Open3D - Pixels to voxels", 1800, 900)
         self.window.set_on_layout(self._on_layout)
@@ -46,12 +64,21 @@ class Custom3dView:
         self.mat.shader = "defaultLit"
         self.mat.point_size = 3 * self.window.scaling
 
+        # geometries stay in the scene once uploaded, switching back to one only shows it
+        self.resident = ResidentScene(self.widget3d.scene, self.mat, GPU_CACHE_BYTES)
+
         self.mat_maxi = rendering.MaterialRecord()
         self.mat_maxi.shader = "defaultUnlit"
         self.mat_maxi.point_size = 15 * self.window.scaling
 
-        self.current_vox_index = 0
         self.current_chan_index = 0
+        self.color_space = 'Native'
+        self.img_path = None
+        self.tints = None
+        self.voxel_size = DEFAULT_VOXEL_SIZE
+        self.use_mesh = False
+        # None for all the intensity levels of each block, or the pooling of its heights
+        self.pooling = None
 
         # layout
         self.create_layout()
@@ -59,6 +86,29 @@ class Custom3dView:
         # default autorescale on
         self.auto_rescale = True
 
+        # heavy jobs run in the background, results come back on the main thread
+        self.worker = LatestJobWorker(
+            lambda callback: gui.Application.instance.post_to_main_thread(self.window, callback),
+            on_error=lambda exc: self._show_message(f'Failed: {exc}'))
+        self.camera_pending = False
+        self.grids = None
+        self.pyramid = None
+        self.tiles = None
+        self.current_level = 0
+        self.current_tiles = []
+        self.load_time = 0.0
+        self.picker = None
+        self.picker_key = None
+        self.player = None
+        self.sequence_params = None
+        # processed images are kept on disk, keyed by their content
+        self.disk_cache = DiskCache()
+        # footprint of the image, grids and tiles, kept within a budget (see memory.py)
+        self.memory = MemoryBudget(memory_budget)
+        # fixed range of the values of images deeper than 8 bits (see channels.to_uint8)
+        self.value_range = value_range
+        self._show_memory()
+
     def create_layout(self):
         # LAYOUT GUI ELEMENTS
         em = self.window.theme.font_size
@@ -72,6 +122,11 @@ class Custom3dView:
                                               gui.Margins(em, 0, 0, 0))
         self.load_but = gui.Button('Choose image')
         self.load_but.set_on_clicked(self._on_button_load)
+        self.sequence_but = gui.Button('Choose sequence')
+        self.sequence_but.set_on_clicked(self._on_button_sequence)
+        self.export_but = gui.Button('Export voxels')
+        self.export_but.set_on_clicked(self._on_button_export)
+        self.export_but.enabled = False
 
         img_path = res.find('img/miniature.png')
         self.img_thumb = gui.ImageWidget(img_path)
@@ -97,37 +152,68 @@ class Custom3dView:
         combo_light.add_child(gui.Label("Rendering"))
         combo_light.add_child(self._shader)
 
-        # add combo for colour channel
+        # add combo for voxels/merged mesh
+        self._geometry = gui.Combobox()
+        self.geometry_name = ['Voxels', 'Merged mesh']
+        self._geometry.add_item(self.geometry_name[0])
+        self._geometry.add_item(self.geometry_name[1])
+        self._geometry.set_on_selection_changed(self._on_geometry)
+        combo_geometry = gui.Horiz(0, gui.Margins(0.25 * em, 0.25 * em, 0.25 * em, 0.25 * em))
+        combo_geometry.add_child(gui.Label("Geometry"))
+        combo_geometry.add_child(self._geometry)
+
+        # add combo for colour space, filled when an image is loaded
+        self._space = gui.Combobox()
+        self.space_name = color_spaces(3)
+        for name in self.space_name:
+            self._space.add_item(name)
+        self._space.set_on_selection_changed(self._on_space)
+        self._space.enabled = False
+
+        combo_space = gui.Horiz(0, gui.Margins(0.25 * em, 0.25 * em, 0.25 * em, 0.25 * em))
+        combo_space.add_child(gui.Label("Colour space"))
+        combo_space.add_child(self._space)
+
+        # add combo for colour channel, filled with the channels of the loaded image
         self._channel = gui.Combobox()
-        self.channel_name = ["Red", "Green", "Blue"]
-        self._channel.add_item(self.channel_name[0])
-        self._channel.add_item(self.channel_name[1])
-        self._channel.add_item(self.channel_name[2])
+        self.channel_name = channel_names(3)
+        for name in self.channel_name:
+            self._channel.add_item(name)
         self._channel.set_on_selection_changed(self._on_channel)
 
         # disable combo
         self._channel.enabled = False
 
         combo_channel = gui.Horiz(0, gui.Margins(0.25 * em, 0.25 * em, 0.25 * em, 0.25 * em))
-        combo_channel.add_child(gui.Label("RGB Channel"))
+        combo_channel.add_child(gui.Label("Channel"))
         combo_channel.add_child(self._channel)
 
-        # add combo for voxel size
-        self._voxel = gui.Combobox()
-        self.voxel_name = ["2", "6", "15"]
-        self._voxel.add_item(self.voxel_name[0])
-        self._voxel.add_item(self.voxel_name[1])
-        self._voxel.add_item(self.voxel_name[2])
-        self._voxel.set_on_selection_changed(self._on_voxel)
+        # add slider for voxel size, any size in pixels
+        self._voxel = gui.Slider(gui.Slider.INT)
+        self._voxel.set_limits(1, MAX_VOXEL_SIZE)
+        self._voxel.int_value = DEFAULT_VOXEL_SIZE
+        self._voxel.tooltip = ("Voxel size in pixels. Odd multiples of a size already shown, and any size after 1,\n"
+                               "are pooled from its voxels; other sizes (e.g. 4 after 2) are voxelized again.")
+        self._voxel.set_on_value_changed(self._on_voxel)
 
-        # disable combo
+        # disable slider
         self._voxel.enabled = False
 
-
         combo_voxel = gui.Horiz(0, gui.Margins(0.25 * em, 0.25 * em, 0.25 * em, 0.25 * em))
         combo_voxel.add_child(gui.Label("Size of voxels"))
         combo_voxel.add_child(self._voxel)
 
+        # add combo for the voxels of each column: all levels, or one at the pooled height
+        self._pooling = gui.Combobox()
+        self.pooling_name = ['All levels', 'Mean height', 'Max height']
+        self.pooling_modes = [None, 'mean', 'max']
+        for name in self.pooling_name:
+            self._pooling.add_item(name)
+        self._pooling.set_on_selection_changed(self._on_pooling)
+        combo_pooling = gui.Horiz(0, gui.Margins(0.25 * em, 0.25 * em, 0.25 * em, 0.25 * em))
+        combo_pooling.add_child(gui.Label("Columns"))
+        combo_pooling.add_child(self._pooling)
+
         # add editor for max temp
         self.edit_max = gui.NumberEdit(gui.NumberEdit.INT)
         self.edit_min = gui.NumberEdit(gui.NumberEdit.INT)
@@ -149,11 +235,19 @@ class Custom3dView:
         color_back.add_child(self.color_sel)
         self.color_sel.set_on_value_changed(self.change_back_col)
 
+        # memory used against the budget, updated when a geometry is shown
+        self.memory_label = gui.Label("")
+
         # layout
         self.button_lay.add_child(self.load_but)
+        self.button_lay.add_child(self.sequence_but)
+        self.button_lay.add_child(self.export_but)
+        view_ctrls.add_child(combo_space)
         view_ctrls.add_child(combo_channel)
         view_ctrls.add_child(combo_light)
+        view_ctrls.add_child(combo_geometry)
         view_ctrls.add_child(combo_voxel)
+        view_ctrls.add_child(combo_pooling)
         view_ctrls.add_child(numlayout_min)
         view_ctrls.add_child(numlayout_max)
         view_ctrls.add_child(filter_but)
@@ -163,6 +257,7 @@ class Custom3dView:
 
         self.layout.add_child(self.button_lay)
         self.layout.add_child(view_ctrls)
+        self.layout.add_child(self.memory_label)
         self.window.add_child(self.layout)
 
         self.widget3d.set_on_mouse(self._on_mouse_widget3d)
@@ -187,10 +282,34 @@ class Custom3dView:
 
         self.window.show_dialog(file_input)
 
+    def _on_button_sequence(self):
+        # a video, an animated GIF/TIFF, or one image of a numbered sequence
+        file_input = gui.FileDialog(gui.FileDialog.OPEN, "Choose sequence to play",
+                                    self.window.theme)
+        file_input.set_on_cancel(self._on_load_dialog_cancel)
+        file_input.set_on_done(self._on_sequence_dialog_done)
+        self.window.show_dialog(file_input)
+
+    def _on_button_export(self):
+        file_input = gui.FileDialog(gui.FileDialog.SAVE, "Export voxels", self.window.theme)
+        for extension, description in EXPORT_FORMATS:
+            file_input.add_filter(extension, description)
+        file_input.set_on_cancel(self._on_load_dialog_cancel)
+        file_input.set_on_done(self._on_export_dialog_done)
+        self.window.show_dialog(file_input)
+
+    def _on_export_dialog_done(self, path):
+        self.window.close_dialog()
+        self.export(path)
+
     def _on_load_dialog_done(self, img_path):
         self.window.close_dialog()
         self.load(img_path)
 
+    def _on_sequence_dialog_done(self, path):
+        self.window.close_dialog()
+        self.load_sequence(path)
+
     def _on_load_dialog_cancel(self):
         self.window.close_dialog()
 
@@ -204,111 +323,367 @@ class Custom3dView:
         self.edit_min.set_limits(0, 255)
         self.edit_min.set_value(0)
 
-        self.mega_grid = []
-
-        # create all voxel plots
-        for i in range(3):
-            voxel_grids = []
-            pc_active = self.pc_channels[i]
-            for size in self.voxel_size:
-                voxel_grid = o3d.geometry.VoxelGrid.create_from_point_cloud(pc_active,
-                                                                            voxel_size=size)
-                voxel_grids.append(voxel_grid)
-                print('done...')
-
-            self.mega_grid.append(voxel_grids)
-
-        print('new vox ok')
-        # show one geometry
-        self.widget3d.scene.clear_geometry()
-        self.widget3d.scene.add_geometry(f"PC {self.current_vox_index}",
-                                         self.mega_grid[self.current_chan_index][self.current_vox_index], self.mat)
-        self.widget3d.force_redraw()
+        # show one geometry, built on demand
+        self.update_view()
+
+    def update_view(self, delay=0.0):
+        # the grid store only voxelizes the (channel, size, intensity window) that is asked for;
+        # the request is snapshotted here, as the controls may change while it is computed
+        if self.player is not None:
+            # playing a sequence: the next frames are voxelized with the new settings
+            self.sequence_params = (self.current_chan_index, self.voxel_size,
+                                    self.min_value, self.max_value, self.use_mesh)
+            return
+        if self.grids is None:
+            return
+
+        # the level of detail fits the voxel and memory budgets and the camera distance
+        voxel_size = self.voxel_size
+        pixels_per_unit = None if self.camera_pending else self.pixels_per_unit()
+        self.current_level = self.pyramid.pick_level(voxel_size, self.voxel_budget(), pixels_per_unit)
+        self.current_tiles = self.visible_tiles(voxel_size, pixels_per_unit)
+
+        channel, lower, upper, mesh = self.current_chan_index, self.min_value, self.max_value, self.use_mesh
+
+        if self.current_tiles:
+            # zoomed in on a large image: full resolution voxels around the camera target
+            tiles, store, tint, memory = self.current_tiles, self.tiles, self.tints[channel], self.memory
+            pooling = self.pooling
+            origin = grid_origin(store.tiled.width, voxel_size)
+            key = ('tiles', channel, voxel_size, lower, upper, tuple(tiles), mesh, pooling)
+
+            def job(cancelled):
+                if pooling is None:
+                    voxels = store.get(channel, voxel_size, lower, upper, tiles, cancelled)
+                else:
+                    # pooled columns are block reductions of the tiles, cheap enough not to be kept
+                    voxels = store.pooled(channel, voxel_size, lower, upper, tiles, pooling, cancelled)
+                if voxels is None:
+                    return None
+
+                indices, values = voxels
+                colors = channel_colors(values, channel, tint)
+                geometry, nbytes = build_geometry(indices, colors, voxel_size, origin, mesh)
+                # caches are shrunk on the worker thread, which is the only one filling them
+                memory.enforce()
+                return key, geometry, nbytes
+        else:
+            grids, level, n_channels, memory = self.grids, self.current_level, len(self.tints), self.memory
+            request = (channel, voxel_size, lower, upper, level, mesh, self.pooling)
+            # the key is only known without voxelizing once the level filter is built
+            key = grids.grid_key(*request, build=False)
+
+            def job(cancelled):
+                if request[-1] is None:
+                    # all the channels are voxelized together, switching to another one is then instant
+                    grids.prefetch(range(n_channels), [voxel_size], level)
+                entry = grids.entry(*request)
+                memory.enforce()
+                return entry
+
+        if key is not None and key in self.resident:
+            # already uploaded: shown at once, a pending build is dropped
+            self.worker.cancel()
+            self._show_grid((key, None, 0))
+            return
+
+        self.worker.submit(job, self._show_grid, delay)
+
+    def voxel_budget(self):
+        # under memory pressure, coarser levels of detail are picked
+        return min(VOXEL_BUDGET, self.memory.room() // VOXEL_MEMORY_BYTES)
+
+    def visible_tiles(self, voxel_size, pixels_per_unit):
+        # full resolution tiles replace the overview once its pixels get large on screen
+        if self.tiles is None or not pixels_per_unit:
+            return []
+        if self.pyramid.pixel_size(0) * pixels_per_unit <= TILE_ZOOM:
+            return []
+
+        # target of the camera, on the mid-intensity plane
+        model = np.asarray(self.widget3d.scene.camera.get_model_matrix())
+        position, forward = model[:3, 3], -model[:3, 2]
+        if abs(forward[2]) > 1e-6:
+            target = position + (127.5 - position[2]) / forward[2] * forward
+        else:
+            target = self.resident.bounding_box().get_center()
+
+        radius = max(self.widget3d.frame.width, self.widget3d.frame.height) / 2 / pixels_per_unit
+        return self.tiles.tiled.tiles_around(voxel_size, target[1], -target[0], radius, self.voxel_budget())
+
+    def pixels_per_unit(self):
+        # screen pixels per world unit, at the center of the scene
+        camera = self.widget3d.scene.camera
+        position = np.asarray(camera.get_model_matrix())[:3, 3]
+        center = self.resident.bounding_box().get_center()
+        distance = np.linalg.norm(position - center)
+        if distance == 0:
+            return None
+
+        fov = np.radians(camera.get_field_of_view())
+        return self.widget3d.frame.height / (2 * np.tan(fov / 2) * distance)
+
+    def pick(self, x, y):
+        """
+        Returns the pixel under a point of the 3D widget.
+
+        :param      x, y | int, widget coordinates
+
+        :return     (row, col, intensities, world) or None | row and col in full
+                    resolution pixels (see picking.HeightfieldPicker.pick)
+        """
+        if self.pyramid is None:
+            return None
+
+        # one picker for the shown level, channel and intensity window
+        level = self.current_level
+        key = (level, self.current_chan_index, self.min_value, self.max_value)
+        if key != self.picker_key:
+            self.picker = HeightfieldPicker(self.pyramid.levels[level], self.current_chan_index,
+                                            self.min_value, self.max_value, self.pyramid.pixel_size(level))
+            self.picker_key = key
+
+        camera = self.widget3d.scene.camera
+        position = np.asarray(camera.get_model_matrix())[:3, 3]
+        through = np.asarray(camera.unproject(x, y, 0.5, self.widget3d.frame.width, self.widget3d.frame.height))
+        hit = self.picker.pick(position, through - position)
+        if hit is None:
+            return None
+
+        row, col, intensities, world = hit
+        pixel_size = self.pyramid.pixel_size(level)
+        return row * pixel_size, col * pixel_size, intensities, world
+
+    def export(self, path):
+        """
+        Writes the shown channel, voxel size and intensity window to a file, at the finest resolution loaded.
+
+        Voxels are streamed band by band (tile by tile for large images) on a thread of
+        their own, so that the view can still be used meanwhile (see export.py).
+
+        :param      path | str, the extension gives the format (.p2v by default)
+        """
+        if not os.path.splitext(path)[1]:
+            path += EXPORT_FORMATS[0][0]
+        channel, voxel_size, lower, upper = self.current_chan_index, self.voxel_size, self.min_value, self.max_value
+        pooling, grids, tiles, tint = self.pooling, self.grids, self.tiles, self.tints[channel]
+
+        # images decoded at a coarser width (see cached_pyramid) are exported in the world frame
+        pixel_size = 1 if tiles is not None else grids.pyramid.pixel_size(0)
+        world_size = voxel_size * pixel_size
+        if pooling is None:
+            # the view shows whole voxel layers (see voxelizer.LevelFilter.window): so does the export
+            lower, upper = snapped_window(lower, upper, world_size)
+
+        def chunks():
+            if tiles is not None:
+                # large images are read from disk tile by tile
+                yield from tiles.tiled.voxel_tiles(channel, voxel_size, lower, upper, pooling)
+            elif pooling is not None:
+                yield grids.block_pool(channel).voxels(voxel_size, lower, upper, pooling, world_size)
+            else:
+                yield from voxelize_bands(grids.pyramid.levels[0][:, :, channel], voxel_size, lower, upper, world_size)
+
+        width = tiles.tiled.width if tiles is not None else grids.pyramid.levels[0].shape[1]
+        origin = grid_origin(width, voxel_size, pixel_size)
+
+        def run():
+            try:
+                n_voxels = export_voxels(path, chunks(), world_size, origin, channel, tint)
+                message = f'{n_voxels} voxels exported to {path}'
+            except Exception as exc:
+                # any error must reach the viewer: the thread would otherwise die silently
+                instrument.error('export', exc, path=path)
+                message = f'Export failed: {exc}'
+            gui.Application.instance.post_to_main_thread(self.window, lambda: self._show_message(message))
+
+        threading.Thread(target=run, name='export', daemon=True).start()
+
+    def _show_message(self, message):
+        self.info.text = message
+        self.info.visible = True
+        self.window.set_needs_layout()
+
+    def _refine_lod(self):
+        # called after zooming/orbiting: only rebuild if another level is needed
+        if self.grids is None or self.camera_pending:
+            return
+
+        voxel_size = self.voxel_size
+        pixels_per_unit = self.pixels_per_unit()
+        level = self.pyramid.pick_level(voxel_size, self.voxel_budget(), pixels_per_unit)
+        tiles = self.visible_tiles(voxel_size, pixels_per_unit)
+        if level != self.current_level or tiles != self.current_tiles:
+            self.update_view(DEBOUNCE_S)
+
+    def _show_grid(self, entry):
+        # entry: (key, geometry, nbytes), geometry is None if the key is resident
+        self.resident.show(*entry)
+        self._after_show()
+
+    def _after_show(self):
+        if self.camera_pending:
+            self.camera_pending = False
+            self._on_reset_camera()
+
+        with instrument.span('force_redraw'):
+            self.widget3d.force_redraw()
+        self._show_memory()
+
+        if instrument.is_enabled():
+            self.show_profile()
+
+    def _show_memory(self):
+        self.memory_label.text = (f'Memory: {self.memory.summary()}\n'
+                                  f'Renderer: {format_bytes(self.resident.nbytes)} / {format_bytes(GPU_CACHE_BYTES)}')
+        self.window.set_needs_layout()
+
+    def show_profile(self):
+        # cost of the stages since the image was loaded
+        self.info.text = instrument.summary(self.load_time)
+        if self.player is not None:
+            self.info.text += (f'\nframes: {self.player.n_decoded} decoded, {self.player.n_dropped} dropped, '
+                               f'{self.player.n_shown} shown')
+        self.info.visible = True
+        self.window.set_needs_layout()
 
     def clear_all(self):
+        self.worker.cancel()
+        if self.player is not None:
+            self.player.stop()
+            self.player = None
         self.min_value = 0
         self.max_value = 255
-        self.mega_grid = []
-        old_name = f"PC {self.current_vox_index}"
-        self.widget3d.scene.remove_geometry(old_name)
-
-        self.current_vox_index = 0
+        if self.grids is not None:
+            # the GUI does not wait for the running jobs, nor for the disk cache
+            self.grids.close(wait=False)
+            self.worker.run(self.grids.persist_shown)
+        for name in ('image', 'grids', 'tiles'):
+            self.memory.unregister(name)
+        self.grids = None
+        self.pyramid = None
+        self.tiles = None
+        self.picker = None
+        self.picker_key = None
+        self.resident.clear()
+        self._show_memory()
+
+        self.voxel_size = DEFAULT_VOXEL_SIZE
+        self._voxel.int_value = DEFAULT_VOXEL_SIZE
         self.current_chan_index = 0
 
-    def load(self, img_path):
+    def load(self, img_path, space='Native'):
         # clear all data
         self.clear_all()
-
-        # Open the image using PIL
-        image = Image.open(img_path)
-        print('Image successfully loaded')
-
-        # resize image for performance
-        # Define the desired fixed width
-        fixed_width = 1000  # Replace with your desired width in pixels
-
-        # Calculate the corresponding height to maintain the original aspect ratio
-        original_width, original_height = image.size
-        aspect_ratio = original_height / original_width
-        print('ratio')
-        fixed_height = int(fixed_width * aspect_ratio)
-
-        # Define the new size as a tuple (width, height)
-        new_size = (fixed_width, fixed_height)
-        print(new_size)
-
-        # Resize the image
-        resized_image = image.resize(new_size)
-        print('ok resized')
-
-        # Convert the image to a NumPy array
-        image_array = np.array(resized_image)
-
-        # separate each channel as an individual array
-        print('Lauching image-to-cloud')
-        self.pc_channels = surface_from_image(image_array)
-        self.pc_active = self.pc_channels[0]  # Red channel by default
-
-        # store basic properties
-        bound = self.pc_active.get_axis_aligned_bounding_box()
-        center = bound.get_center()
-        dim = bound.get_extent()
-
-        dim_x = dim[0]
-        dim_y = dim[1]
-        dim_z = dim[2]
-
-        self.pt1 = [center[0] - dim_x / 2, center[1] - dim_y / 2, center[2] - dim_z / 2]
-        self.pt2 = [center[0] + dim_x / 2, center[1] + dim_y / 2, center[2] + dim_z / 2]
+        self.load_time = time.perf_counter()
+        self.img_path = img_path
+        self.color_space = space
+
+        # decoding and voxelization run in the background; the image is kept at full
+        # resolution, coarser levels of detail are used when it is too large to display
+        max_bytes = int(self.memory.max_bytes * PYRAMID_SHARE)
+        values = self.value_range
+
+        def job(cancelled):
+            if not is_large(img_path):
+                # images whose pyramid would not fit the memory budget are decoded at a coarser width
+                factor = reduction_factor(decoded_bytes(img_path) * 4 // 3, max_bytes)
+                return (None,) + cached_pyramid(img_path, self.disk_cache, space, factor, values)
+
+            # very large images stay on disk: an overview is streamed for the coarse
+            # levels, and full resolution voxels are built tile by tile when zooming
+            tiled = TiledImage(open_image_source(img_path), space=space, values=values)
+            factor = overview_factor(tiled.width)
+            pyramid = ImagePyramid(tiled.overview(factor), base_level=factor.bit_length() - 1)
+
+            return TileStore(tiled), pyramid, None, tiled.n_native
+
+        self.worker.submit(job, self._on_image_loaded)
+
+    def _on_image_loaded(self, result):
+        # voxels are built straight from the array, without going through point clouds
+        self.tiles, self.pyramid, content_hash, n_native = result
+        self.picker_key = None
+        self.tints = channel_tints(n_native, self.color_space)
+        self._set_channel_items(n_native)
+        self.image_array = self.pyramid.levels[0]
 
         self.min_value = 0
         self.max_value = 255
 
-        # create all voxel grids
-        self.mega_grid = []
-        self.voxel_size = [2, 6, 15]
-
-        # create all voxel plots
-        for i in range(3):
-            voxel_grids = []
-            pc_active = self.pc_channels[i]
-            for size in self.voxel_size:
-                voxel_grid = o3d.geometry.VoxelGrid.create_from_point_cloud(pc_active,
-                                                                            voxel_size=size)
-                voxel_grids.append(voxel_grid)
-                print('done...')
-
-            self.mega_grid.append(voxel_grids)
-
-        # show one geometry
-        self.widget3d.scene.add_geometry('PC 0', self.mega_grid[0][0], self.mat)
-        self.current_vox_index = 0
-
-        self.widget3d.force_redraw()
-
+        # voxel grids are built lazily, when displayed
+        self.grids = GridStore(self.pyramid, GRID_CACHE_BYTES, self.disk_cache, content_hash, self.tints)
+        pyramid, grids, tiles = self.pyramid, self.grids, self.tiles
+        self.memory.register('image', lambda: pyramid.nbytes)
+        self.memory.register('grids', lambda: grids.footprint, grids.shrink)
+        if tiles is not None:
+            self.memory.register('tiles', lambda: tiles.nbytes, tiles.shrink)
+
+        # show one geometry, and fit the camera once it is there
+        self.voxel_size = DEFAULT_VOXEL_SIZE
+        self._voxel.int_value = DEFAULT_VOXEL_SIZE
+        self.camera_pending = True
+        self.update_view()
+        self._enable_controls()
+
+    def load_sequence(self, path):
+        # frames are decoded, voxelized and shown by a pipeline of threads (see sequence.py)
+        self.clear_all()
+        self.load_time = time.perf_counter()
+        self.img_path = None
+        self.color_space = 'Native'
+        self.camera_pending = True
+        self.sequence_params = (0, self.voxel_size, 0, 255, self.use_mesh)
+
+        values = self.value_range
+        field, field_key = None, None
+
+        def process(frame):
+            # each frame only re-voxelizes the blocks that changed since the previous one
+            nonlocal field, field_key
+            channel, voxel_size, lower, upper, mesh = self.sequence_params
+            channel = min(channel, frame.shape[2] - 1)
+            if (channel, voxel_size, lower, upper) != field_key:
+                field, field_key = VoxelField(voxel_size, lower, upper), (channel, voxel_size, lower, upper)
+
+            field.update(frame[:, :, channel])
+            tint = channel_tints(frame.shape[2])[channel]
+            origin = grid_origin(frame.shape[1], voxel_size)
+            geometry, nbytes = build_geometry(field.indices, channel_colors(field.values, channel, tint),
+                                              voxel_size, origin, mesh)
+
+            return geometry, nbytes, frame.shape[2]
+
+        def start(sequence):
+            frames, fps = sequence
+            post = lambda callback: gui.Application.instance.post_to_main_thread(self.window, callback)
+            self.player = SequencePlayer(frames, fps, process, self._show_frame, post,
+                                         on_error=self._on_frame_error)
+
+        # opening reads the file (and imports imageio for videos): errors reach the info label
+        self.worker.submit(lambda cancelled: open_sequence(path, values=values), start)
+
+    def _show_frame(self, result):
+        geometry, nbytes, n_native = result
+        if self.camera_pending:
+            # first frame: the controls follow the channels of the sequence
+            self._set_channel_items(n_native)
+            self._enable_controls(space=False)
+
+        # each frame takes the place of the previous one
+        self.resident.replace(('sequence',), geometry, nbytes)
+        self._after_show()
+
+    def _on_frame_error(self, exc, stopped):
+        self._show_message(f'Playback stopped: {exc}' if stopped else f'Frame failed: {exc}')
+
+    def _enable_controls(self, space=True):
         # enable comboboxes
         self._voxel.enabled = True
         self._channel.enabled = True
+        self._space.enabled = space and len(self.space_name) > 1
+        # sequences are only played
+        self.export_but.enabled = space
         self.edit_max.enabled = True
         self.edit_min.enabled = True
 
@@ -322,44 +697,26 @@ class Custom3dView:
         self.edit_max.set_value(255)
         self.edit_min.set_on_value_changed(self._on_edit_min)
 
+    def _set_channel_items(self, n_native):
+        # the combos list what the image has: its own channels, or those of a colour space
+        self.space_name = color_spaces(n_native)
+        self._space.clear_items()
+        for name in self.space_name:
+            self._space.add_item(name)
+        self._space.selected_index = self.space_name.index(self.color_space)
 
-        self._on_reset_camera()
+        self.channel_name = channel_names(n_native, self.color_space)
+        self._channel.clear_items()
+        for name in self.channel_name:
+            self._channel.add_item(name)
+        self._channel.selected_index = 0
 
     def _on_edit_min(self, value):
         self.min_value = value
-        # crop point cloud
-        pt1 = self.pt1
-        pt1[2] = value
-        pt2 = self.pt2
-        pt2[2] = self.max_value
-        np_points = [pt1, pt2]
-
-        points = o3d.utility.Vector3dVector(np_points)
-        crop_box = o3d.geometry.AxisAlignedBoundingBox
-        crop_box = crop_box.create_from_points(points)
-
-        self.mega_grid = []
-        self.voxel_size = [2, 6, 15]
-
-        # create all voxel plots
-        for i in range(3):
-            voxel_grids = []
-            pc_active = self.pc_channels[i]
-            point_cloud_crop = pc_active.crop(crop_box)
-            for size in self.voxel_size:
-                voxel_grid = o3d.geometry.VoxelGrid.create_from_point_cloud(point_cloud_crop,
-                                                                            voxel_size=size)
-                voxel_grids.append(voxel_grid)
-                print('done...')
-
-            self.mega_grid.append(voxel_grids)
-
-        print('new vox ok')
-        # show one geometry
-        self.widget3d.scene.clear_geometry()
-        self.widget3d.scene.add_geometry(f"PC {self.current_vox_index}",
-                                         self.mega_grid[self.current_chan_index][self.current_vox_index], self.mat)
-        self.widget3d.force_redraw()
+
+        # voxelize the pixels within the intensity window, for the displayed grid only;
+        # rapid changes are merged so only the last value is computed
+        self.update_view(DEBOUNCE_S)
 
         # set max values
         self.edit_max.set_limits(0, self.max_value)
@@ -367,40 +724,9 @@ class Custom3dView:
     def _on_edit_max(self, value):
         self.max_value = value
 
-        # crop point cloud
-        pt1 = self.pt1
-        pt1[2] = self.min_value
-        pt2 = self.pt2
-        pt2[2] = value
-        np_points = [pt1, pt2]
-        points = o3d.utility.Vector3dVector(np_points)
-        print(pt1, pt2)
-
-        crop_box = o3d.geometry.AxisAlignedBoundingBox
-        crop_box = crop_box.create_from_points(points)
-
-        self.mega_grid = []
-        self.voxel_size = [2, 6, 15]
-
-        # create all voxel plots
-        for i in range(3):
-            voxel_grids = []
-            pc_active = self.pc_channels[i]
-            point_cloud_crop = pc_active.crop(crop_box)
-            for size in self.voxel_size:
-                voxel_grid = o3d.geometry.VoxelGrid.create_from_point_cloud(point_cloud_crop,
-                                                                            voxel_size=size)
-                voxel_grids.append(voxel_grid)
-                print('done...')
-
-            self.mega_grid.append(voxel_grids)
-
-        print('new vox ok')
-        # show one geometry
-        self.widget3d.scene.clear_geometry()
-        self.widget3d.scene.add_geometry(f"PC {self.current_vox_index}",
-                                         self.mega_grid[self.current_chan_index][self.current_vox_index], self.mat)
-        self.widget3d.force_redraw()
+        # voxelize the pixels within the intensity window, for the displayed grid only;
+        # rapid changes are merged so only the last value is computed
+        self.update_view(DEBOUNCE_S)
 
         # set max values
         self.edit_max.set_limits(self.min_value, 255)
@@ -424,31 +750,33 @@ class Custom3dView:
                                    r.get_bottom() - pref.height, pref.width,
                                    pref.height)
 
-    def _on_voxel(self, name, index):
-        old_name = f"PC {self.current_vox_index}"
-        print(old_name)
-        self.widget3d.scene.remove_geometry(old_name)
-        self.widget3d.scene.add_geometry(f"PC {index}", self.mega_grid[self.current_chan_index][index], self.mat)
-        self.current_vox_index = index
+    def _on_voxel(self, value):
+        # dragging the slider merges the sizes passed over into the last one
+        self.voxel_size = int(value)
+        self.update_view(DEBOUNCE_S)
 
-        self.widget3d.force_redraw()
+    def _on_pooling(self, name, index):
+        # pooled columns are cut from block statistics, for any voxel size
+        self.pooling = self.pooling_modes[index]
+        self.update_view()
 
     def _on_channel(self, name, index):
-        # change active pointcloud
+        # change active channel
         self.current_chan_index = index
-        self.pc_active = self.pc_channels[index]
+        self.update_view()
 
-        # show one geometry
-        old_name = f"PC {self.current_vox_index}"
-        self.widget3d.scene.remove_geometry(old_name)
-        self.widget3d.scene.add_geometry(f"PC {self.current_vox_index}", self.mega_grid[index][self.current_vox_index],
-                                         self.mat)
+    def _on_space(self, name, index):
+        # the channels of the other colour space are derived (or read from the cache)
+        if self.img_path is not None and name != self.color_space:
+            self.load(self.img_path, name)
 
-        self.widget3d.force_redraw()
+    def _on_geometry(self, name, index):
+        # merged meshes only hold the visible faces of the voxels
+        self.use_mesh = index == 1
+        self.update_view()
 
     def _on_shader(self, name, index):
         material = self.materials[index]
-        print(material)
         self.mat.shader = material
         self.widget3d.scene.update_material(self.mat)
         self.widget3d.force_redraw()
@@ -459,141 +787,64 @@ class Custom3dView:
 
     def _on_reset_camera(self):
         # adapt camera
-        bounds = self.widget3d.scene.bounding_box
+        bounds = self.resident.bounding_box()
         center = bounds.get_center()
         self.widget3d.setup_camera(30, bounds, center)
         camera = self.widget3d.scene.camera
-        self.widget3d.look_at(center, center + [0, 0, 3000], [0, -1, 0])
+        # the distance follows the size of the image (3000 for a 1000 px wide image)
+        distance = 3 * max(bounds.get_extent())
+        self.widget3d.look_at(center, center + [0, 0, distance], [0, -1, 0])
 
     def _on_mouse_widget3d(self, event):
         # We could override BUTTON_DOWN without a modifier, but that would
         # interfere with manipulating the scene.
-        if event.type == gui.MouseEvent.Type.BUTTON_DOWN and event.is_modifier_down(
-                gui.KeyModifier.CTRL):
-
-            def depth_callback(depth_image):
-                # Coordinates are expressed in absolute coordinates of the
-                # window, but to dereference the image correctly we need them
-                # relative to the origin of the widget. Note that even if the
-                # scene widget is the only thing in the window, if a menubar
-                # exists it also takes up space in the window (except on macOS).
-                x = event.x - self.widget3d.frame.x
-                y = event.y - self.widget3d.frame.y
-                # Note that np.asarray() reverses the axes.
-                depth = np.asarray(depth_image)[y, x]
-
-                if depth == 1.0:  # clicked on nothing (i.e. the far plane)
-                    text = ""
-                    coords = []
-                else:
-                    world = self.widget3d.scene.camera.unproject(
-                        event.x, event.y, depth, self.widget3d.frame.width,
-                        self.widget3d.frame.height)
-                    text = "({:.3f}, {:.3f}, {:.3f})".format(
-                        world[0], world[1], world[2])
-
+        if event.type in (gui.MouseEvent.Type.WHEEL, gui.MouseEvent.Type.BUTTON_UP):
+            # the camera moves once the event is handled by the widget
+            gui.Application.instance.post_to_main_thread(self.window, self._refine_lod)
+
+        if event.is_modifier_down(gui.KeyModifier.CTRL) and event.type in (gui.MouseEvent.Type.BUTTON_DOWN,
+                                                                            gui.MouseEvent.Type.MOVE):
+            # the camera ray is cast against the heightfield on the CPU, so picking needs no
+            # depth rendering and can follow the mouse. Coordinates are relative to the widget,
+            # as a menubar also takes up space in the window (except on macOS).
+            hit = self.pick(event.x - self.widget3d.frame.x, event.y - self.widget3d.frame.y)
+            if hit is None:
+                text = ""
+            else:
+                row, col, intensities, world = hit
+                text = "pixel ({}, {}), intensity {}\n({:.3f}, {:.3f}, {:.3f})".format(
+                    row, col, tuple(int(i) for i in np.atleast_1d(intensities)), world[0], world[1], world[2])
+
+                if event.type == gui.MouseEvent.Type.BUTTON_DOWN:
                     # add 3D label
                     self.widget3d.add_3d_label(world, '._yeah')
 
-                # This is not called on the main thread, so we need to
-                # post to the main thread to safely access UI items.
-                def update_label():
-                    self.info.text = text
-                    self.info.visible = (text != "")
-                    # We are sizing the info label to be exactly the right size,
-                    # so since the text likely changed width, we need to
-                    # re-layout to set the new frame.
-                    self.window.set_needs_layout()
-
-                gui.Application.instance.post_to_main_thread(
-                    self.window, update_label)
-
-            self.widget3d.scene.scene.render_to_depth_image(depth_callback)
+            self.info.text = text
+            self.info.visible = (text != "")
+            # We are sizing the info label to be exactly the right size,
+            # so since the text likely changed width, we need to
+            # re-layout to set the new frame.
+            self.window.set_needs_layout()
 
             return gui.Widget.EventCallbackResult.HANDLED
         return gui.Widget.EventCallbackResult.IGNORED
 
 
-def replace_pixels_between_thresholds(image, lower_threshold, upper_threshold, new_value):
-    # Create a copy of the original image to avoid modifying it directly
-    modified_image = np.copy(image)
-
-    # Find the indices of pixels that satisfy the condition (lower_threshold < pixel < upper_threshold)
-    between_threshold_indices = np.logical_and(image > lower_threshold, image < upper_threshold)
-
-    # Replace the pixels between the thresholds with the new value
-    modified_image[between_threshold_indices] = new_value
-
-    return modified_image
-
-
-def filter_point_cloud_by_intensity(point_cloud, lower_threshold, upper_threshold):
-    # Extract the intensity values from the point cloud
-    print('ok')
-    intensity_values = point_cloud[:, 2]  # Assuming the intensity is in the fourth column (index 3)
-    print(intensity_values)
-
-    # Find the indices of points with intensity within the desired range
-    valid_indices = np.where(np.logical_and(intensity_values >= lower_threshold, intensity_values <= upper_threshold))[
-        0]
-
-    print('ok')
-    # Create the filtered point cloud
-    filtered_point_cloud = point_cloud[valid_indices]
-
-    return filtered_point_cloud
-
-
-def surface_from_image(data):
-    # Separate color channels
-    red_channel = data[:, :, 0]
-    green_channel = data[:, :, 1]
-    blue_channel = data[:, :, 2]
-
-    channels = [red_channel, green_channel, blue_channel]
-    pcds = []
-
-    for i, chan in enumerate(channels):
-        color_array = np.zeros((chan.shape[0], chan.shape[1], 3), dtype=np.float32)
-
-        # Assign the red channel's intensity values to all three channels
-        color_array[:, :, 0] = 0.2 * chan / 255
-        color_array[:, :, 1] = 0.2 * chan / 255
-        color_array[:, :, 2] = 0.2 * chan / 255
-
-        color_array[:, :, i] = 0.6 * chan / 255
-
-        # color_array = np.transpose(color_array, (1, 0, 2))
-        print(color_array.shape)
-        height, width = chan.shape
-
-        # Generate the x and y coordinates
-        x_coords, y_coords = np.meshgrid(np.arange(width), np.arange(height))
-
-        # Flatten the arrays
-        x = -x_coords.flatten()
-        y = y_coords.flatten()
-        z = chan.flatten()
-        # z = [i * Z_FACTOR for i in z]
-
-        # Create the point cloud using the flattened arrays
-        # compute how the range scales compared to x/y
-        points = np.vstack((x, y, z)).T
-
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(points)
-
-        # get colors
-        color_array = color_array.reshape(width * height, 3)
-        pcd.colors = o3d.utility.Vector3dVector(color_array)
-
-        pcds.append(pcd)
-
-    return pcds
-
-
-app_vis = gui.Application.instance
-app_vis.initialize()
-
-viz = Custom3dView()
-app_vis.run()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pixels to voxels viewer.')
+    parser.add_argument('--profile', action='store_true', help='time the pipeline stages')
+    parser.add_argument('--trace', help='JSON file where the timings are dumped at exit')
+    parser.add_argument('--memory-budget', type=parse_bytes,
+                        help='memory the images and voxels may take, e.g. 6G (half of the RAM by default)')
+    parser.add_argument('--value-range', type=float, nargs=2, metavar=('LOW', 'HIGH'),
+                        help='values mapped to intensities 0-255 in every image deeper than 8 bits '
+                             '(default: the range of each image)')
+    args = parser.parse_args()
+    if args.profile or args.trace:
+        instrument.enable(args.trace)
+
+    app_vis = gui.Application.instance
+    app_vis.initialize()
+
+    viz = Custom3dView(args.memory_budget, args.value_range and tuple(args.value_range))
+    app_vis.run()
@@ -0,0 +1,156 @@
+""" Memory footprint of the viewer's data, kept within one budget.
+
+The budget is set with the --memory-budget flag of main.py or the PIX2VOX_MEMORY_BUDGET
+environment variable (e.g. '6G', '512M'); it defaults to half of the physical memory.
+"""
+
+import os
+import threading
+
+# Budget used when the physical memory is unknown
+DEFAULT_BUDGET_BYTES = 4 * 1024 * 1024 * 1024
+# Share of the physical memory used by default
+MEMORY_FRACTION = 0.5
+
+_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_bytes(text):
+    """
+    Parses a size such as '6G', '512M', '1.5GB' or '1000000'.
+
+    :param      text | str
+
+    :return     int
+    """
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in _UNITS else ''
+    try:
+        value = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError(f'invalid size: {text!r}') from None
+
+    return int(value * _UNITS[unit])
+
+
+def format_bytes(nbytes):
+    if nbytes >= 2 ** 30:
+        return f'{nbytes / 2 ** 30:.1f} GB'
+
+    return f'{nbytes / 2 ** 20:.0f} MB'
+
+
+def physical_memory():
+    # None where sysconf is not available (Windows)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_budget():
+    text = os.environ.get('PIX2VOX_MEMORY_BUDGET')
+    if text:
+        return parse_bytes(text)
+
+    total = physical_memory()
+    return int(total * MEMORY_FRACTION) if total else DEFAULT_BUDGET_BYTES
+
+
+def reduction_factor(nbytes, max_bytes):
+    """
+    Returns the power of two by which the sides of an image are divided for its nbytes to
+    fit max_bytes.
+
+    :param      nbytes | int, footprint at full resolution
+                max_bytes | int
+
+    :return     int
+    """
+    factor = 1
+    while nbytes > max_bytes * factor ** 2:
+        factor *= 2
+
+    return factor
+
+
+class MemoryBudget:
+    """
+    Tracks the footprint of the parts of the viewer and shrinks their caches to fit a budget.
+
+    Each part is registered with a callable returning its footprint in bytes and, if it
+    holds data that can be rebuilt (grid LRUs, voxelized tiles), a callable shrinking it
+    to a given size. 'enforce' shrinks the parts in the order they were registered until
+    the total fits; what the other parts hold is fixed, and 'room' tells how much the
+    shrinkable ones may use, from which the level of detail is picked.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = default_budget() if max_bytes is None else max_bytes
+        # name -> (footprint, shrink or None), in order of registration
+        self._parts = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, footprint, shrink=None):
+        """
+        Adds a part, or replaces the part of the same name.
+
+        :param      name | str
+                    footprint | callable returning int
+                    shrink | callable taking the max. number of bytes the part may keep
+        """
+        with self._lock:
+            self._parts.pop(name, None)
+            self._parts[name] = (footprint, shrink)
+
+    def unregister(self, name):
+        with self._lock:
+            self._parts.pop(name, None)
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self._parts.items())
+
+    def usage(self):
+        """
+        :return     dict | {name: bytes}, in order of registration
+        """
+        return {name: footprint() for name, (footprint, _) in self._snapshot()}
+
+    @property
+    def total(self):
+        return sum(self.usage().values())
+
+    def room(self):
+        # bytes left to the shrinkable parts once the fixed ones are accounted for
+        fixed = sum(footprint() for _, (footprint, shrink) in self._snapshot() if shrink is None)
+        return max(self.max_bytes - fixed, 0)
+
+    def enforce(self):
+        """
+        Shrinks the parts until the total footprint fits the budget.
+
+        :return     int | bytes freed
+        """
+        over = self.total - self.max_bytes
+        freed = 0
+        for _, (footprint, shrink) in self._snapshot():
+            if over - freed <= 0:
+                break
+            if shrink is None:
+                continue
+
+            before = footprint()
+            shrink(max(before - (over - freed), 0))
+            freed += before - footprint()
+
+        return freed
+
+    def summary(self):
+        usage = self.usage()
+        parts = ', '.join(f'{name} {format_bytes(nbytes)}' for name, nbytes in usage.items() if nbytes)
+        text = f'{format_bytes(sum(usage.values()))} / {format_bytes(self.max_bytes)}'
+
+        return f'{text}\n{parts}' if parts else text
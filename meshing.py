@@ -0,0 +1,147 @@
+""" Merged triangle meshes of voxel heightfields, with hidden faces culled."""
+
+import numpy as np
+
+from instrument import span
+
+# (normal axis, direction, axis along which faces are merged)
+FACES = [(0, 1, 2), (0, -1, 2), (1, 1, 2), (1, -1, 2), (2, 1, 0), (2, -1, 0)]
+
+
+def _voxel_keys(indices, dims):
+    return (indices[:, 0].astype(np.int64) * dims[1] + indices[:, 1]) * dims[2] + indices[:, 2]
+
+
+def exposed(indices, axis, direction):
+    """
+    Returns the mask of the voxels whose face in the given direction is not covered.
+
+    :param      indices | np.ndarray (M, 3) of voxel grid indices
+                axis | int
+                direction | int, 1 or -1
+
+    :return     np.ndarray (M,) bool
+    """
+    # one empty layer around the grid, so that neighbors never wrap around
+    shifted = indices.astype(np.int64) + 1
+    dims = shifted.max(axis=0) + 2
+    keys = np.sort(_voxel_keys(shifted, dims))
+
+    neighbors = shifted.copy()
+    neighbors[:, axis] += direction
+    neighbor_keys = _voxel_keys(neighbors, dims)
+    found = np.searchsorted(keys, neighbor_keys)
+    found = np.minimum(found, len(keys) - 1)
+
+    return keys[found] != neighbor_keys
+
+
+def merge_runs(indices, axis, colors=None):
+    """
+    Groups faces into runs of consecutive voxels along an axis (greedy 1D merging).
+
+    With colors, a run also ends where the color changes, so that every face of a run
+    has the same color.
+
+    :param      indices | np.ndarray (F, 3), voxels whose face is exposed
+                axis | int, merge axis
+                colors | np.ndarray (F, 3) or None
+
+    :return     (first, last, order) | positions of the first and last face of each run
+                in the sorted faces, and the sort order of the faces
+    """
+    others = [a for a in range(3) if a != axis]
+    order = np.lexsort((indices[:, axis], indices[:, others[1]], indices[:, others[0]]))
+    ordered = indices[order]
+
+    new_run = np.ones(len(ordered), dtype=bool)
+    same_line = np.all(ordered[1:, others] == ordered[:-1, others], axis=1)
+    same_run = same_line & (ordered[1:, axis] == ordered[:-1, axis] + 1)
+    if colors is not None:
+        ordered_colors = colors[order]
+        same_run &= np.all(ordered_colors[1:] == ordered_colors[:-1], axis=1)
+    new_run[1:] = ~same_run
+
+    first = np.flatnonzero(new_run)
+    last = np.append(first[1:] - 1, len(ordered) - 1)
+
+    return first, last, order
+
+
+def mesh_arrays(indices, colors, voxel_size, origin):
+    """
+    Builds the arrays of a mesh showing only the exposed faces of the voxels.
+
+    Exposed faces of the same color are merged in runs: vertically along the columns for
+    the sides, and along x for the tops and bottoms. Each merged quad has the one color of
+    its voxels.
+
+    :param      indices | np.ndarray (M, 3)
+                colors | np.ndarray (M, 3)
+                voxel_size | float
+                origin | np.ndarray (3,)
+
+    :return     (vertices, triangles, vertex_colors, vertex_normals)
+    """
+    vertices, triangles, vertex_colors, normals = [], [], [], []
+    n_vertices = 0
+    if not len(indices):
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int32), np.empty((0, 3)), np.empty((0, 3))
+
+    for axis, direction, merge_axis in FACES:
+        mask = exposed(indices, axis, direction)
+        faces, face_colors = indices[mask], colors[mask]
+        if not len(faces):
+            continue
+
+        first, last, order = merge_runs(faces, merge_axis, face_colors)
+        start, end = faces[order[first]], faces[order[last]]
+        side_axis = 3 - axis - merge_axis
+
+        # corners of each quad, in voxel units: (merge, side) = (0, 0), (1, 0), (1, 1), (0, 1)
+        quads = np.empty((len(first), 4, 3))
+        quads[:, :, axis] = (start[:, axis] + (direction > 0))[:, None]
+        quads[:, :, merge_axis] = np.stack([start[:, merge_axis], end[:, merge_axis] + 1,
+                                            end[:, merge_axis] + 1, start[:, merge_axis]], axis=1)
+        quads[:, :, side_axis] = start[:, side_axis][:, None] + np.array([0, 0, 1, 1])
+
+        quad_colors = np.repeat(face_colors[order[first]][:, None], 4, axis=1)
+
+        # counter-clockwise as seen from outside
+        normal = np.zeros(3)
+        normal[axis] = direction
+        edge_merge, edge_side = np.eye(3)[merge_axis], np.eye(3)[side_axis]
+        if np.dot(np.cross(edge_merge, edge_side), normal) > 0:
+            quad_triangles = np.array([[0, 1, 2], [0, 2, 3]])
+        else:
+            quad_triangles = np.array([[0, 2, 1], [0, 3, 2]])
+
+        base = n_vertices + 4 * np.arange(len(first))
+        triangles.append((base[:, None, None] + quad_triangles).reshape(-1, 3))
+        vertices.append(origin + quads.reshape(-1, 3) * voxel_size)
+        vertex_colors.append(quad_colors.reshape(-1, 3))
+        normals.append(np.broadcast_to(normal, (4 * len(first), 3)))
+        n_vertices += 4 * len(first)
+
+    return (np.concatenate(vertices), np.concatenate(triangles).astype(np.int32),
+            np.concatenate(vertex_colors), np.concatenate(normals))
+
+
+def heightfield_mesh(indices, colors, voxel_size, origin):
+    """
+    Builds one merged Open3D TriangleMesh from voxel indices and colors.
+
+    :return     o3d.geometry.TriangleMesh
+    """
+    import open3d as o3d
+
+    with span('mesh', voxels=len(indices)):
+        vertices, triangles, vertex_colors, normals = mesh_arrays(indices, colors, voxel_size, origin)
+
+        mesh = o3d.geometry.TriangleMesh()
+        mesh.vertices = o3d.utility.Vector3dVector(vertices)
+        mesh.triangles = o3d.utility.Vector3iVector(triangles)
+        mesh.vertex_colors = o3d.utility.Vector3dVector(vertex_colors)
+        mesh.vertex_normals = o3d.utility.Vector3dVector(normals)
+
+        return mesh
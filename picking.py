@@ -0,0 +1,126 @@
+""" Picking on the CPU: camera rays cast against the image heightfield."""
+
+import numpy as np
+
+from imaging import box_reduce
+from instrument import span
+
+
+def max_mip(heights):
+    """
+    Builds the max-height pyramid of a heightfield, down to a single cell.
+
+    Cell (r, c) of level k holds the max. height of the 2^k x 2^k pixels it covers, so
+    that a ray passing above it cannot hit any of them.
+
+    :param      heights | np.ndarray (H, W) int16, -1 for pixels that cannot be hit
+
+    :return     list of np.ndarray, finest first
+    """
+    levels = [heights]
+    while max(levels[-1].shape) > 1:
+        # replicated edges leave the maxima unchanged
+        levels.append(box_reduce(levels[-1], 2, ('max',))['max'])
+
+    return levels
+
+
+def _slab(origin, inv_direction, low, high, t0, t1):
+    # clips [t0, t1] to the parameters of the ray between low and high along each axis
+    for axis in range(len(low)):
+        if inv_direction[axis] == np.inf:
+            if not low[axis] <= origin[axis] <= high[axis]:
+                return None
+            continue
+        ta = (low[axis] - origin[axis]) * inv_direction[axis]
+        tb = (high[axis] - origin[axis]) * inv_direction[axis]
+        if ta > tb:
+            ta, tb = tb, ta
+        t0, t1 = max(t0, ta), min(t1, tb)
+        if t0 > t1:
+            return None
+
+    return t0, t1
+
+
+class HeightfieldPicker:
+    """
+    Finds the pixel of an image hit by a ray, seen as a heightfield of columns.
+
+    Pixel (row, col) of intensity v is the column [col - 1/2, col + 1/2] x
+    [row - 1/2, row + 1/2] x [0, v] in pixel units, placed in the world frame like the
+    voxels (x = -col, y = row, z = intensity, scaled by pixel_size for pyramid levels).
+    Pixels outside the intensity window are not shown, so they are never hit.
+
+    Rays descend the max-height pyramid front to back and skip every block they pass
+    above, so a pick visits a few cells per level instead of the whole image.
+    """
+
+    def __init__(self, image_array, channel, lower=0, upper=255, pixel_size=1):
+        self.image_array = image_array
+        self.pixel_size = pixel_size
+        chan = image_array[:, :, channel]
+        with span('pick_index'):
+            heights = chan.astype(np.int16)
+            heights[(chan < lower) | (chan > upper)] = -1
+            self.mip = max_mip(heights)
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.mip)
+
+    def pick(self, origin, direction):
+        """
+        Casts a ray and returns the first pixel it hits.
+
+        :param      origin | (3,) ray origin, in the world frame
+                    direction | (3,) ray direction, in the world frame
+
+        :return     (row, col, intensities, world) or None | pixel in the picked image,
+                    its values in every channel, and the hit point in the world frame
+        """
+        p = self.pixel_size
+        # pixel frame: (col, row, intensity)
+        o = np.array([-origin[0] / p, origin[1] / p, origin[2]], dtype=float)
+        d = np.array([-direction[0] / p, direction[1] / p, direction[2]], dtype=float)
+        with np.errstate(divide='ignore'):
+            inv = np.where(d != 0, 1 / np.where(d != 0, d, 1), np.inf)
+
+        height, width = self.mip[0].shape
+        stack = [(len(self.mip) - 1, 0, 0)]
+        while stack:
+            k, r, c = stack.pop()
+            top = self.mip[k][r, c]
+            if top < 0:
+                continue
+
+            # columns and rows covered by the cell, clipped to the image
+            n = 1 << k
+            low = (c * n - 0.5, r * n - 0.5, 0.0)
+            high = (min((c + 1) * n, width) - 0.5, min((r + 1) * n, height) - 0.5, float(top))
+            hit = _slab(o, inv, low, high, 0.0, np.inf)
+            if hit is None:
+                continue
+
+            if k == 0:
+                world = np.asarray(origin, dtype=float) + hit[0] * np.asarray(direction, dtype=float)
+                return r, c, self.image_array[r, c], world
+
+            # children are pushed far to near, so that the nearest is searched first
+            children = []
+            child_level = self.mip[k - 1]
+            for cr in (2 * r, 2 * r + 1):
+                for cc in (2 * c, 2 * c + 1):
+                    if cr >= child_level.shape[0] or cc >= child_level.shape[1] or child_level[cr, cc] < 0:
+                        continue
+                    m = 1 << (k - 1)
+                    low = (cc * m - 0.5, cr * m - 0.5)
+                    high = (min((cc + 1) * m, width) - 0.5, min((cr + 1) * m, height) - 0.5)
+                    entry = _slab(o, inv, low, high, 0.0, np.inf)
+                    if entry is not None:
+                        children.append((entry[0], k - 1, cr, cc))
+
+            children.sort(reverse=True)
+            stack.extend(child[1:] for child in children)
+
+        return None
@@ -0,0 +1,125 @@
+""" Voxel columns of any size, pooled from the pixels with summed-area tables and max pyramids."""
+
+import numpy as np
+
+from instrument import span
+
+# Pooled heights of a voxel column
+POOLING_MODES = ('mean', 'max')
+
+
+class BlockPool:
+    """
+    Statistics of the blocks of one channel, for any integer voxel size.
+
+    The finest level is the pixels themselves. Block sums come from a summed-area table,
+    and block maxima from square max tables of side 2^k (built on first use, each from
+    the previous one), a block being covered by four overlapping squares. Pooling the
+    blocks of one size thus costs the number of blocks, not the number of pixels.
+
+    Blocks follow the grid of voxelizer.voxelize_channel (columns flipped, first block
+    centered on the first pixel), so pooled columns line up with the other voxels.
+    """
+
+    def __init__(self, chan):
+        self.height, self.width = chan.shape
+        with span('block_pool', pixels=chan.size):
+            flipped = chan[:, ::-1]
+            self.sums = np.zeros((self.height + 1, self.width + 1), dtype=np.int64)
+            np.cumsum(np.cumsum(flipped, axis=0, dtype=np.int64), axis=1, out=self.sums[1:, 1:])
+        self.flipped = flipped
+        # max tables, padded with 0 on every side as the blocks overhang the image
+        self._max_tables = {}
+        self._max_pad = 0
+
+    @property
+    def nbytes(self):
+        return self.sums.nbytes + sum(table.nbytes for table in self._max_tables.values())
+
+    def grid_shape(self, voxel_size):
+        off = voxel_size // 2
+        return (self.height - 1 + off) // voxel_size + 1, (self.width - 1 + off) // voxel_size + 1
+
+    def _max_table(self, k, overhang):
+        if overhang > self._max_pad:
+            # a larger overhang: the tables are rebuilt with more padding
+            self._max_tables.clear()
+            self._max_pad = 1 << overhang.bit_length()
+        if 0 not in self._max_tables:
+            self._max_tables[0] = np.pad(self.flipped, self._max_pad)
+
+        for level in range(1, k + 1):
+            if level not in self._max_tables:
+                previous, half = self._max_tables[level - 1], 1 << (level - 1)
+                self._max_tables[level] = np.maximum(
+                    np.maximum(previous[:-half, :-half], previous[half:, :-half]),
+                    np.maximum(previous[:-half, half:], previous[half:, half:]))
+
+        return self._max_tables[k]
+
+    def block_means(self, voxel_size):
+        """
+        Returns the mean intensity of each block.
+
+        :param      voxel_size | int
+
+        :return     np.ndarray (ny, nx) float32
+        """
+        s = voxel_size
+        ny, nx = self.grid_shape(s)
+        y = np.clip(np.arange(ny + 1) * s - s // 2, 0, self.height)
+        x = np.clip(np.arange(nx + 1) * s - s // 2, 0, self.width)
+
+        sums = (self.sums[y[1:, None], x[None, 1:]] - self.sums[y[:-1, None], x[None, 1:]]
+                - self.sums[y[1:, None], x[None, :-1]] + self.sums[y[:-1, None], x[None, :-1]])
+        areas = np.diff(y)[:, None] * np.diff(x)[None, :]
+
+        return (sums / areas).astype(np.float32)
+
+    def block_maxima(self, voxel_size):
+        """
+        Returns the max. intensity of each block.
+
+        :param      voxel_size | int
+
+        :return     np.ndarray (ny, nx), dtype of the channel
+        """
+        s = voxel_size
+        ny, nx = self.grid_shape(s)
+        k = s.bit_length() - 1
+        side = 1 << k
+        # blocks start half a voxel before the image and end up to one voxel after it
+        table = self._max_table(k, s)
+
+        y0 = np.arange(ny) * s - s // 2 + self._max_pad
+        x0 = np.arange(nx) * s - s // 2 + self._max_pad
+        y1, x1 = y0 + s - side, x0 + s - side
+
+        return np.maximum(np.maximum(table[y0[:, None], x0[None, :]], table[y1[:, None], x0[None, :]]),
+                          np.maximum(table[y0[:, None], x1[None, :]], table[y1[:, None], x1[None, :]]))
+
+    def voxels(self, voxel_size, lower=0, upper=255, mode='mean', z_size=None):
+        """
+        Returns one voxel per column, at the pooled height of its block.
+
+        :param      voxel_size | int
+                    lower | int, columns whose pooled height is outside the window are hidden
+                    upper | int
+                    mode | str, 'mean' or 'max' height (colors always use the mean)
+                    z_size | int, height of the intensity levels (voxel_size by default)
+
+        :return     (indices, values) | np.ndarray (M, 3) int32, np.ndarray (M,) float32
+        """
+        s = int(voxel_size)
+        z_size = s if z_size is None else int(z_size)
+        with span('pool', voxel_size=s, mode=mode):
+            means = self.block_means(s)
+            heights = means if mode == 'mean' else self.block_maxima(s)
+
+            iy, ix = np.nonzero((heights >= lower) & (heights <= upper))
+            indices = np.empty((len(iy), 3), dtype=np.int32)
+            indices[:, 0] = ix
+            indices[:, 1] = iy
+            indices[:, 2] = np.floor((heights[iy, ix] + z_size // 2) / z_size)
+
+            return indices, means[iy, ix]
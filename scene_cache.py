@@ -0,0 +1,137 @@
+""" Geometries kept resident in the renderer, shown and hidden instead of uploaded again."""
+
+from collections import OrderedDict
+
+from grid_store import VOXEL_BYTES
+from instrument import span
+
+# Approximate renderer footprint of one voxel: its cube is drawn as 24 vertices (position,
+# normal, color) and 36 indices
+GPU_VOXEL_BYTES = 1024
+# Bytes per vertex and per triangle of a mesh, in the renderer
+GPU_VERTEX_BYTES = 48
+GPU_TRIANGLE_BYTES = 12
+
+
+def render_bytes(geometry, nbytes):
+    """
+    Estimates the renderer footprint of a geometry.
+
+    :param      geometry | VoxelGrid or TriangleMesh, see grid_store.build_geometry
+                nbytes | int, its estimated footprint in memory, see grid_store.build_geometry
+
+    :return     int
+    """
+    if hasattr(geometry, 'triangles'):
+        return len(geometry.vertices) * GPU_VERTEX_BYTES + len(geometry.triangles) * GPU_TRIANGLE_BYTES
+
+    return nbytes // VOXEL_BYTES * GPU_VOXEL_BYTES
+
+
+class ResidentScene:
+    """
+    Keeps the recently shown geometries in an Open3DScene, only the current one visible.
+
+    Each geometry is uploaded once, under a name of its own, and showing it again (going
+    back to another channel or voxel size) only toggles its visibility. Least recently
+    shown geometries are removed from the scene once their estimated renderer footprint
+    exceeds max_bytes; the current geometry is always kept.
+
+    Keys are those of the stores the geometries come from (see GridStore.grid_key), so a
+    request is resident exactly when the store would return the same geometry.
+    """
+
+    def __init__(self, scene, material, max_bytes):
+        self.scene = scene
+        self.material = material
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.current = None
+        # key -> (name, renderer bytes, bounding box), least recently shown first
+        self._entries = OrderedDict()
+        self._count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def show(self, key, geometry=None, nbytes=0):
+        """
+        Makes a geometry the visible one, uploading it if it is not resident.
+
+        :param      key | hashable, identity of the geometry
+                    geometry | Open3D geometry, only needed if key is not resident
+                    nbytes | int, estimated footprint of geometry in memory (see render_bytes)
+        """
+        if key not in self._entries:
+            self._add(key, geometry, nbytes)
+        self._entries.move_to_end(key)
+
+        if key != self.current:
+            with span('show_geometry'):
+                if self.current is not None:
+                    self.scene.show_geometry(self._entries[self.current][0], False)
+                self.scene.show_geometry(self._entries[key][0], True)
+            self.current = key
+
+        self._evict()
+
+    def replace(self, key, geometry, nbytes=0):
+        """
+        Shows a geometry in place of the resident one of the same key (e.g. the next
+        frame of a sequence). The new geometry is added before the old one is removed,
+        so the scene is never empty in between.
+        """
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous[1]
+            if key == self.current:
+                self.current = None
+        self.show(key, geometry, nbytes)
+        if previous is not None:
+            self.scene.remove_geometry(previous[0])
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        self.scene.remove_geometry(entry[0])
+        self.nbytes -= entry[1]
+        if key == self.current:
+            self.current = None
+
+    def clear(self):
+        for name, _, _ in self._entries.values():
+            self.scene.remove_geometry(name)
+        self._entries.clear()
+        self.nbytes = 0
+        self.current = None
+
+    def bounding_box(self):
+        # bounds of the visible geometry; the scene bounds also hold the hidden ones
+        if self.current is None:
+            return self.scene.bounding_box
+
+        return self._entries[self.current][2]
+
+    def _add(self, key, geometry, nbytes):
+        # names are never reused, a geometry being removed while its replacement is added
+        name = f'grid-{self._count}'
+        self._count += 1
+
+        gpu_bytes = render_bytes(geometry, nbytes)
+        with span('add_geometry', bytes=gpu_bytes):
+            self.scene.add_geometry(name, geometry, self.material)
+            self.scene.show_geometry(name, False)
+        self._entries[key] = (name, gpu_bytes, geometry.get_axis_aligned_bounding_box())
+        self.nbytes += gpu_bytes
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == self.current:
+                break
+            self.discard(key)
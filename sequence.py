@@ -0,0 +1,313 @@
+""" Playback of image sequences (animated GIF/TIFF, numbered images, videos) as voxel fields.
+
+Frames flow through a bounded pipeline of three stages: a decoding thread paced at the
+target frame rate, a voxelization thread, and the renderer. Each stage only holds a few
+frames: when voxelization falls behind, the oldest decoded frames are dropped, and the
+renderer only ever gets the latest voxelized one.
+"""
+
+import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+from channels import to_uint8
+from imaging import FIXED_WIDTH, fitted_size, image_to_array, resize_image
+from instrument import error, span
+from voxelizer import voxelize_blocks
+
+# Frame rate when the source does not tell
+DEFAULT_FPS = 10.0
+# Number of decoded frames waiting for voxelization
+QUEUE_SIZE = 2
+# Consecutive failed frames after which the player stops
+MAX_FAILURES = 3
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+
+def _natural_key(path):
+    # 'frame_10' after 'frame_9'
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+
+def numbered_siblings(img_path):
+    """
+    Returns the images named like img_path up to its last number, in numeric order.
+
+    :param      img_path | str, e.g. 'scan_0001.png'
+
+    :return     list of str, ['scan_0001.png', 'scan_0002.png', ...]
+    """
+    directory, name = os.path.split(img_path)
+    match = re.search(r'(\d+)(\D*)$', name)
+    if match is None:
+        return [img_path]
+
+    pattern = re.compile(re.escape(name[:match.start(1)]) + r'\d+' + re.escape(match.group(2)))
+    names = [other for other in os.listdir(directory or '.') if pattern.fullmatch(other)]
+
+    return [os.path.join(directory, other) for other in sorted(names, key=_natural_key)]
+
+
+def _resized(image, width):
+    # numbered JPEG frames are decoded at a reduced scale (see imaging.resize_image)
+    return image if width is None else resize_image(image, fitted_size(image.size, width))
+
+
+def open_sequence(path, width=FIXED_WIDTH, values=None):
+    """
+    Opens a sequence of frames: a video, a multi-frame image, or numbered images.
+
+    Videos need the optional imageio package (with its ffmpeg plugin).
+
+    :param      path | str, video, animated image, or one image of a numbered sequence
+                width | int, width of the frames, or None to keep the original size
+                values | (float, float), fixed range of the intensities of frames deeper
+                than 8 bits (otherwise each frame is rescaled over its own range, see
+                channels.to_uint8)
+
+    :return     (frames, fps) | callable returning a fresh iterator of (H, W, C) uint8
+                frames, and the frame rate of the source
+    """
+    from PIL import Image, ImageSequence
+
+    if path.lower().endswith(VIDEO_EXTENSIONS):
+        import imageio.v3 as iio
+
+        fps = iio.immeta(path).get('fps') or DEFAULT_FPS
+
+        def frames():
+            for frame in iio.imiter(path):
+                yield to_uint8(image_to_array(_resized(Image.fromarray(frame), width)), values)
+
+        return frames, fps
+
+    with Image.open(path) as image:
+        n_frames = getattr(image, 'n_frames', 1)
+        duration = image.info.get('duration')
+
+    if n_frames > 1:
+        def frames():
+            with Image.open(path) as animation:
+                for frame in ImageSequence.Iterator(animation):
+                    yield to_uint8(image_to_array(_resized(frame, width)), values)
+
+        return frames, 1000.0 / duration if duration else DEFAULT_FPS
+
+    paths = numbered_siblings(path)
+
+    def frames():
+        for frame_path in paths:
+            with Image.open(frame_path) as frame:
+                yield to_uint8(image_to_array(_resized(frame, width)), values)
+
+    return frames, DEFAULT_FPS
+
+
+class VoxelField:
+    """
+    Voxels of one channel of successive frames, updated only where the frames differ.
+
+    A voxel column only depends on the pixels of its block, so each new frame is compared
+    to the previous one and only the blocks with a changed pixel are voxelized again;
+    the voxels of the other blocks are kept as they are.
+    """
+
+    def __init__(self, voxel_size, lower=0, upper=255):
+        self.voxel_size = int(voxel_size)
+        self.lower = lower
+        self.upper = upper
+        self.padded = None
+        self.indices = np.empty((0, 3), dtype=np.int32)
+        self.values = np.empty(0, dtype=np.float32)
+
+    def _pad(self, chan):
+        # same layout as voxelizer.voxelize_channel: columns flipped, -1 for padding
+        s = self.voxel_size
+        off = s // 2
+        height, width = chan.shape
+        ny = (height - 1 + off) // s + 1
+        nx = (width - 1 + off) // s + 1
+
+        padded = np.full((ny * s, nx * s), -1, dtype=np.int32)
+        padded[off:off + height, off:off + width] = chan[:, ::-1]
+
+        return padded
+
+    def update(self, chan):
+        """
+        Moves the field to a new frame.
+
+        :param      chan | np.ndarray (H, W) uint8, channel of the frame
+
+        :return     int | number of blocks voxelized again
+        """
+        s = self.voxel_size
+        padded = self._pad(chan)
+        ny, nx = padded.shape[0] // s, padded.shape[1] // s
+
+        with span('frame_update'):
+            if self.padded is None or self.padded.shape != padded.shape:
+                changed_y, changed_x = np.divmod(np.arange(ny * nx), nx)
+                kept = np.zeros(len(self.indices), dtype=bool)
+            else:
+                changed = (padded != self.padded).reshape(ny, s, nx, s).any(axis=(1, 3))
+                changed_y, changed_x = np.nonzero(changed)
+                kept = ~changed[self.indices[:, 1], self.indices[:, 0]]
+            self.padded = padded
+
+            if not len(changed_y):
+                return 0
+
+            # changed blocks side by side, voxelized as one row of blocks
+            blocks = padded.reshape(ny, s, nx, s).swapaxes(1, 2)[changed_y, changed_x]
+            row = np.ascontiguousarray(blocks.transpose(1, 0, 2)).reshape(s, len(changed_y) * s)
+            indices, values = voxelize_blocks(row, s, self.lower, self.upper)
+
+            position = indices[:, 0].copy()
+            indices[:, 0] = changed_x[position]
+            indices[:, 1] = changed_y[position]
+
+            self.indices = np.concatenate([self.indices[kept], indices])
+            self.values = np.concatenate([self.values[kept], values])
+
+        return len(changed_y)
+
+
+class SequencePlayer:
+    """
+    Plays frames through the decode -> process -> render pipeline at a target frame rate.
+
+    'process(frame)' runs on the processing thread (voxelization, geometry building) and
+    'show(result)' on the main thread, through 'post' (see worker.LatestJobWorker). Only
+    one result waits for the renderer at a time: newer results replace it.
+
+    A frame whose processing raises is recorded with instrument.error and skipped, and
+    its exception is handed to 'on_error(exc, stopped)' on the main thread; after
+    max_failures failed frames in a row, the player stops. It also stops when decoding
+    raises, the frames being unreadable past that point.
+    """
+
+    def __init__(self, frames, fps, process, show, post, loop=True, queue_size=QUEUE_SIZE, on_error=None,
+                 max_failures=MAX_FAILURES):
+        self.frames = frames
+        self.fps = fps
+        self.process = process
+        self.show = show
+        self.post = post
+        self.loop = loop
+        self.on_error = on_error
+        self.max_failures = max_failures
+
+        self.n_decoded = 0
+        self.n_dropped = 0
+        self.n_shown = 0
+        self.n_failed = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._latest = None
+        self._posted = False
+
+        self._threads = [threading.Thread(target=self._decode, name='sequence-decode', daemon=True),
+                         threading.Thread(target=self._run_process, name='sequence-process', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def _put(self, item):
+        # the decoder never waits for the processing: the oldest waiting frame is dropped
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.n_dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _decode(self):
+        try:
+            self._decode_frames()
+        except Exception as exc:
+            # a corrupt frame, a missing file or a failing video decoder ends the frames
+            self._failed(self.n_decoded, exc, self.max_failures)
+        self._put(None)
+
+    def _decode_frames(self):
+        start = time.monotonic()
+        n_frames = 0
+        while not self.stopped:
+            for frame in self.frames():
+                # hold the frame rate of the source
+                delay = start + n_frames / self.fps - time.monotonic()
+                if delay > 0 and self._stop.wait(delay):
+                    return
+
+                self._put((n_frames, frame))
+                n_frames += 1
+                self.n_decoded = n_frames
+                if self.stopped:
+                    return
+
+            if not self.loop:
+                break
+
+    def _run_process(self):
+        failures = 0
+        while not self.stopped:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+
+            index, frame = item
+            try:
+                result = self.process(frame)
+            except Exception as exc:
+                self._failed(index, exc, failures + 1)
+                failures += 1
+                continue
+            failures = 0
+
+            with self._lock:
+                self._latest = result
+                if self._posted:
+                    continue
+                self._posted = True
+
+            self.post(self._deliver)
+
+    def _failed(self, index, exc, failures):
+        error('frame', exc, index=index)
+        self.n_failed += 1
+        stopped = failures >= self.max_failures
+        if stopped:
+            self.stop()
+        if self.on_error is not None:
+            self.post(lambda: self.on_error(exc, stopped))
+
+    def _deliver(self):
+        # on the main thread: show the latest result, frames voxelized meanwhile are skipped
+        with self._lock:
+            result, self._latest = self._latest, None
+            self._posted = False
+
+        if not self.stopped:
+            self.n_shown += 1
+            self.show(result)
@@ -0,0 +1,64 @@
+""" Shared helpers of the tests, which only need NumPy (and Pillow for decoding)."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the modules of the app are top-level files of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def sorted_voxels(indices, values):
+    # voxels in (y, x, z) order, as the pipelines return them in different orders
+    indices = np.asarray(indices)
+    order = np.lexsort((indices[:, 2], indices[:, 0], indices[:, 1]))
+    return indices[order], np.asarray(values)[order]
+
+
+def reference_voxels(chan, voxel_size, lower=0, upper=255, z_size=None):
+    """
+    Voxelizes a channel pixel by pixel, as the definition of voxelizer.voxelize_channel:
+    pixel (row, col) goes to voxel ((W - 1 - col + s // 2) // s, (row + s // 2) // s,
+    (v + z // 2) // z), and each voxel holds the mean of its pixels.
+    """
+    s = int(voxel_size)
+    z = s if z_size is None else int(z_size)
+    height, width = chan.shape
+    sums, counts = {}, {}
+    for row in range(height):
+        for col in range(width):
+            value = int(chan[row, col])
+            if value < lower or value > upper:
+                continue
+            key = ((width - 1 - col + s // 2) // s, (row + s // 2) // s, (value + z // 2) // z)
+            sums[key] = sums.get(key, 0) + value
+            counts[key] = counts.get(key, 0) + 1
+
+    keys = sorted(sums)
+    indices = np.array(keys, dtype=np.int32).reshape(-1, 3)
+    values = np.array([sums[key] / counts[key] for key in keys], dtype=np.float32)
+
+    return sorted_voxels(indices, values)
+
+
+@pytest.fixture
+def assert_same_voxels():
+    def check(actual, expected):
+        actual, expected = sorted_voxels(*actual), sorted_voxels(*expected)
+        np.testing.assert_array_equal(actual[0], expected[0])
+        np.testing.assert_allclose(actual[1], expected[1], rtol=1e-5)
+
+    return check
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def chan(rng):
+    # odd sides, so that the last blocks are partial
+    return rng.integers(0, 256, (37, 29), dtype=np.uint8)
@@ -0,0 +1,22 @@
+""" Image search of the batch tool through subdirectories (user-005)."""
+
+import os
+
+from batch import find_images, output_paths
+
+
+def test_find_images_recursive(tmp_path):
+    for path in ['a/x.jpg', 'a/b/y.PNG', 'a/b/c/z.tif', 'a/notes.txt', 'd/w.jpeg']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_bytes(b'')
+
+    found = find_images([str(tmp_path / 'a')])
+    assert [os.path.relpath(p, tmp_path) for p in found] == [os.path.join('a', 'b', 'c', 'z.tif'),
+                                                             os.path.join('a', 'b', 'y.PNG'),
+                                                             os.path.join('a', 'x.jpg')]
+    assert find_images([str(tmp_path / '**' / '*.jp*g')]) == [str(tmp_path / 'a' / 'x.jpg'),
+                                                              str(tmp_path / 'd' / 'w.jpeg')]
+    # nested images keep their subdirectories, so they do not overwrite each other
+    outputs = output_paths(found, 'out')
+    assert len(set(outputs)) == len(found)
+    assert outputs[0] == os.path.join('out', 'b', 'c', 'z.tif.npz')
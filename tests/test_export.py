@@ -0,0 +1,48 @@
+""" Streaming export to the .p2v column format and back (user-021)."""
+
+import os
+
+import numpy as np
+import pytest
+
+from export import ColumnReader, export_voxels
+from voxelizer import grid_origin, voxelize_bands, voxelize_channel
+
+
+@pytest.mark.parametrize('voxel_size', [1, 2, 5])
+def test_column_file_round_trip(rng, tmp_path, voxel_size, assert_same_voxels):
+    chan = rng.integers(0, 256, (41, 33), dtype=np.uint8)
+    path = str(tmp_path / 'voxels.p2v')
+    origin = grid_origin(chan.shape[1], voxel_size)
+    tint = np.array([1.0, 0.5, 0.25])
+
+    n_voxels = export_voxels(path, voxelize_bands(chan, voxel_size, 20, 220, band_blocks=3), voxel_size,
+                             origin, 2, tint)
+
+    expected = voxelize_channel(chan, voxel_size, 20, 220)
+    reader = ColumnReader(path)
+    assert n_voxels == len(reader) == len(expected[0])
+    assert reader.channel == 2 and reader.voxel_size == voxel_size
+    np.testing.assert_allclose(reader.origin, origin)
+    np.testing.assert_allclose(reader.tint, tint)
+    assert_same_voxels(reader.read(), expected)
+
+
+def test_empty_export(tmp_path):
+    path = str(tmp_path / 'empty.p2v')
+    assert export_voxels(path, [], 2, np.zeros(3)) == 0
+    indices, values = ColumnReader(path).read()
+    assert len(indices) == 0 and len(values) == 0
+
+
+def test_failed_export_leaves_no_file(tmp_path):
+    path = str(tmp_path / 'bad.p2v')
+    chunks = [(np.array([[0, 0, 300]], dtype=np.int32), np.array([1.0], dtype=np.float32))]
+    with pytest.raises(ValueError):
+        export_voxels(path, chunks, 1, np.zeros(3))
+    assert not os.path.exists(path)
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        export_voxels(str(tmp_path / 'voxels.xyz'), [], 1, np.zeros(3))
@@ -0,0 +1,52 @@
+""" Block reduction shared by the decode path and the overview (user-022)."""
+
+import numpy as np
+import pytest
+
+from imaging import box_reduce
+
+
+def reference_reduce(image_array, factor):
+    # statistics of each block over its own pixels, edge blocks being smaller
+    height, width = image_array.shape[:2]
+    rows, cols = -(-height // factor), -(-width // factor)
+    reduced = {stat: np.empty((rows, cols) + image_array.shape[2:]) for stat in ('mean', 'min', 'max')}
+    for i in range(rows):
+        for j in range(cols):
+            block = image_array[i * factor:(i + 1) * factor, j * factor:(j + 1) * factor].astype(np.float64)
+            reduced['mean'][i, j] = block.mean(axis=(0, 1))
+            reduced['min'][i, j] = block.min(axis=(0, 1))
+            reduced['max'][i, j] = block.max(axis=(0, 1))
+
+    return reduced
+
+
+@pytest.mark.parametrize('shape', [(8, 12), (7, 10), (9, 9, 3), (5, 11, 2)])
+@pytest.mark.parametrize('factor', [2, 3, 4])
+def test_box_reduce_matches_blocks(rng, shape, factor):
+    image_array = rng.integers(0, 256, shape, dtype=np.uint8)
+    reduced = box_reduce(image_array, factor, ('mean', 'min', 'max'))
+    expected = reference_reduce(image_array, factor)
+
+    assert reduced['mean'].dtype == np.uint8
+    # integer means are rounded
+    np.testing.assert_allclose(reduced['mean'], expected['mean'], atol=0.5 + 1e-4)
+    np.testing.assert_array_equal(reduced['min'], expected['min'])
+    np.testing.assert_array_equal(reduced['max'], expected['max'])
+
+
+def test_edge_blocks_are_not_biased():
+    # a 3-wide image reduced by 2: the last column is a block of its own
+    image_array = np.array([[0, 0, 90], [0, 0, 30]], dtype=np.uint8)
+    np.testing.assert_array_equal(box_reduce(image_array, 2)['mean'], [[0, 60]])
+
+
+def test_float_means(rng):
+    image_array = rng.random((7, 5)).astype(np.float32)
+    np.testing.assert_allclose(box_reduce(image_array, 3)['mean'], reference_reduce(image_array, 3)['mean'],
+                               rtol=1e-5)
+
+
+def test_unknown_statistic():
+    with pytest.raises(ValueError):
+        box_reduce(np.zeros((4, 4), dtype=np.uint8), 2, ('median',))
@@ -0,0 +1,57 @@
+""" Intensity bucket index range queries (user-014)."""
+
+import numpy as np
+import pytest
+
+from core import filter_point_cloud_by_intensity, replace_pixels_between_thresholds, surface_from_image
+from intensity_index import IntensityIndex, bucket_sort, channel_indexes
+
+
+def test_bucket_sort_is_stable(rng):
+    keys = rng.integers(0, 40, 500)
+    order, offsets = bucket_sort(keys, 40)
+    np.testing.assert_array_equal(order, np.argsort(keys, kind='stable'))
+    np.testing.assert_array_equal(np.diff(offsets), np.bincount(keys, minlength=40))
+
+
+@pytest.mark.parametrize('lower, upper', [(0, 255), (10.5, 99.2), (100, 100), (200, 50), (-5, 300)])
+def test_queries_match_scans(rng, lower, upper):
+    values = rng.integers(0, 256, 2000, dtype=np.uint8)
+    index = IntensityIndex(values)
+
+    within = (values >= lower) & (values <= upper)
+    between = (values > lower) & (values < upper)
+    assert index.count(lower, upper) == within.sum()
+    np.testing.assert_array_equal(np.sort(index.within(lower, upper)), np.flatnonzero(within))
+    np.testing.assert_array_equal(np.sort(index.between(lower, upper)), np.flatnonzero(between))
+
+
+def test_channel_indexes(rng):
+    image_array = rng.integers(0, 256, (8, 9, 2), dtype=np.uint8)
+    for channel, index in enumerate(channel_indexes(image_array)):
+        expected = np.flatnonzero(image_array[:, :, channel].ravel() <= 30)
+        np.testing.assert_array_equal(np.sort(index.within(0, 30)), expected)
+
+
+def test_integer_intensities_are_accepted():
+    index = IntensityIndex(np.array([3, 255, 0], dtype=np.int32))
+    assert index.count(1, 255) == 2
+
+
+@pytest.mark.parametrize('values', [np.array([0.5, 2.0]), np.array([256, 3]), np.array([-1, 3])])
+def test_other_intensities_are_rejected(values):
+    with pytest.raises(ValueError):
+        IntensityIndex(values)
+
+
+@pytest.mark.parametrize('lower, upper', [(100, 104), (20, 230)])
+def test_indexed_filters_match_scans(rng, lower, upper):
+    # narrow windows go through the index, wide ones fall back to the scan
+    image_array = rng.integers(0, 256, (30, 40), dtype=np.uint8)
+    surface = surface_from_image(image_array)
+    points = surface.points(0)
+    np.testing.assert_array_equal(filter_point_cloud_by_intensity(points, lower, upper, surface.intensity_index(0)),
+                                  filter_point_cloud_by_intensity(points, lower, upper))
+    np.testing.assert_array_equal(
+        replace_pixels_between_thresholds(image_array, lower, upper, 0, IntensityIndex(image_array)),
+        replace_pixels_between_thresholds(image_array, lower, upper, 0))
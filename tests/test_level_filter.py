@@ -0,0 +1,60 @@
+""" LevelFilter: windows snapped to voxel layers (user-003), rebuilding from stored arrays
+(user-013), pooling of coarser sizes (user-018) and the window exported with the view (user-021).
+"""
+
+import numpy as np
+import pytest
+
+from voxelizer import LevelFilter, nests, snapped_window, voxelize_channel
+
+SIZES = [1, 2, 3, 4, 6]
+
+
+@pytest.mark.parametrize('voxel_size', SIZES)
+def test_level_filter_window_is_a_layer_range(chan, voxel_size, assert_same_voxels):
+    indices, values = voxelize_channel(chan, voxel_size)
+    level_filter = LevelFilter(chan, voxel_size)
+    for lower, upper in [(0, 255), (30, 200), (100, 101), (200, 30)]:
+        levels = indices[:, 2]
+        inside = (levels >= level_filter.level(lower)) & (levels <= level_filter.level(upper))
+        assert_same_voxels(level_filter.window(lower, upper), (indices[inside], values[inside]))
+
+
+def test_level_filter_from_arrays(chan, assert_same_voxels):
+    level_filter = LevelFilter(chan, 4, 8)
+    copy = LevelFilter.from_arrays(level_filter.arrays, 4, 8)
+    assert_same_voxels(copy.window(20, 120), level_filter.window(20, 120))
+    np.testing.assert_array_equal(copy.counts, level_filter.counts)
+
+
+@pytest.mark.parametrize('voxel_size, k, pixel_size', [(1, 3, 1), (1, 2, 1), (1, 4, 1), (2, 3, 1), (2, 5, 2),
+                                                          (3, 3, 4), (4, 7, 1)])
+def test_pooled_filter_matches_direct(chan, voxel_size, k, pixel_size, assert_same_voxels):
+    fine = LevelFilter(chan, voxel_size, voxel_size * pixel_size)
+    coarse = voxel_size * k
+    pooled = fine.pooled(coarse)
+    direct = LevelFilter(chan, coarse, coarse * pixel_size)
+
+    assert pooled.z_size == direct.z_size
+    np.testing.assert_array_equal(pooled.offsets, direct.offsets)
+    assert_same_voxels(pooled.window(0, 255), direct.window(0, 255))
+    assert_same_voxels(pooled.window(50, 180), direct.window(50, 180))
+
+
+def test_nests():
+    assert nests(2, 6) and nests(2, 10) and nests(5, 15) and nests(3, 3)
+    assert nests(1, 2) and nests(1, 4)
+    assert not nests(2, 4) and not nests(3, 5)
+    with pytest.raises(ValueError):
+        LevelFilter(np.zeros((4, 4), dtype=np.uint8), 2).pooled(4)
+    # blocks of single pixels, but layers two values high
+    with pytest.raises(ValueError):
+        LevelFilter(np.zeros((4, 4), dtype=np.uint8), 1, 2).pooled(2)
+
+
+@pytest.mark.parametrize('voxel_size, z_size', [(1, 1), (2, 2), (3, 3), (4, 8)])
+def test_snapped_window_gives_the_shown_voxels(chan, voxel_size, z_size, assert_same_voxels):
+    level_filter = LevelFilter(chan, voxel_size, z_size)
+    for lower, upper in [(0, 255), (31, 200), (100, 101), (7, 8)]:
+        snapped = snapped_window(lower, upper, z_size)
+        assert_same_voxels(voxelize_channel(chan, voxel_size, *snapped, z_size), level_filter.window(lower, upper))
@@ -0,0 +1,59 @@
+""" Merged heightfield meshes with hidden faces culled (user-009)."""
+
+import numpy as np
+
+from meshing import FACES, exposed, merge_runs, mesh_arrays
+from voxelizer import voxelize_channel
+
+
+def heightfield(rng):
+    indices, values = voxelize_channel(rng.integers(0, 256, (12, 10), dtype=np.uint8), 2)
+    colors = np.repeat(np.round(values / 255, 1)[:, None], 3, axis=1)
+    return indices, colors
+
+
+def test_exposed_matches_neighbors(rng):
+    indices, _ = heightfield(rng)
+    occupied = set(map(tuple, indices))
+    for axis, direction, _ in FACES:
+        step = np.eye(3, dtype=int)[axis] * direction
+        expected = [tuple(index + step) not in occupied for index in indices]
+        np.testing.assert_array_equal(exposed(indices, axis, direction), expected)
+
+
+def test_runs_are_consecutive_and_of_one_color(rng):
+    indices, colors = heightfield(rng)
+    for axis, direction, merge_axis in FACES:
+        mask = exposed(indices, axis, direction)
+        faces, face_colors = indices[mask], colors[mask]
+        first, last, order = merge_runs(faces, merge_axis, face_colors)
+
+        assert first[0] == 0 and last[-1] == len(faces) - 1
+        np.testing.assert_array_equal(first[1:], last[:-1] + 1)
+        for start, end in zip(first, last):
+            run = order[start:end + 1]
+            np.testing.assert_array_equal(faces[run, merge_axis], faces[run[0], merge_axis] + np.arange(len(run)))
+            assert (face_colors[run] == face_colors[run[0]]).all()
+
+
+def test_mesh_covers_every_exposed_face(rng):
+    indices, colors = heightfield(rng)
+    vertices, triangles, vertex_colors, normals = mesh_arrays(indices, colors, 2.0, np.zeros(3))
+    n_faces = sum(exposed(indices, axis, direction).sum() for axis, direction, _ in FACES)
+
+    # each quad is two triangles covering as many faces as voxels it merges
+    quads = vertices.reshape(-1, 4, 3)
+    sides = np.abs(quads[:, 2] - quads[:, 0]) / 2.0
+    area = np.prod(np.where(sides == 0, 1, sides), axis=1)
+    assert len(triangles) == 2 * len(quads)
+    assert area.sum() == n_faces
+
+    # one color per quad, the color of its voxels
+    quad_colors = vertex_colors.reshape(-1, 4, 3)
+    assert (quad_colors == quad_colors[:, :1]).all()
+    assert set(map(tuple, quad_colors[:, 0])) <= set(map(tuple, colors))
+
+
+def test_empty_mesh():
+    vertices, triangles, _, _ = mesh_arrays(np.empty((0, 3), dtype=np.int32), np.empty((0, 3)), 1.0, np.zeros(3))
+    assert len(vertices) == 0 and len(triangles) == 0
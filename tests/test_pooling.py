@@ -0,0 +1,54 @@
+""" Block pooling of arbitrary voxel sizes with summed-area and max tables (user-018)."""
+
+import numpy as np
+import pytest
+
+from pooling import BlockPool
+
+
+def reference_blocks(chan, voxel_size):
+    # blocks of the voxelizer grid: columns flipped, the first block centered on the first pixel
+    s = voxel_size
+    flipped = chan[:, ::-1].astype(np.float64)
+    ny, nx = BlockPool(chan).grid_shape(s)
+    means, maxima = np.empty((ny, nx)), np.empty((ny, nx))
+    for iy in range(ny):
+        for ix in range(nx):
+            y0, x0 = max(iy * s - s // 2, 0), max(ix * s - s // 2, 0)
+            block = flipped[y0:iy * s - s // 2 + s, x0:ix * s - s // 2 + s]
+            means[iy, ix], maxima[iy, ix] = block.mean(), block.max()
+
+    return means, maxima
+
+
+@pytest.mark.parametrize('voxel_size', [1, 2, 3, 5, 8])
+def test_block_statistics_match_pixels(rng, voxel_size):
+    chan = rng.integers(0, 256, (29, 22), dtype=np.uint8)
+    block_pool = BlockPool(chan)
+    means, maxima = reference_blocks(chan, voxel_size)
+
+    np.testing.assert_allclose(block_pool.block_means(voxel_size), means, rtol=1e-6)
+    np.testing.assert_array_equal(block_pool.block_maxima(voxel_size), maxima)
+
+
+@pytest.mark.parametrize('mode', ['mean', 'max'])
+def test_voxels_are_one_per_column(rng, mode):
+    chan = rng.integers(0, 256, (20, 24), dtype=np.uint8)
+    block_pool = BlockPool(chan)
+    means, maxima = reference_blocks(chan, 4)
+    heights = means if mode == 'mean' else maxima
+
+    indices, values = block_pool.voxels(4, 60, 200, mode)
+    inside = (heights >= 60) & (heights <= 200)
+    assert len(indices) == inside.sum()
+    assert inside[indices[:, 1], indices[:, 0]].all()
+    np.testing.assert_array_equal(indices[:, 2], np.floor((heights[indices[:, 1], indices[:, 0]] + 2) / 4))
+    np.testing.assert_allclose(values, means[indices[:, 1], indices[:, 0]], rtol=1e-6)
+
+
+def test_max_tables_grow_with_the_voxel_size(rng):
+    # a larger size after a smaller one rebuilds the padded tables
+    chan = rng.integers(0, 256, (40, 40), dtype=np.uint8)
+    block_pool = BlockPool(chan)
+    block_pool.block_maxima(2)
+    np.testing.assert_array_equal(block_pool.block_maxima(16), reference_blocks(chan, 16)[1])
@@ -0,0 +1,38 @@
+""" Incremental frame-to-frame voxel updates of sequence.VoxelField (user-017)."""
+
+import numpy as np
+import pytest
+
+from sequence import VoxelField
+from voxelizer import voxelize_channel
+
+
+@pytest.mark.parametrize('voxel_size', [1, 2, 3, 4])
+def test_incremental_frames_match_full_voxelization(rng, voxel_size, assert_same_voxels):
+    frame = rng.integers(0, 256, (27, 34), dtype=np.uint8)
+    field = VoxelField(voxel_size, 15, 240)
+    assert field.update(frame) > 0
+    assert_same_voxels((field.indices, field.values), voxelize_channel(frame, voxel_size, 15, 240))
+
+    for _ in range(4):
+        # a few pixels change, some blocks are voxelized again
+        frame = frame.copy()
+        rows, cols = rng.integers(0, 27, 5), rng.integers(0, 34, 5)
+        frame[rows, cols] = rng.integers(0, 256, 5)
+        field.update(frame)
+        assert_same_voxels((field.indices, field.values), voxelize_channel(frame, voxel_size, 15, 240))
+
+
+def test_unchanged_frame_voxelizes_nothing(rng):
+    frame = rng.integers(0, 256, (16, 16), dtype=np.uint8)
+    field = VoxelField(2)
+    field.update(frame)
+    assert field.update(frame.copy()) == 0
+
+
+def test_resized_frame_starts_over(rng, assert_same_voxels):
+    field = VoxelField(3)
+    field.update(rng.integers(0, 256, (16, 16), dtype=np.uint8))
+    frame = rng.integers(0, 256, (20, 12), dtype=np.uint8)
+    field.update(frame)
+    assert_same_voxels((field.indices, field.values), voxelize_channel(frame, 3))
@@ -0,0 +1,70 @@
+""" Out-of-core tiles against the whole image (user-008), one value range for wider depths
+(user-016) and pooled tiles for export (user-021).
+"""
+
+import numpy as np
+import pytest
+
+from imaging import box_reduce
+from pooling import BlockPool
+from tiles import TiledImage, TileStore
+from voxelizer import LevelFilter, voxelize_channel
+
+
+@pytest.fixture
+def image_array(rng):
+    return rng.integers(0, 256, (45, 53, 2), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('tile_size', [8, 12, 64])
+@pytest.mark.parametrize('voxel_size', [1, 2, 3, 5])
+def test_tiles_match_whole_image(image_array, tile_size, voxel_size, assert_same_voxels):
+    tiled = TiledImage(image_array, tile_size)
+    for channel in range(2):
+        tiles = list(tiled.voxel_tiles(channel, voxel_size, 20, 230))
+        assert len(tiles) == np.prod(tiled.tile_grid(voxel_size))
+        voxels = np.concatenate([t[0] for t in tiles]), np.concatenate([t[1] for t in tiles])
+        assert_same_voxels(voxels, voxelize_channel(image_array[:, :, channel], voxel_size, 20, 230))
+
+
+@pytest.mark.parametrize('voxel_size', [2, 3])
+def test_tile_store_matches_level_filter(image_array, voxel_size, assert_same_voxels):
+    tiled = TiledImage(image_array, 10)
+    store = TileStore(tiled)
+    n_rows, n_cols = tiled.tile_grid(voxel_size)
+    tiles = [(ty, tx) for ty in range(n_rows) for tx in range(n_cols)]
+    level_filter = LevelFilter(image_array[:, :, 1], voxel_size)
+
+    for lower, upper in [(0, 255), (60, 140)]:
+        assert_same_voxels(store.get(1, voxel_size, lower, upper, tiles), level_filter.window(lower, upper))
+    # the second window is cut from the resident tiles
+    assert len(store) == len(tiles)
+
+
+def test_tile_store_shrink(image_array):
+    store = TileStore(TiledImage(image_array, 10))
+    store.get(0, 2, 0, 255, [(0, 0), (0, 1)])
+    store.shrink(0)
+    assert len(store) == 0 and store.nbytes == 0
+
+
+@pytest.mark.parametrize('factor', [2, 4])
+def test_overview_matches_whole_image(image_array, factor):
+    tiled = TiledImage(image_array, 8)
+    np.testing.assert_array_equal(tiled.overview(factor), box_reduce(image_array, factor)['mean'])
+
+
+def test_wider_depths_use_one_range(rng):
+    source = rng.integers(0, 4096, (20, 30), dtype=np.uint16)
+    tiled = TiledImage(source, 8, values=(0, 4095))
+    expected = source / 4095 * 255
+    np.testing.assert_allclose(tiled.read((0, 20), (0, 30), 0), expected, atol=0.501)
+
+
+@pytest.mark.parametrize('mode', ['mean', 'max'])
+@pytest.mark.parametrize('voxel_size', [2, 3, 5])
+def test_pooled_tiles_match_block_pool(image_array, mode, voxel_size, assert_same_voxels):
+    tiled = TiledImage(image_array, 12)
+    tiles = list(tiled.voxel_tiles(0, voxel_size, 40, 220, mode))
+    voxels = np.concatenate([t[0] for t in tiles]), np.concatenate([t[1] for t in tiles])
+    assert_same_voxels(voxels, BlockPool(image_array[:, :, 0]).voxels(voxel_size, 40, 220, mode))
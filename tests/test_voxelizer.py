@@ -0,0 +1,41 @@
+""" Direct voxelization of the image array (user-001), all the channels at once (user-016) and
+band by band for streaming export (user-021), against the per-pixel definition.
+"""
+
+import numpy as np
+import pytest
+
+from conftest import reference_voxels
+from voxelizer import voxelize_bands, voxelize_channel, voxelize_channels
+
+SIZES = [1, 2, 3, 4, 6]
+
+
+@pytest.mark.parametrize('voxel_size', SIZES)
+def test_voxelize_channel_matches_pixels(chan, voxel_size, assert_same_voxels):
+    assert_same_voxels(voxelize_channel(chan, voxel_size), reference_voxels(chan, voxel_size))
+
+
+@pytest.mark.parametrize('voxel_size, z_size', [(2, 4), (3, 9), (4, 1)])
+def test_voxelize_channel_window_and_z_size(chan, voxel_size, z_size, assert_same_voxels):
+    assert_same_voxels(voxelize_channel(chan, voxel_size, 40, 200, z_size),
+                       reference_voxels(chan, voxel_size, 40, 200, z_size))
+
+
+def test_voxelize_channel_counts(chan):
+    indices, values, counts = voxelize_channel(chan, 3, counts=True)
+    assert counts.sum() == chan.size
+    assert len(counts) == len(indices)
+
+
+@pytest.mark.parametrize('voxel_size', SIZES)
+def test_voxelize_channels_and_bands_match_channel(rng, voxel_size, assert_same_voxels):
+    image_array = rng.integers(0, 256, (23, 31, 3), dtype=np.uint8)
+    by_channel = voxelize_channels(image_array, voxel_size, 10, 240)
+    for channel in range(3):
+        expected = voxelize_channel(image_array[:, :, channel], voxel_size, 10, 240)
+        assert_same_voxels(by_channel[channel], expected)
+
+        bands = list(voxelize_bands(image_array[:, :, channel], voxel_size, 10, 240, band_blocks=2))
+        assert_same_voxels((np.concatenate([b[0] for b in bands]), np.concatenate([b[1] for b in bands])),
+                           expected)
@@ -0,0 +1,456 @@
+""" Out-of-core, tile by tile access and voxelization of very large images."""
+
+import math
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from channels import as_channels, channel_names, derive_channels, to_uint8, value_range
+from imaging import box_reduce, image_to_array
+from voxelizer import LevelFilter, voxelize_blocks
+
+# Side of the tiles, in pixels (rounded down to a multiple of the voxel size)
+TILE_SIZE = 1024
+# Images with more pixels are loaded tile by tile
+TILED_PIXELS = 64_000_000
+# Width of the overview image used for the coarse levels of detail
+OVERVIEW_WIDTH = 2048
+# Memory cap of the resident voxelized tiles
+TILE_CACHE_BYTES = 512 * 1024 * 1024
+# Disk cap of the images spilled to NPY files by open_image_source
+SPILL_BYTES = 16 * 1024 * 1024 * 1024
+# Modes decoded straight into a memory map, and the mode and dtype of the map (RGB is
+# stored as RGBX by PIL)
+_MAPPED_MODES = {'L': ('L', np.uint8), 'I;16': ('I;16', '<u2'), 'RGB': ('RGBA', np.uint8), 'RGBA': ('RGBA', np.uint8)}
+# Overview pixels larger than this (in screen pixels) switch to full resolution tiles
+TILE_ZOOM = 2.0
+
+
+def _pil_image():
+    from PIL import Image
+
+    # gigapixel scans are legitimate inputs here
+    Image.MAX_IMAGE_PIXELS = None
+    return Image
+
+
+def image_size(img_path):
+    """
+    Returns (width, height) of an image, reading only its header.
+
+    :param      img_path | str
+
+    :return     (int, int)
+    """
+    if img_path.lower().endswith('.npy'):
+        shape = np.load(img_path, mmap_mode='r').shape
+        return shape[1], shape[0]
+
+    with _pil_image().open(img_path) as image:
+        return image.size
+
+
+def decoded_bytes(img_path):
+    """
+    Estimates the memory of an image once decoded into 8-bit channels, from its header.
+
+    :param      img_path | str
+
+    :return     int
+    """
+    if img_path.lower().endswith('.npy'):
+        shape = np.load(img_path, mmap_mode='r').shape
+        return math.prod(shape[:2]) * (shape[2] if len(shape) > 2 else 1)
+
+    with _pil_image().open(img_path) as image:
+        return image.width * image.height * len(image.getbands())
+
+
+def is_large(img_path):
+    width, height = image_size(img_path)
+    return img_path.lower().endswith('.npy') or width * height > TILED_PIXELS
+
+
+def open_image_source(img_path, spill_dir=None, max_spill_bytes=SPILL_BYTES):
+    """
+    Returns an (H, W[, C]) memory-mapped array of the image.
+
+    NPY files are mapped directly. Other formats cannot be decoded region by region by
+    PIL, so they are decoded once to an NPY file in spill_dir (the temporary directory by
+    default), which is reused for later openings. 8-bit gray and RGB(A) and 16-bit gray
+    images are decoded straight into the memory map, so that the decoder only holds a
+    strip at a time (see _decode_mapped); other modes are decoded in memory first. The
+    least recently used spilled images are deleted once they take more than max_spill_bytes.
+
+    :param      img_path | str
+                spill_dir | str
+                max_spill_bytes | int
+
+    :return     np.memmap
+    """
+    if img_path.lower().endswith('.npy'):
+        return np.load(img_path, mmap_mode='r')
+
+    spill_dir = spill_dir or os.path.join(tempfile.gettempdir(), 'pixels2voxels')
+    os.makedirs(spill_dir, exist_ok=True)
+    stat = os.stat(img_path)
+    name = f'{os.path.basename(img_path)}-{stat.st_size}-{int(stat.st_mtime)}.npy'
+    npy_path = os.path.join(spill_dir, name)
+
+    with _pil_image().open(img_path) as image:
+        mode = image.mode
+        spill = not os.path.exists(npy_path)
+        if spill:
+            _spill(image, npy_path + '.part')
+    if spill:
+        # the file is complete: renamed once PIL has released it
+        os.replace(npy_path + '.part', npy_path)
+
+    # the modification time of a spilled image is its last use, for eviction
+    os.utime(npy_path)
+    evict_spilled(spill_dir, max_spill_bytes, keep=npy_path)
+
+    spilled = np.load(npy_path, mmap_mode='r')
+    # RGB images are decoded as RGBX
+    return spilled[:, :, :3] if mode == 'RGB' else spilled
+
+
+def _spill(image, npy_path):
+    try:
+        if image.mode in _MAPPED_MODES:
+            _decode_mapped(image, npy_path)
+        else:
+            _decode_spilled(image, npy_path)
+    except BaseException:
+        if os.path.exists(npy_path):
+            os.remove(npy_path)
+        raise
+
+
+def _decode_mapped(image, npy_path):
+    # PIL decodes into an image sharing the memory of the NPY file, so pixels go to disk
+    # as they are decoded instead of into one large buffer
+    Image = _pil_image()
+    buffer_mode, dtype = _MAPPED_MODES[image.mode]
+    shape = (image.height, image.width, 4) if buffer_mode == 'RGBA' else (image.height, image.width)
+    spilled = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=shape)
+
+    image.im = Image.frombuffer(buffer_mode, image.size, spilled, 'raw', buffer_mode, 0, 1).im
+    image.load()
+    if image.readonly:
+        # uncompressed files of the same layout are mapped by PIL instead of decoded into the
+        # target: they are copied by strips
+        for r0 in range(0, image.height, TILE_SIZE):
+            strip = np.asarray(image.crop((0, r0, image.width, min(r0 + TILE_SIZE, image.height))))
+            spilled[r0:r0 + len(strip)] = strip
+
+    spilled.flush()
+    del spilled
+
+
+def _decode_spilled(image, npy_path):
+    # modes that are converted after decoding (palette, bilevel, CMYK, 32-bit...)
+    decoded = image_to_array(image)
+    spilled = np.lib.format.open_memmap(npy_path, mode='w+', dtype=decoded.dtype, shape=decoded.shape)
+    for r0 in range(0, decoded.shape[0], TILE_SIZE):
+        spilled[r0:r0 + TILE_SIZE] = decoded[r0:r0 + TILE_SIZE]
+    spilled.flush()
+    del spilled, decoded
+
+
+def evict_spilled(spill_dir, max_bytes=SPILL_BYTES, keep=None):
+    """
+    Deletes the least recently used images spilled by open_image_source once they take
+    more than max_bytes.
+
+    :param      spill_dir | str
+                max_bytes | int
+                keep | str, path of a spilled image in use, never deleted
+    """
+    entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in os.scandir(spill_dir)
+                     if entry.name.endswith('.npy') and entry.is_file())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+class TiledImage:
+    """
+    Image read region by region from a memory-mapped array.
+
+    Tiles are aligned on the voxel grid of each voxel size (see voxelizer.grid_origin),
+    so that voxelizing tile by tile gives exactly the voxels of the whole image.
+
+    Regions are read as 8-bit channels of the given colour space (see channels.py); the
+    depth of the source is rescaled with one range for the whole image, so that tiles
+    match each other: 'values' if given, otherwise the range of the source.
+    """
+
+    def __init__(self, source, tile_size=TILE_SIZE, space='Native', values=None):
+        self.source = source
+        self.tile_size = tile_size
+        self.space = space
+        self.height, self.width = source.shape[:2]
+        self.n_native = 1 if source.ndim == 2 else source.shape[2]
+        self.values = values if values is not None or source.dtype == np.uint8 else value_range(source)
+
+    @property
+    def n_channels(self):
+        return len(channel_names(self.n_native, self.space))
+
+    def read(self, rows, cols, channel=None):
+        """
+        Reads a region of the image into memory.
+
+        :param      rows | (int, int), first and last + 1 row
+                    cols | (int, int), first and last + 1 column
+                    channel | int, or None for all the channels
+
+        :return     np.ndarray
+        """
+        region = as_channels(self.source[rows[0]:rows[1], cols[0]:cols[1]])
+        region = derive_channels(to_uint8(region, self.values), self.space)
+        if channel is not None:
+            region = region[:, :, channel]
+
+        return np.array(region)
+
+    def tile_blocks(self, voxel_size):
+        return max(1, self.tile_size // voxel_size)
+
+    def tile_grid(self, voxel_size):
+        """
+        Returns the number of tiles (rows, columns) for a voxel size.
+
+        :return     (int, int)
+        """
+        off = voxel_size // 2
+        blocks = self.tile_blocks(voxel_size)
+        ny = (self.height - 1 + off) // voxel_size + 1
+        nx = (self.width - 1 + off) // voxel_size + 1
+
+        return math.ceil(ny / blocks), math.ceil(nx / blocks)
+
+    def _padded_tile(self, channel, voxel_size, tile):
+        # pixels of a tile laid out as voxelizer.voxelize_blocks takes them, with its first block
+        s = voxel_size
+        off = s // 2
+        blocks = self.tile_blocks(s)
+        iy0, ix0 = tile[0] * blocks, tile[1] * blocks
+        iy1 = min(iy0 + blocks, (self.height - 1 + off) // s + 1)
+        ix1 = min(ix0 + blocks, (self.width - 1 + off) // s + 1)
+
+        # pixel ranges of the tile (columns are flipped, as x = -col)
+        r0, c0 = iy0 * s - off, ix0 * s - off
+        rows = (max(r0, 0), min(iy1 * s - off, self.height))
+        flipped = (max(c0, 0), min(ix1 * s - off, self.width))
+
+        padded = np.full(((iy1 - iy0) * s, (ix1 - ix0) * s), -1, dtype=np.int32)
+        region = self.read(rows, (self.width - flipped[1], self.width - flipped[0]), channel)
+        padded[rows[0] - r0:rows[1] - r0, flipped[0] - c0:flipped[1] - c0] = region[:, ::-1]
+
+        return padded, iy0, ix0
+
+    def voxelize_tile(self, channel, voxel_size, tile, lower=0, upper=255):
+        """
+        Voxelizes one tile, returning indices in the grid of the whole image.
+
+        :param      channel | int
+                    voxel_size | int
+                    tile | (int, int), tile row and column
+                    lower | int
+                    upper | int
+
+        :return     (indices, values) | np.ndarray (M, 3) int32, np.ndarray (M,) float32
+        """
+        padded, iy0, ix0 = self._padded_tile(channel, voxel_size, tile)
+        indices, values = voxelize_blocks(padded, voxel_size, lower, upper)
+        indices[:, 0] += ix0
+        indices[:, 1] += iy0
+
+        return indices, values
+
+    def pool_tile(self, channel, voxel_size, tile, lower=0, upper=255, mode='mean'):
+        """
+        Pools one tile into one voxel per column, as pooling.BlockPool.voxels does for a
+        whole image (tiles hold whole blocks, so the columns are the same).
+
+        :param      mode | str, 'mean' or 'max' height (colors always use the mean)
+
+        :return     (indices, values) | np.ndarray (M, 3) int32, np.ndarray (M,) float32
+        """
+        s = voxel_size
+        padded, iy0, ix0 = self._padded_tile(channel, s, tile)
+        blocks = padded.reshape(padded.shape[0] // s, s, padded.shape[1] // s, s)
+        valid = blocks >= 0
+        means = (np.where(valid, blocks, 0).sum(axis=(1, 3)) / valid.sum(axis=(1, 3))).astype(np.float32)
+        heights = means if mode == 'mean' else blocks.max(axis=(1, 3))
+
+        iy, ix = np.nonzero((heights >= lower) & (heights <= upper))
+        indices = np.empty((len(iy), 3), dtype=np.int32)
+        indices[:, 0] = ix + ix0
+        indices[:, 1] = iy + iy0
+        indices[:, 2] = np.floor((heights[iy, ix] + s // 2) / s)
+
+        return indices, means[iy, ix]
+
+    def tile_filter(self, channel, voxel_size, tile):
+        """
+        Voxelizes one tile with every intensity level, as a LevelFilter (see voxelizer.py).
+
+        :return     LevelFilter
+        """
+        return LevelFilter.from_voxels(*self.voxelize_tile(channel, voxel_size, tile), voxel_size)
+
+    def voxel_tiles(self, channel, voxel_size, lower=0, upper=255, pooling=None):
+        # voxels of the whole image, tile by tile (see export.py), pooled with a pooling mode
+        n_rows, n_cols = self.tile_grid(voxel_size)
+        for ty in range(n_rows):
+            for tx in range(n_cols):
+                if pooling is None:
+                    yield self.voxelize_tile(channel, voxel_size, (ty, tx), lower, upper)
+                else:
+                    yield self.pool_tile(channel, voxel_size, (ty, tx), lower, upper, pooling)
+
+    def tiles_around(self, voxel_size, row, col, radius, budget=None):
+        """
+        Returns the tiles intersecting the square of the given radius around a pixel.
+
+        :param      voxel_size | int
+                    row, col | float, pixel position
+                    radius | float, in pixels
+                    budget | int, max. number of voxel columns of the returned tiles
+
+        :return     list of (int, int), nearest tiles first
+        """
+        span = self.tile_blocks(voxel_size) * voxel_size
+        off = voxel_size // 2
+        n_rows, n_cols = self.tile_grid(voxel_size)
+        # tile coordinates of the flipped image
+        y, x = (row + off) / span, (self.width - 1 - col + off) / span
+        r = radius / span
+
+        tiles = [(ty, tx)
+                 for ty in range(max(0, int(y - r)), min(n_rows, int(y + r) + 1))
+                 for tx in range(max(0, int(x - r)), min(n_cols, int(x + r) + 1))]
+        tiles.sort(key=lambda t: (t[0] + 0.5 - y) ** 2 + (t[1] + 0.5 - x) ** 2)
+
+        if budget is not None:
+            tiles = tiles[:max(1, budget // self.tile_blocks(voxel_size) ** 2)]
+
+        return tiles
+
+    def overview(self, factor):
+        """
+        Downsamples the image by an integer factor, streaming over strips of rows.
+
+        :param      factor | int
+
+        :return     np.ndarray (ceil(H / factor), ceil(W / factor), C), same dtype
+        """
+        strip = max(1, self.tile_size // factor) * factor
+        parts = []
+        for r0 in range(0, self.height, strip):
+            region = self.read((r0, min(r0 + strip, self.height)), (0, self.width))
+            parts.append(box_reduce(region, factor)['mean'])
+
+        return np.concatenate(parts)
+
+
+def overview_factor(width, max_width=OVERVIEW_WIDTH):
+    # power of two, so that the overview fits the pyramid of lod.py
+    return 2 ** max(0, math.ceil(math.log2(width / max_width)))
+
+
+class TileStore:
+    """
+    Voxelized tiles kept resident in an LRU, within a memory budget.
+
+    Tiles are kept as level filters keyed by (channel, voxel size, tile row, tile column),
+    so that moving the intensity window only slices them again, as GridStore does. Tiles
+    that are requested together are never evicted by each other.
+    """
+
+    def __init__(self, tiled, max_bytes=TILE_CACHE_BYTES):
+        self.tiled = tiled
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, channel, voxel_size, lower, upper, tiles, cancelled=None):
+        """
+        Returns the voxels of the given tiles, voxelizing the ones that are not resident.
+
+        :param      tiles | list of (int, int)
+                    cancelled | callable returning True to stop early (returns None)
+
+        :return     (indices, values) | concatenated arrays
+        """
+        parts = []
+        keys = []
+        for tile in tiles:
+            if cancelled is not None and cancelled():
+                return None
+
+            key = (channel, voxel_size) + tuple(tile)
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+            else:
+                self._tiles[key] = self.tiled.tile_filter(channel, voxel_size, tile)
+                self.nbytes += self._tiles[key].nbytes
+
+            keys.append(key)
+            parts.append(self._tiles[key].window(lower, upper))
+
+        self._evict(set(keys))
+
+        if not parts:
+            return np.empty((0, 3), dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def pooled(self, channel, voxel_size, lower, upper, tiles, mode='mean', cancelled=None):
+        """
+        Returns one voxel per column of the given tiles, pooled with mode (see TiledImage.pool_tile).
+
+        :return     (indices, values) | concatenated arrays, or None if cancelled
+        """
+        parts = []
+        for tile in tiles:
+            if cancelled is not None and cancelled():
+                return None
+            parts.append(self.tiled.pool_tile(channel, voxel_size, tile, lower, upper, mode))
+
+        if not parts:
+            return np.empty((0, 3), dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def shrink(self, max_bytes):
+        # least recently used tiles first; those shown are rebuilt if needed again
+        self._evict((), max_bytes)
+
+    def clear(self):
+        self._tiles.clear()
+        self.nbytes = 0
+
+    def _evict(self, keep, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        for key in list(self._tiles):
+            if self.nbytes <= max_bytes:
+                break
+            if key not in keep:
+                self.nbytes -= self._tiles.pop(key).nbytes
@@ -0,0 +1,440 @@
+""" Direct voxelization of image channels seen as heightfields."""
+
+import numpy as np
+
+from instrument import span
+from intensity_index import bucket_sort
+
+
+def grid_origin(width, voxel_size, pixel_size=1):
+    """
+    Returns the origin of the voxel grid for an image of the given width.
+
+    Pixels are placed at (-col, row, intensity), as in surface_from_image, and the grid
+    is anchored half a voxel below the image corner (like Open3D does for a cloud whose
+    minimum intensity is 0). The grid is thus the same whatever the intensity window.
+    For downsampled images (see lod.py), pixel_size is the world size of one pixel.
+
+    :param      width | int
+                voxel_size | int, in pixels
+                pixel_size | int
+
+    :return     np.ndarray (3,)
+    """
+    half = voxel_size * pixel_size / 2
+    return np.array([-(width - 1) * pixel_size - half, -half, -half])
+
+
+def voxelize_channel(chan, voxel_size, lower=0, upper=255, z_size=None, counts=False):
+    """
+    Bins one image channel into voxel cells with block reductions on the array.
+
+    Each block of voxel_size x voxel_size pixels is sorted, and every run of pixels
+    falling into the same intensity level becomes one voxel. Pixels outside the
+    [lower, upper] intensity window are ignored.
+
+    :param      chan | np.ndarray (H, W) of integers
+                voxel_size | int
+                lower | int
+                upper | int
+                z_size | int, height of the intensity levels (voxel_size by default)
+                counts | bool, also return the number of pixels of each voxel
+
+    :return     (indices, values[, counts]) | np.ndarray (M, 3) int32, np.ndarray (M,) float32
+                grid indices of the occupied voxels and their mean intensity (and
+                np.ndarray (M,) int32 pixel counts)
+    """
+    s = int(voxel_size)
+    height, width = chan.shape
+    # with the grid origin half a voxel before the first pixel, pixel p lands in
+    # voxel (p + s // 2) // s
+    off = s // 2
+    ny = (height - 1 + off) // s + 1
+    nx = (width - 1 + off) // s + 1
+
+    # x = -col, so columns are flipped; -1 marks padding
+    padded = np.full((ny * s, nx * s), -1, dtype=np.int32)
+    padded[off:off + height, off:off + width] = chan[:, ::-1]
+
+    return voxelize_blocks(padded, s, lower, upper, z_size, counts)
+
+
+def voxelize_channels(image_array, voxel_size, lower=0, upper=255, z_size=None):
+    """
+    Voxelizes all the channels of an image, as voxelize_channel does for each.
+
+    :param      image_array | np.ndarray (H, W, C) of integers
+
+    :return     list of (indices, values), one per channel
+    """
+    return [voxelize_channel(image_array[:, :, channel], voxel_size, lower, upper, z_size)
+            for channel in range(image_array.shape[2])]
+
+
+def voxelize_bands(chan, voxel_size, lower=0, upper=255, z_size=None, band_blocks=64):
+    """
+    Voxelizes one channel band by band of block rows, as voxelize_channel does at once.
+
+    Only one band is padded and voxelized at a time, so the voxels of a large image can
+    be streamed (e.g. to export.py) without holding all of them.
+
+    :param      band_blocks | int, block rows per band
+
+    :return     iterator of (indices, values), indices in the grid of the whole channel
+    """
+    s = int(voxel_size)
+    height, width = chan.shape
+    off = s // 2
+    ny = (height - 1 + off) // s + 1
+    nx = (width - 1 + off) // s + 1
+
+    for y0 in range(0, ny, band_blocks):
+        y1 = min(y0 + band_blocks, ny)
+        # pixel rows of the band, the first band starting half a voxel before the image
+        r0 = y0 * s - off
+        rows = (max(r0, 0), min(y1 * s - off, height))
+
+        padded = np.full(((y1 - y0) * s, nx * s), -1, dtype=np.int32)
+        padded[rows[0] - r0:rows[1] - r0, off:off + width] = chan[rows[0]:rows[1], ::-1]
+        indices, values = voxelize_blocks(padded, s, lower, upper, z_size)
+        indices[:, 1] += y0
+
+        yield indices, values
+
+
+def voxelize_blocks(padded, voxel_size, lower=0, upper=255, z_size=None, counts=False):
+    """
+    Voxelizes a block-aligned array whose first pixel starts a voxel.
+
+    :param      padded | np.ndarray (ny * voxel_size, nx * voxel_size) int32, with -1
+                for the pixels outside the image (modified in place)
+                voxel_size | int
+                lower | int
+                upper | int
+                z_size | int
+                counts | bool, also return the number of pixels of each voxel
+
+    :return     (indices, values[, counts]) | np.ndarray (M, 3) int32, np.ndarray (M,) float32
+                (np.ndarray (M,) int32), indices are relative to the first block of the array
+    """
+    with span('voxelize', voxel_size=int(voxel_size), pixels=padded.size):
+        voxels = _voxelize_blocks(padded, voxel_size, lower, upper, z_size)
+
+    return voxels if counts else voxels[:2]
+
+
+def _voxelize_blocks(padded, voxel_size, lower, upper, z_size):
+    s = int(voxel_size)
+    z_size = s if z_size is None else int(z_size)
+    ny = padded.shape[0] // s
+    nx = padded.shape[1] // s
+
+    # filtered pixels are handled as padding
+    padded[(padded < lower) | (padded > upper)] = -1
+
+    blocks = padded.reshape(ny, s, nx, s).swapaxes(1, 2).reshape(ny * nx, s * s)
+    blocks.sort(axis=1)
+    valid = blocks >= 0
+    levels = (blocks + z_size // 2) // z_size
+
+    # a voxel starts on each valid pixel whose level differs from the previous one
+    starts = valid.copy()
+    starts[:, 1:] &= (levels[:, 1:] != levels[:, :-1]) | ~valid[:, :-1]
+    starts = np.flatnonzero(starts)
+
+    if starts.size == 0:
+        return np.empty((0, 3), dtype=np.int32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int32)
+
+    # sorted rows hold padding first, so a run never swallows valid pixels of the next block
+    sums = np.add.reduceat(np.where(valid, blocks, 0).ravel(), starts)
+    counts = np.add.reduceat(valid.ravel(), starts)
+
+    block_id = starts // (s * s)
+    indices = np.empty((starts.size, 3), dtype=np.int32)
+    indices[:, 0] = block_id % nx
+    indices[:, 1] = block_id // nx
+    indices[:, 2] = levels.ravel()[starts]
+
+    return indices, (sums / counts).astype(np.float32), counts.astype(np.int32)
+
+
+def nests(voxel_size, coarse_size):
+    """
+    Tells whether the blocks (or intensity layers) of coarse_size are unions of those of
+    voxel_size. Grids are anchored half a voxel before the first pixel, so this holds for
+    odd multiples, and for any multiple of size 1 whose blocks are single pixels; even
+    multiples of larger sizes straddle the finer blocks (e.g. 4 and 2).
+
+    :return     bool
+    """
+    return coarse_size % voxel_size == 0 and (voxel_size == 1 or (coarse_size // voxel_size) % 2 == 1)
+
+
+def snapped_window(lower, upper, z_size):
+    """
+    Returns the intensity window covering the whole voxel layers that [lower, upper]
+    touches, i.e. the pixels of the voxels LevelFilter.window(lower, upper) shows.
+
+    :param      lower | int
+                upper | int
+                z_size | int, height of the intensity layers
+
+    :return     (int, int)
+    """
+    z = int(z_size)
+    first, last = (int(lower) + z // 2) // z, (int(upper) + z // 2) // z
+
+    return max(first * z - z // 2, 0), (last + 1) * z - z // 2 - 1
+
+
+def _merge_cells(cells, counts, sums, n_cells):
+    # sums the counts and sums of the voxels of each cell, cells in increasing order
+    if len(cells) * 8 < n_cells:
+        # a sparse layer: sorting its voxels is cheaper than a pass over every cell
+        cells, inverse = np.unique(cells, return_inverse=True)
+        return cells, np.bincount(inverse, counts, len(cells)), np.bincount(inverse, sums, len(cells))
+
+    total = np.bincount(cells, counts, n_cells)
+    occupied = np.flatnonzero(total)
+    return occupied, total[occupied], np.bincount(cells, sums, n_cells)[occupied]
+
+
+def channel_colors(values, channel, tint=None):
+    """
+    Returns the display colors of a channel for the given intensities.
+
+    :param      values | np.ndarray (M,)
+                channel | int
+                tint | np.ndarray (3,), color of the channel (see channels.channel_tints);
+                by default red, green or blue for the channels 0 to 2, white after
+
+    :return     np.ndarray (M, 3) float64
+    """
+    if tint is None:
+        tint = np.eye(3)[channel] if channel < 3 else np.ones(3)
+
+    return (values / 255)[:, None] * (0.2 + 0.4 * np.asarray(tint, dtype=float))
+
+
+def to_voxel_grid(indices, colors, voxel_size, origin):
+    """
+    Builds an Open3D VoxelGrid from voxel indices and colors.
+
+    Open3D has no bulk setter for voxels, so one point is placed at the center of each
+    voxel (not one per pixel) and binned within fixed bounds, which keeps the indices exact.
+
+    :param      indices | np.ndarray (M, 3)
+                colors | np.ndarray (M, 3)
+                voxel_size | float
+                origin | np.ndarray (3,)
+
+    :return     o3d.geometry.VoxelGrid
+    """
+    import open3d as o3d
+
+    with span('voxel_grid', voxels=len(indices)):
+        centers = origin + (indices + 0.5) * voxel_size
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(centers)
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+
+        if len(indices):
+            max_bound = origin + (indices.max(axis=0) + 1) * voxel_size
+        else:
+            max_bound = origin + voxel_size
+
+        return o3d.geometry.VoxelGrid.create_from_point_cloud_within_bounds(pcd, voxel_size, origin, max_bound)
+
+
+def voxel_grid_from_image(image_array, channel, voxel_size, lower=0, upper=255):
+    """
+    Voxelizes one channel of an image array straight into an Open3D VoxelGrid.
+
+    :param      image_array | np.ndarray (H, W, C)
+                channel | int
+                voxel_size | int
+                lower | int
+                upper | int
+
+    :return     o3d.geometry.VoxelGrid
+    """
+    indices, values = voxelize_channel(image_array[:, :, channel], voxel_size, lower, upper)
+    colors = channel_colors(values, channel)
+    origin = grid_origin(image_array.shape[1], voxel_size)
+
+    return to_voxel_grid(indices, colors, voxel_size, origin)
+
+
+class LevelFilter:
+    """
+    Intensity filter over the precomputed, unfiltered voxels of one channel and size.
+
+    Voxels are stored sorted by z-level (the intensity layer) with the offset of each
+    level, so an intensity window is a contiguous slice. The window is snapped to the
+    voxel layers it touches, and moving one bound only moves that end of the slice.
+
+    The pixel count of each voxel is kept, so that the filter of a coarser size nesting
+    this one (see nests) is pooled from its voxels instead of the pixels ('pooled').
+    """
+
+    def __init__(self, chan, voxel_size, z_size=None):
+        self.voxel_size = int(voxel_size)
+        self.z_size = self.voxel_size if z_size is None else int(z_size)
+        self._sort(*voxelize_channel(chan, self.voxel_size, z_size=self.z_size, counts=True))
+
+    @classmethod
+    def from_voxels(cls, indices, values, voxel_size, z_size=None, counts=None):
+        """
+        Builds a filter from unfiltered voxels voxelized elsewhere (e.g. one tile of a large image).
+
+        :param      indices | np.ndarray (M, 3) int32
+                    values | np.ndarray (M,) float32
+                    voxel_size | int
+                    z_size | int
+                    counts | np.ndarray (M,) int32, pixels of each voxel (None if the filter
+                    is never pooled)
+
+        :return     LevelFilter
+        """
+        level_filter = cls.__new__(cls)
+        level_filter.voxel_size = int(voxel_size)
+        level_filter.z_size = level_filter.voxel_size if z_size is None else int(z_size)
+        level_filter._sort(indices, values, counts)
+
+        return level_filter
+
+    @classmethod
+    def from_arrays(cls, arrays, voxel_size, z_size=None):
+        """
+        Rebuilds a filter from the arrays of another one (see 'arrays'), e.g. read from disk.
+
+        :param      arrays | dict with 'indices', 'values', 'offsets' and 'counts'
+                    voxel_size | int
+                    z_size | int
+
+        :return     LevelFilter
+        """
+        level_filter = cls.__new__(cls)
+        level_filter.voxel_size = int(voxel_size)
+        level_filter.z_size = level_filter.voxel_size if z_size is None else int(z_size)
+        level_filter._set_arrays(arrays['indices'], arrays['values'], arrays['offsets'], arrays.get('counts'))
+
+        return level_filter
+
+    def pooled(self, voxel_size):
+        """
+        Derives the filter of a coarser voxel size from the voxels of this one.
+
+        Blocks and intensity layers of voxel_size must be unions of those of this filter
+        (see nests), the layers growing with the blocks. The voxels falling into the same
+        coarse block and layer are merged, their means weighted by their pixel counts:
+        the result is the filter voxelize_channel would give, at the cost of the voxels of
+        this filter rather than of the pixels.
+
+        :param      voxel_size | int, multiple of this filter's size nesting it
+
+        :return     LevelFilter
+        """
+        k = voxel_size // self.voxel_size
+        if self.counts is None or not nests(self.voxel_size, voxel_size) or not nests(self.z_size, self.z_size * k):
+            raise ValueError(f'voxel size {voxel_size} cannot be pooled from size {self.voxel_size}')
+
+        level_filter = LevelFilter.__new__(LevelFilter)
+        level_filter.voxel_size = int(voxel_size)
+        level_filter.z_size = self.z_size * k
+        n_levels = level_filter.level(255) + 1
+
+        with span('pool_filter', voxel_size=int(voxel_size), voxels=len(self.indices)):
+            # a block (or layer) i of this filter falls into the coarse one (i + k // 2) // k,
+            # looked up rather than divided for each voxel
+            fine_x, fine_y = (int(self.indices[:, c].max(initial=0)) + 1 for c in (0, 1))
+            coarse_x = (np.arange(fine_x) + k // 2) // k
+            coarse_y = (np.arange(fine_y) + k // 2) // k
+            nx = int(coarse_x[-1]) + 1
+            n_cells = nx * (int(coarse_y[-1]) + 1)
+            cells = (coarse_y * nx)[self.indices[:, 1]]
+            cells += coarse_x[self.indices[:, 0]]
+            weighted = self.values * self.counts.astype(np.float64)
+
+            # the voxels of a coarse layer are the contiguous ones of k layers of this filter
+            parts = []
+            offsets = np.zeros(n_levels + 1, dtype=np.int64)
+            for level in range(n_levels):
+                first = min(max(level * k - k // 2, 0), len(self.offsets) - 1)
+                last = min(max(level * k - k // 2 + k, 0), len(self.offsets) - 1)
+                start, stop = self.offsets[first], self.offsets[last]
+                part = _merge_cells(cells[start:stop], self.counts[start:stop], weighted[start:stop], n_cells)
+                parts.append(part + (np.full(len(part[0]), level, dtype=np.int32),))
+                offsets[level + 1] = offsets[level] + len(part[0])
+
+            cells, counts, sums, levels = (np.concatenate(arrays) for arrays in zip(*parts))
+            indices = np.empty((len(cells), 3), dtype=np.int32)
+            indices[:, 0] = cells % nx
+            indices[:, 1] = cells // nx
+            indices[:, 2] = levels
+            level_filter._set_arrays(indices, (sums / counts).astype(np.float32), offsets, counts.astype(np.int32))
+
+        return level_filter
+
+    def _sort(self, indices, values, counts=None):
+        order, offsets = bucket_sort(indices[:, 2], self.level(255) + 1)
+        self._set_arrays(indices[order], values[order], offsets, None if counts is None else counts[order])
+
+    def _set_arrays(self, indices, values, offsets, counts=None):
+        self.indices = indices
+        self.values = values
+        self.offsets = offsets
+        self.counts = counts
+
+        self.lower = 0
+        self.upper = 255
+        self.start = 0
+        self.stop = len(self.indices)
+
+    @property
+    def arrays(self):
+        arrays = {'indices': self.indices, 'values': self.values, 'offsets': self.offsets}
+        if self.counts is not None:
+            arrays['counts'] = self.counts
+
+        return arrays
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def level(self, value):
+        return (int(value) + self.z_size // 2) // self.z_size
+
+    def set_window(self, lower, upper):
+        """
+        Moves the intensity window and returns the matching slice of the sorted voxels.
+
+        :param      lower | int
+                    upper | int
+
+        :return     slice
+        """
+        if lower != self.lower:
+            self.start = self.offsets[self.level(lower)]
+            self.lower = lower
+        if upper != self.upper:
+            self.stop = self.offsets[self.level(upper) + 1]
+            self.upper = upper
+
+        return slice(self.start, max(self.start, self.stop))
+
+    def window(self, lower, upper):
+        """
+        Returns the voxels within the intensity window, as views on the sorted arrays.
+
+        :return     (indices, values) | np.ndarray (M, 3), np.ndarray (M,)
+        """
+        with span('window', lower=int(lower), upper=int(upper)):
+            selection = self.set_window(lower, upper)
+
+            return self.indices[selection], self.values[selection]
+
+    def window_key(self, lower, upper):
+        # windows touching the same voxel layers give the same grid
+        return self.level(lower), self.level(upper)
@@ -0,0 +1,134 @@
+""" Background worker running the heavy voxelization jobs away from the GUI thread."""
+
+import threading
+import time
+from collections import deque
+
+import instrument
+
+# Delay during which rapid requests (e.g. NumberEdit changes) are merged into the last one
+DEBOUNCE_S = 0.08
+
+
+class LatestJobWorker:
+    """
+    Runs jobs on a background thread, keeping only the latest submitted one.
+
+    Submitting a job makes all the previous ones stale: a pending job is replaced
+    before it starts, a running job can poll its 'cancelled' argument to stop early,
+    and the result of a stale job is dropped instead of being handed to the GUI.
+    Results are delivered through 'post', which must run a callback on the main thread
+    (e.g. gui.Application.instance.post_to_main_thread). A job that raises is recorded
+    with instrument.error and, unless stale, its exception is handed to on_error instead.
+
+    Tasks ('run') are side work without a result, e.g. writing a cache entry: they run
+    before the next job and never become stale.
+    """
+
+    def __init__(self, post, on_error=None):
+        self._post = post
+        self._on_error = on_error
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._pending = None
+        self._tasks = deque()
+        self._running = True
+
+        self._thread = threading.Thread(target=self._run, name='voxel-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, job, on_done, delay=0.0):
+        """
+        Schedules job(cancelled) and, if still current when finished, on_done(result).
+
+        :param      job | callable taking a 'cancelled' callable, returning the result
+                    on_done | callable, run on the main thread
+                    delay | float, debounce delay in seconds
+        """
+        with self._cond:
+            self._generation += 1
+            self._pending = (self._generation, job, on_done, time.monotonic() + delay)
+            self._cond.notify()
+
+    def run(self, task):
+        """
+        Schedules task() on the background thread, ahead of the pending job.
+
+        :param      task | callable without argument
+        """
+        with self._cond:
+            self._tasks.append(task)
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._generation += 1
+            self._pending = None
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._pending = None
+            self._tasks.clear()
+            self._cond.notify()
+
+    def is_current(self, generation):
+        return generation == self._generation
+
+    def _next_job(self):
+        with self._cond:
+            while self._running:
+                if self._tasks:
+                    return self._tasks.popleft()
+                if self._pending is None:
+                    self._cond.wait()
+                    continue
+
+                # wait for the debounce delay, a newer submission restarts it
+                remaining = self._pending[3] - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+                pending, self._pending = self._pending, None
+                return pending
+
+        return None
+
+    def _run(self):
+        while True:
+            pending = self._next_job()
+            if pending is None:
+                return
+            if callable(pending):
+                try:
+                    pending()
+                except Exception as exc:
+                    instrument.error('task', exc)
+                continue
+
+            generation, job, on_done, _ = pending
+
+            def cancelled():
+                return not self.is_current(generation)
+
+            try:
+                result = job(cancelled)
+            except Exception as exc:
+                instrument.error('job', exc)
+                if self._on_error is not None and not cancelled():
+                    self._post(self._deliver(generation, self._on_error, exc))
+                continue
+
+            if cancelled():
+                continue
+
+            self._post(self._deliver(generation, on_done, result))
+
+    def _deliver(self, generation, callback, value):
+        def deliver():
+            # a newer job may have been submitted while this was queued
+            if self.is_current(generation):
+                callback(value)
+
+        return deliver